@@ -0,0 +1,61 @@
+"""
+Reports how large the documents table is, and how long fetching documents
+takes, for each document codec.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/codecs.py
+"""
+
+import os, random, shutil, sqlite3, tempfile, time
+
+from spot import Index
+from spot import document_codec
+
+kNumDocs = 20000
+kWords = ['the', 'comment', 'reddit', 'score', 'author', 'python', 'index', 'query', 'token', 'search', 'result', 'page']
+
+def make_doc(i):
+  # Roughly 2KB reddit-style comments.
+  return {
+    'rankings': { 'score': random.randint(-10, 1000) },
+    'tags': [f"author:user{random.randint(0, 500)}"],
+    'permalink': f"/r/python/comments/{i:08x}/",
+    'author': f"user{random.randint(0, 500)}",
+    'score': random.randint(-10, 1000),
+    'body': ' '.join(random.choices(kWords, k = 330)),
+  }
+
+if __name__ == '__main__':
+  random.seed(0)
+  docs = [make_doc(i) for i in range(kNumDocs)]
+  codecs = ['json', 'marshal', 'json+zlib', 'marshal+zlib']
+  if document_codec.msgpack is not None:
+    codecs += ['msgpack', 'msgpack+zlib']
+  if document_codec.zstandard is not None:
+    codecs += ['json+zstd', 'msgpack+zstd' if document_codec.msgpack else 'marshal+zstd', 'json+zstd (dictionary)']
+
+  print('%-24s %12s %14s %16s' % ('codec', 'bytes', 'fetch (us/doc)', 'fetch_many (us/doc)'))
+  for name in codecs:
+    codec = name.split(' ')[0]
+    path = tempfile.mkdtemp()
+    conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+    index = Index.create(conn, path, rankings=["score"], codec = codec)
+    index.insert_documents(docs)
+    if name.endswith('(dictionary)'):
+      index.train_codec_dictionary()
+    conn.execute("VACUUM")
+
+    nbytes = conn.execute("SELECT SUM(LENGTH(data)) FROM documents").fetchone()[0]
+    docids = random.sample(range(1, kNumDocs + 1), 2000)
+
+    start_time = time.time()
+    for docid in docids:
+      index.fetch(docid)
+    fetch_time = (time.time() - start_time) / len(docids)
+
+    start_time = time.time()
+    for i in range(0, len(docids), 20):
+      index.fetch_many(docids[i:i + 20])
+    fetch_many_time = (time.time() - start_time) / len(docids)
+
+    print('%-24s %12i %14.1f %16.1f' % (name, nbytes, fetch_time * 1e6, fetch_many_time * 1e6))
+    shutil.rmtree(path)
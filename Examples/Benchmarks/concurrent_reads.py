@@ -0,0 +1,46 @@
+"""
+Measures query throughput of an Index with concurrent_reads enabled, as the
+number of threads querying it grows. The posting cache is disabled, so every
+query reads from SQLite (which releases the GIL while it runs).
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/concurrent_reads.py
+"""
+
+import os, random, shutil, sqlite3, tempfile, time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import spot
+
+kNumDocs = 100000
+kNumTags = 200
+kNumQueries = 2000
+
+if __name__ == '__main__':
+  random.seed(0)
+  path = tempfile.mkdtemp()
+  conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+  spot.Index.create(conn, path, ['score'])
+  index = spot.Index(conn, path, posting_cache = None, concurrent_reads = True)
+  index.insert_documents({
+    'rankings': { 'score': random.randint(0, 1000) },
+    'tags': [f"tag{int(random.paretovariate(1)) % kNumTags}" for _ in range(5)],
+  } for _ in range(kNumDocs))
+
+  queries = [random.sample([f"tag{i}" for i in range(20)], 2) for _ in range(kNumQueries)]
+  def query(tags):
+    return index.search(index.intersect(*tags), 'score', k = 10)
+
+  print('%-8s %12s %10s' % ('threads', 'queries/s', 'speedup'))
+  baseline = None
+  for numThreads in [1, 2, 4, 8, 16]:
+    with ThreadPoolExecutor(numThreads) as executor:
+      # Open every thread's connection before timing.
+      list(executor.map(query, queries[:numThreads * 4]))
+      start_time = time.time()
+      list(executor.map(query, queries))
+      qps = len(queries) / (time.time() - start_time)
+    baseline = baseline or qps
+    print('%-8i %12.0f %10.2f' % (numThreads, qps, qps / baseline))
+  index.read_pool.close()
+  shutil.rmtree(path)
@@ -0,0 +1,54 @@
+"""
+Compares the streaming (Node.next) and vectorized (NumPy) query engines on a
+synthetic corpus.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/engines.py
+"""
+
+import os, random, shutil, sqlite3, tempfile, time
+
+from spot import Index, evaluate, stream
+from spot.nodes import OrNode
+
+kNumDocs = 50000
+kVocabSize = 2000
+
+def timeit(f, repeats = 5):
+  best = float('inf')
+  for _ in range(repeats):
+    start_time = time.time()
+    r = f()
+    best = min(best, time.time() - start_time)
+  return best, r
+
+if __name__ == '__main__':
+  random.seed(0)
+  path = tempfile.mkdtemp()
+  conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+  index = Index.create(conn, path, rankings=["score"])
+  index = Index(conn, path, posting_cache = None)
+
+  # Token i appears in roughly 1 / (i + 1) of documents.
+  weights = [1 / (i + 1) for i in range(kVocabSize)]
+  index.insert_documents({
+    'rankings': { 'score': random.randint(0, 1000) },
+    'tags': list(set(f"t{i}" for i in random.choices(range(kVocabSize), weights, k = 20))),
+  } for _ in range(kNumDocs))
+
+  queries = {
+    'common': lambda: index.intersect('t0'),
+    'common AND common': lambda: index.intersect('t0', 't1'),
+    'rare AND common': lambda: index.intersect('t500', 't0'),
+    'common AND NOT common': lambda: index.intersect('t0', 't2', invert = [False, True]),
+    'OR of 8': lambda: OrNode([(index.intersect(f"t{i}"), False) for i in range(1, 9)]),
+  }
+
+  print('%-24s %8s %12s %12s' % ('query', 'results', 'stream (ms)', 'numpy (ms)'))
+  for name, make_node in queries.items():
+    ctx = index.expression_context('score')
+    t1, A = timeit(lambda: stream(make_node(), ctx))
+    t2, B = timeit(lambda: evaluate(make_node(), ctx))
+    assert A == B
+    print('%-24s %8i %12.2f %12.2f' % (name, len(A), t1 * 1000, t2 * 1000))
+
+  shutil.rmtree(path)
@@ -0,0 +1,42 @@
+"""
+Compares And queries of a rare tag and a common filter token ("author:x"),
+where the filter is either probed through its postings or is a FilterNode,
+checked against the filter cache. The posting cache is disabled, so
+postings are read from SQLite.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/filters.py
+"""
+
+import os, random, shutil, sqlite3, tempfile, time
+
+import spot
+
+kNumDocs = 100000
+kNumTags = 200
+kNumAuthors = 5
+kNumQueries = 500
+
+class AuthorIndex(spot.Index):
+  def is_filter(self, token_str):
+    return token_str.startswith('author:')
+
+if __name__ == '__main__':
+  random.seed(0)
+  path = tempfile.mkdtemp()
+  conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+  spot.Index.create(conn, path, ['score', 'age'])
+  plain = spot.Index(conn, path, posting_cache = None)
+  plain.insert_documents({
+    'rankings': { 'score': random.randint(0, 1000), 'age': i },
+    'tags': [f"tag{random.randint(0, kNumTags - 1)}", f"author:{random.randint(0, kNumAuthors - 1)}"],
+  } for i in range(kNumDocs))
+  filtered = AuthorIndex(conn, path, posting_cache = None, filter_cache = spot.FilterCache())
+
+  queries = [(f"tag{random.randint(0, kNumTags - 1)}", f"author:{random.randint(0, kNumAuthors - 1)}", random.choice(['score', 'age'])) for _ in range(kNumQueries)]
+  print('%-10s %12s' % ('index', 'queries/s'))
+  for name, index in [('plain', plain), ('filtered', filtered)]:
+    start_time = time.time()
+    for tag, author, ranking in queries:
+      index.search(index.query(f"{tag} {author}", ranking), ranking, k = 100, fields = ['age'])
+    print('%-10s %12.0f' % (name, kNumQueries / (time.time() - start_time)))
+  shutil.rmtree(path)
@@ -0,0 +1,33 @@
+"""
+Compares OrNode (which advances every child on every call) with HeapOrNode
+(which only advances the children it has to) for wide Or queries.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/or_nodes.py
+"""
+
+import random, sqlite3, time
+
+from spot import TokenIndex, ExpressionContext, AdaptiveTokenNode, OrNode, HeapOrNode, stream
+
+kNumDocs = 100000
+kPostingsPerChild = 500
+
+if __name__ == '__main__':
+  random.seed(0)
+  conn = sqlite3.connect(':memory:')
+  c = conn.cursor()
+  index = TokenIndex.create(c, 'score')
+  for token in range(1, 129):
+    docids = random.sample(range(kNumDocs), kPostingsPerChild)
+    index.insert_many(c, ((docid % 1000, docid, token) for docid in docids))
+
+  print('%-10s %8s %14s %16s' % ('children', 'results', 'OrNode (ms)', 'HeapOrNode (ms)'))
+  for n in [8, 32, 128]:
+    times = []
+    for cls in [OrNode, HeapOrNode]:
+      ctx = ExpressionContext(c = c, r = 1, pageLength = 1000, index = index)
+      node = cls([(AdaptiveTokenNode(token), False) for token in range(1, n + 1)])
+      start_time = time.time()
+      results = stream(node, ctx)
+      times.append(time.time() - start_time)
+    print('%-10i %8i %14.1f %16.1f' % (n, len(results), times[0] * 1000, times[1] * 1000))
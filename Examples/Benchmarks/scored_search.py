@@ -0,0 +1,41 @@
+"""
+Compares the latency of Index.scored_search on 5-token Or queries when every
+matching document is scored ("exhaustive") with WAND and block-max WAND, on
+a synthetic corpus with Zipf-distributed tokens and random priors.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/scored_search.py
+"""
+
+import os, random, shutil, sqlite3, tempfile, time
+
+import spot
+from spot.bench import zipf_corpus
+
+kNumDocs = 100000
+kVocabSize = 5000
+kNumQueries = 50
+
+if __name__ == '__main__':
+  random.seed(0)
+  path = tempfile.mkdtemp()
+  conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+  spot.Index.create(conn, path, ['score'], scored = True)
+  index = spot.Index(conn, path, posting_cache = None)
+  index.add_range('depth', 0, 1023)
+  def with_prior(doc):
+    doc['prior'] = random.random()
+    return doc
+  index.insert_documents(with_prior(doc) for doc in zipf_corpus(kNumDocs, kVocabSize))
+
+  # Mostly common tokens, plus a couple of rarer ones.
+  queries = [[f"t{random.randint(0, 50)}" for _ in range(3)] + [f"t{random.randint(50, 500)}" for _ in range(2)] for _ in range(kNumQueries)]
+  print('%-16s %10s %10s' % ('method', 'k', 'ms/query'))
+  for k in [10, 100]:
+    expected = None
+    for method in ['exhaustive', 'wand', 'block_max_wand']:
+      start_time = time.time()
+      results = [index.scored_search(tokens, k, method = method, fields = ['prior']) for tokens in queries]
+      print('%-16s %10i %10.2f' % (method, k, (time.time() - start_time) * 1000 / len(queries)))
+      expected = expected or results
+      assert results == expected
+  shutil.rmtree(path)
@@ -0,0 +1,60 @@
+"""
+Compares the cost of single-document inserts into a plain Index and into a
+segmented one (see Index.create's segment_size), as the index grows, and
+the latency of queries over the segmented index before and after it is
+compacted.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/segments.py
+"""
+
+import os, random, shutil, sqlite3, tempfile, time
+
+import spot
+
+kNumTags = 1000
+kInsertsPerStep = 1000
+kBulkPerStep = 100000
+
+def make_doc():
+  return {
+    'rankings': { 'score': random.randint(0, 1000000) },
+    'tags': [f"tag{int(random.paretovariate(0.5)) % kNumTags}" for _ in range(20)],
+  }
+
+if __name__ == '__main__':
+  random.seed(0)
+  indices = {}
+  for name, kwargs in [('plain', {}), ('segmented', { 'segment_size': 5000 })]:
+    path = tempfile.mkdtemp()
+    conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+    spot.Index.create(conn, path, ['score'], **kwargs)
+    indices[name] = (path, spot.Index(conn, path, posting_cache = None))
+
+  print('%-10s %18s %22s' % ('docs', 'plain (inserts/s)', 'segmented (inserts/s)'))
+  for step in range(4):
+    rates = []
+    bulk = [make_doc() for _ in range(kBulkPerStep)]
+    docs = [make_doc() for _ in range(kInsertsPerStep)]
+    for name, (path, index) in indices.items():
+      index.insert_documents(bulk)
+      if index.segments is not None:
+        index.compact(full = True)
+      start_time = time.time()
+      for doc in docs:
+        index.insert_document(doc)
+      rates.append(len(docs) / (time.time() - start_time))
+    print('%-10i %18.0f %22.0f' % ((step + 1) * (kBulkPerStep + kInsertsPerStep), rates[0], rates[1]))
+
+  _, index = indices['segmented']
+  for i in range(20000):
+    index.insert_document(make_doc())
+  queries = [random.sample([f"tag{i}" for i in range(10)], 2) for _ in range(200)]
+  for label in ['%i segments' % len(index.segments['names']), 'compacted']:
+    start_time = time.time()
+    for tags in queries:
+      index.search(index.intersect(*tags), 'score', k = 10)
+    print('query latency (%s): %.2f ms' % (label, (time.time() - start_time) * 1000 / len(queries)))
+    index.compact(full = True)
+
+  for path, _ in indices.values():
+    shutil.rmtree(path)
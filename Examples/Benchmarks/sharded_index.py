@@ -0,0 +1,38 @@
+"""
+Measures ingestion and query throughput of a ShardedIndex as the number of
+shards (and worker processes) grows. Both should scale with the number of
+cores, up to one shard per core.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/sharded_index.py
+"""
+
+import random, shutil, tempfile, time
+
+import spot
+
+kNumDocs = 100000
+kNumTags = 200
+kNumQueries = 200
+
+if __name__ == '__main__':
+  random.seed(0)
+  docs = [{
+    'rankings': { 'score': random.randint(0, 1000) },
+    'tags': [f"tag{int(random.paretovariate(1)) % kNumTags}" for _ in range(5)],
+  } for _ in range(kNumDocs)]
+  queries = [random.sample([f"tag{i}" for i in range(20)], 2) for _ in range(kNumQueries)]
+
+  print('%-8s %12s %12s' % ('shards', 'docs/s', 'queries/s'))
+  for numShards in [1, 2, 4, 8]:
+    path = tempfile.mkdtemp()
+    with spot.ShardedIndex.create(path, numShards, ['score'], processes = numShards) as index:
+      start_time = time.time()
+      index.insert_documents(docs)
+      docsPerSecond = kNumDocs / (time.time() - start_time)
+
+      start_time = time.time()
+      for tags in queries:
+        index.search(tags, 'score', k = 10)
+      queriesPerSecond = kNumQueries / (time.time() - start_time)
+    print('%-8i %12.0f %12.1f' % (numShards, docsPerSecond, queriesPerSecond))
+    shutil.rmtree(path)
@@ -0,0 +1,50 @@
+"""
+Reports the startup time and memory use of the in-memory token dictionary,
+and compares its lookups and prefix searches with the SQL-backed ones.
+
+$ PYTHONPATH=. python3 Examples/Benchmarks/token_dictionary.py [vocab_size]
+"""
+
+import os, random, shutil, sqlite3, sys, tempfile, time
+
+from spot import TokenMapper
+
+kLetters = 'abcdefghijklmnopqrstuvwxyz'
+
+def rss_mb():
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+def per_call_us(f, args):
+  start_time = time.time()
+  for a in args:
+    f(a)
+  return (time.time() - start_time) / len(args) * 1e6
+
+if __name__ == '__main__':
+  vocab_size = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+  random.seed(0)
+  path = tempfile.mkdtemp()
+  conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+  c = conn.cursor()
+  TokenMapper(c)
+  tokens = [''.join(random.choices(kLetters, k = random.randint(3, 12))) + str(i) for i in range(vocab_size)]
+  c.executemany("INSERT INTO tokens (rowid, token_str, count) VALUES (?, ?, ?)", (
+    (i + 1, token, int(vocab_size / (i + 1))) for i, token in enumerate(tokens)
+  ))
+  conn.commit()
+
+  rss = rss_mb()
+  start_time = time.time()
+  in_memory = TokenMapper(c, in_memory = True)
+  print('vocabulary: %i tokens' % vocab_size)
+  print('startup: %.2f seconds' % (time.time() - start_time))
+  print('RSS: +%.0f MB' % (rss_mb() - rss))
+
+  sql = TokenMapper(c)
+  sample = random.sample(tokens, 10000)
+  prefixes = [token[:random.randint(1, 3)] for token in random.sample(tokens, 200)]
+  print('%-16s %10s %12s' % ('', 'sql (us)', 'memory (us)'))
+  print('%-16s %10.1f %12.1f' % ('lookup', per_call_us(lambda t: sql(t, c), sample), per_call_us(lambda t: in_memory(t, c), sample)))
+  print('%-16s %10.1f %12.1f' % ('prefix search', per_call_us(lambda t: sql.search(t, c), prefixes), per_call_us(lambda t: in_memory.search(t, c), prefixes)))
+  shutil.rmtree(path)
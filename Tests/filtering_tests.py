@@ -4,12 +4,23 @@ From top-level spot directory, run:
 $ pip install .; python3 -m unittest filtering_tests.py
 """
 
+import asyncio
+import contextlib
+import io
+import math
+import random
 import os
 import shutil
 import sqlite3
+import threading
+import time
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+
 import spot
+import spot.bench
+import spot.document_codec
 
 class IndexTest(unittest.TestCase):
   def test1(self):
@@ -56,3 +67,1060 @@ class IndexTest(unittest.TestCase):
       A.append(node.next(ctx, A[-1]))
     A = A[1:-1]
     self.assertEqual([a[1] for a in A], [4, 1])
+
+  def test_insert_documents(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'])
+
+    docids = index.insert_documents([
+      { 'rankings': { 'score': 3.0 }, 'tags': ['foo', 'bar'] },
+      { 'rankings': { 'score': 1.0 }, 'tags': ['foo'] },
+      { 'rankings': { 'score': 4.0 }, 'tags': ['bar'] },
+    ], batch_size = 2)
+    self.assertEqual(docids, [1, 2, 3])
+    index.insert_document({ 'rankings': { 'score': 2.0 }, 'tags': ['foo', 'bar', 'baz'] })
+    self.assertEqual(index.insert_documents([{ 'rankings': { 'score': 0.0 }, 'tags': ['baz'] }]), [5])
+
+    self.assertEqual(index.fetch(3)['tags'], ['bar'])
+    self.assertEqual(dict(index.token_search('ba')), { 'bar': 3, 'baz': 2 })
+
+    ctx = index.expression_context('score')
+    node = index.intersect('foo', 'bar')
+    A = [ctx.first]
+    while A[-1] != ctx.last:
+      A.append(node.next(ctx, A[-1]))
+    A = A[1:-1]
+    self.assertEqual([a[1] for a in A], [4, 1])
+
+  def test_index_builder(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'])
+    index.insert_document({ 'rankings': { 'score': 50 }, 'tags': ['foo', 'bar'] })
+
+    # A tiny budget forces a spill every batch.
+    builder = index.builder(memory_budget = 1, batch_size = 7)
+    builder.insert_documents({
+      'rankings': { 'score': i % 13 },
+      'tags': [t for t, k in [('foo', 2), ('bar', 3), ('baz', 5)] if i % k == 0],
+    } for i in range(100))
+    self.assertGreater(builder.num_runs(), 1)
+    builder.finish()
+
+    # The document inserted before the builder has docid 1.
+    expected = sorted([(50, 1)] + [(i % 13, i + 2) for i in range(0, 100, 6)])
+
+    ctx = index.expression_context('score')
+    node = index.intersect('foo', 'bar')
+    A = [ctx.first]
+    while A[-1] != ctx.last:
+      A.append(node.next(ctx, A[-1]))
+    self.assertEqual(A[1:-1], expected)
+
+  def test_pair_counts(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'], pair_counts = True)
+    index.insert_document({ 'rankings': { 'score': 1 }, 'tags': ['foo', 'bar', 'baz'] })
+    index.insert_documents([
+      { 'rankings': { 'score': 2 }, 'tags': ['foo', 'bar'] },
+      { 'rankings': { 'score': 3 }, 'tags': ['bar', 'baz'] },
+    ])
+    index.modify_document(1, { 'rankings': { 'score': 1 }, 'tags': ['foo', 'baz'] })
+    index.save()
+
+    index = spot.Index(conn, 'tmp')
+    ctx = index.expression_context('score')
+    foo, bar, baz = [index.token_mapper(t, index.ctx) for t in ['foo', 'bar', 'baz']]
+    self.assertEqual(ctx.count(bar), 2)
+    self.assertEqual(ctx.pair_count(foo, bar), 1)
+    self.assertEqual(ctx.pair_count(bar, baz), 1)
+    self.assertEqual(ctx.pair_count(baz, foo), 1)
+
+  def test_posting_cache(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache())
+
+    def query(*tags):
+      ctx = index.expression_context('score')
+      node = index.intersect(*tags)
+      A = [ctx.first]
+      while A[-1] != ctx.last:
+        A.append(node.next(ctx, A[-1]))
+      return [a[1] for a in A[1:-1]]
+
+    index.insert_document({ 'rankings': { 'score': 3 }, 'tags': ['foo', 'bar'] })
+    index.insert_documents([{ 'rankings': { 'score': 1 }, 'tags': ['foo'] }])
+    self.assertEqual(query('foo'), [2, 1])
+    self.assertEqual(query('foo'), [2, 1])
+    self.assertGreater(index.cache_stats()['hits'], 0)
+
+    index.insert_document({ 'rankings': { 'score': 2 }, 'tags': ['foo'] })
+    self.assertEqual(query('foo'), [2, 3, 1])
+    index.modify_document(2, { 'rankings': { 'score': 1 }, 'tags': ['bar'] })
+    self.assertEqual(query('foo'), [3, 1])
+    self.assertEqual(query('bar'), [2, 1])
+
+    index.posting_cache.max_bytes = index.posting_cache.nbytes
+    self.assertEqual(query('foo', 'bar'), [1])
+    self.assertGreater(index.cache_stats()['evictions'], 0)
+    self.assertLessEqual(index.cache_stats()['bytes'], index.posting_cache.max_bytes)
+
+    # Without a posting cache (the default), writes made through other
+    # connections are seen immediately.
+    index = spot.Index(conn, 'tmp')
+    self.assertIsNone(index.cache_stats())
+    self.assertEqual(query('foo'), [3, 1])
+    spot.Index(sqlite3.connect("tmp/db.sqlite"), 'tmp').insert_document({ 'rankings': { 'score': 0 }, 'tags': ['foo'] })
+    self.assertEqual(query('foo'), [4, 3, 1])
+
+  def test_search(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'])
+    index.insert_documents({
+      'rankings': { 'score': (i * 7) % 10 },
+      'tags': ['foo'] if i % 2 == 0 else ['bar'],
+      'i': i,
+    } for i in range(10))
+
+    results = index.search(index.intersect('foo'), 'score', k = 2)
+    self.assertEqual([(rank, docid) for rank, docid, _ in results], [(0, 1), (2, 7)])
+    self.assertEqual([doc['i'] for _, _, doc in results], [0, 6])
+
+    results = index.search(index.intersect('foo'), 'score', k = 2, offset = 2)
+    self.assertEqual([doc['i'] for _, _, doc in results], [2, 8])
+    results = index.search(index.intersect('foo'), 'score', k = 20, offset = 4)
+    self.assertEqual([doc['i'] for _, _, doc in results], [4])
+    self.assertEqual(index.search(index.intersect('foo'), 'score', k = 2, offset = 5), [])
+
+  def test_descending_search(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'])
+    index.insert_documents({
+      'rankings': { 'score': (i * 7) % 10 },
+      'tags': ['foo'] if i % 2 == 0 else ['bar'],
+      'i': i,
+    } for i in range(10))
+
+    results = index.search(index.intersect('foo'), 'score', k = 3, descending = True)
+    self.assertEqual([(rank, docid) for rank, docid, _ in results], [(8, 5), (6, 9), (4, 3)])
+    results = index.search(index.intersect('foo'), '-score', k = 3, offset = 2)
+    self.assertEqual([doc['i'] for _, _, doc in results], [2, 6, 0])
+
+  def test_reused_nodes(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score', 'age'])
+    index.insert_documents({
+      'rankings': { 'score': (i * 7) % 10, 'age': i },
+      'tags': ['foo', 'baz'] if i % 2 == 0 else ['bar', 'baz'],
+    } for i in range(10))
+
+    # A node can be searched again with another ranking or direction.
+    makers = [
+      lambda: index.intersect('foo'),
+      lambda: index.intersect('baz', 'bar', invert = [False, True]),
+      lambda: index.query('foo OR bar'),
+    ]
+    for make_node in makers:
+      node = make_node()
+      for ranking, descending in [('score', False), ('score', True), ('age', False), ('-score', False), ('age', True), ('score', False)]:
+        expected = index.search(make_node(), ranking, k = 3, descending = descending)
+        self.assertEqual(index.search(node, ranking, k = 3, descending = descending), expected)
+
+  def test_document_codecs(self):
+    codecs = ['json', 'marshal', 'json+zlib', 'marshal+zlib']
+    if spot.document_codec.msgpack is not None:
+      codecs.append('msgpack')
+    if spot.document_codec.zstandard is not None:
+      codecs += ['json+zstd', 'marshal+zstd']
+    for codec in codecs:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      index = spot.Index.create(conn, 'tmp', ['score'], codec = codec)
+      docs = [{
+        'rankings': { 'score': i },
+        'tags': ['foo'],
+        'body': f"comment number {i} " * 20,
+      } for i in range(300)]
+      index.insert_documents(docs[:-1])
+      index.insert_document(docs[-1])
+      docs[3] = { 'rankings': { 'score': 3 }, 'tags': ['foo'], 'body': 'modified' }
+      index.modify_document(4, docs[3])
+
+      index = spot.Index(conn, 'tmp')
+      self.assertEqual(index.fetch(4), docs[3], codec)
+      self.assertEqual(index.fetch_many([300, 1]), [docs[299], docs[0]], codec)
+      if codec.endswith('+zstd'):
+        index.train_codec_dictionary(size = 1024)
+        index = spot.Index(conn, 'tmp')
+        self.assertEqual(index.fetch_many(range(1, 301)), docs, codec)
+
+  def test_fetch_fields(self):
+    for codec, fields in [('json', []), ('json', ['permalink', 'score']), ('marshal+zlib', []), ('marshal+zlib', ['score'])]:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      index = spot.Index.create(conn, 'tmp', ['score'], codec = codec, fields = fields)
+      index.insert_document({ 'rankings': { 'score': 1 }, 'permalink': '/a', 'score': 1, 'body': 'x' * 1000, "it's": 'a', 'say "hi"': 'b' })
+      index.insert_documents([
+        { 'rankings': { 'score': 2 }, 'permalink': '/b', 'score': 2, 'meta': { 'depth': [1, 2] } },
+        { 'rankings': { 'score': 3 }, 'permalink': '/c', 'score': 3 },
+      ])
+      index.modify_document(3, { 'rankings': { 'score': 3 }, 'permalink': '/d', 'score': 4 })
+
+      index = spot.Index(conn, 'tmp')
+      self.assertEqual(index.fetch_many([3, 1], fields = ['permalink', 'score']), [
+        { 'permalink': '/d', 'score': 4 },
+        { 'permalink': '/a', 'score': 1 },
+      ], (codec, fields))
+      self.assertEqual(index.fetch_many([2, 1], fields = ['score', 'meta']), [
+        { 'score': 2, 'meta': { 'depth': [1, 2] } },
+        { 'score': 1, 'meta': None },
+      ], (codec, fields))
+      self.assertEqual(index.fetch_many([1])[0]['body'], 'x' * 1000)
+      self.assertEqual(index.fetch_many([1, 2], fields = ["it's", 'say "hi"']), [
+        { "it's": 'a', 'say "hi"': 'b' },
+        { "it's": None, 'say "hi"': None },
+      ], (codec, fields))
+      self.assertEqual(index.fetch_many([1], fields = ["' || (SELECT group_concat(token_str) FROM tokens) || '"]), [
+        { "' || (SELECT group_concat(token_str) FROM tokens) || '": None },
+      ])
+      with self.assertRaises(ValueError):
+        index.fetch_many([1], fields = [1])
+      self.assertEqual(index.search(index.intersect(''), '-score', k = 1, fields = ['permalink']), [(3, 3, { 'permalink': '/d' })])
+
+  def test_in_memory_tokens(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    index = spot.Index(conn, 'tmp')
+    index.insert_document({ 'rankings': { 'score': 1 }, 'tags': ['foo', 'food', 'bar'] })
+
+    index = spot.Index(conn, 'tmp', in_memory_tokens = True)
+    index.insert_document({ 'rankings': { 'score': 2 }, 'tags': ['food', 'fool'] })
+    index.insert_documents([{ 'rankings': { 'score': 3 }, 'tags': ['fool', 'food', 'foot'] } for _ in range(2)])
+    index.modify_document(1, { 'rankings': { 'score': 1 }, 'tags': ['food', 'bar'] })
+    expected = [('food', 4), ('fool', 3), ('foot', 2), ('foo', 0)]
+    self.assertEqual(index.token_search('fo'), expected)
+    self.assertEqual(index.token_search('foo'), expected)
+    self.assertEqual(index.token_search('food'), [('food', 4)])
+    self.assertEqual(index.token_search('x'), [])
+    self.assertEqual(spot.Index(conn, 'tmp').token_search('fo'), expected)
+
+    dictionary = spot.TokenDictionary((i, f"t{i:05}", i % 100) for i in range(1, 3000))
+    for i in range(3000, 5000):
+      dictionary.add(f"t{i:05}", i, i % 100)
+    dictionary.increment('t00042', 1000)
+    self.assertEqual(dictionary.get('t04000'), 4000)
+    self.assertEqual(dictionary.search('t0004', 3), [('t00042', 1042), ('t00049', 49), ('t00048', 48)])
+    self.assertEqual([count for _, count in dictionary.search('t04', 3)], [99, 99, 99])
+
+  def test_ranges(self):
+    for branching_factor in [2, 4, 16]:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      index = spot.Index.create(conn, 'tmp', ['score', 'age'])
+      index.add_range('depth', 0, 40, branching_factor)
+      index.add_range('score', 0, 100, branching_factor)
+      docs = [{
+        'rankings': { 'score': (i * 37) % 101, 'age': i },
+        'ranges': { 'depth': i % 41, 'score': (i * 37) % 101 },
+        'tags': ['foo'] if i % 3 == 0 else [],
+      } for i in range(200)]
+      index.insert_documents(docs)
+      self.assertEqual(len(index.ranges['depth'].tokens(3)), { 2: 6, 4: 3, 16: 2 }[branching_factor])
+
+      predicates = { '<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b }
+      for field in ['depth', 'score']:
+        for op in predicates:
+          for value in [-1, 0, 7, 12.5, 40, 99]:
+            for neg in [False, True]:
+              for ranking in ['age', 'score', '-score']:
+                expected = sorted(
+                  ((doc['rankings'][ranking.lstrip('-')], docid) for docid, doc in enumerate(docs, 1)
+                  if 'foo' in doc['tags'] and predicates[op](doc['ranges'][field], value) != neg),
+                  reverse = ranking.startswith('-'),
+                )
+                node = index.intersect('foo', (field, op, value), invert = [False, neg], ranking = ranking)
+                ctx = index.expression_context(ranking)
+                self.assertEqual(spot.stream(node, ctx), expected, (branching_factor, field, op, value, neg, ranking))
+                if spot.vector_engine.np is not None:
+                  node = index.intersect('foo', (field, op, value), invert = [False, neg], ranking = ranking)
+                  self.assertEqual(spot.evaluate(node, ctx), expected)
+
+      node = index.intersect(('score', '>', 10), ('score', '<=', 12), ranking = 'score')
+      self.assertIsInstance(node, spot.nodes.RankRangeNode)
+      self.assertEqual(spot.stream(node, index.expression_context('score')), [(11, 75), (11, 176), (12, 45), (12, 146)])
+      self.assertIsInstance(index.intersect(('score', '>', 10), ('score', '<', 11), ranking = 'score'), spot.nodes.EmptyNode)
+
+  def test_concurrent_reads(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache(), concurrent_reads = True)
+    index.insert_documents({
+      'rankings': { 'score': i % 10 },
+      'tags': ['foo'] if i % 2 == 0 else ['bar'],
+      'i': i,
+    } for i in range(100))
+
+    def query(tag):
+      return [(rank, docid) for rank, docid, _ in index.search(index.intersect(tag), 'score', k = 100)]
+
+    expected = { tag: query(tag) for tag in ['foo', 'bar'] }
+    with ThreadPoolExecutor(8) as executor:
+      results = list(executor.map(query, ['foo', 'bar'] * 50))
+    self.assertEqual(results, [expected['foo'], expected['bar']] * 50)
+    self.assertGreater(len(index.read_pool), 1)
+
+    # Writes are visible to (and invalidate the caches of) other threads.
+    index.insert_document({ 'rankings': { 'score': 0 }, 'tags': ['foo'] })
+    with ThreadPoolExecutor(4) as executor:
+      results = list(executor.map(query, ['foo'] * 8))
+    self.assertEqual(results, [sorted(expected['foo'] + [(0, 101)])] * 8)
+    index.read_pool.close()
+
+  def test_async_index(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    index = spot.Index(conn, 'tmp', concurrent_reads = True)
+    index.insert_documents({
+      'rankings': { 'score': i % 10 },
+      'tags': ['foo'] if i % 2 == 0 else ['bar'],
+      'i': i,
+    } for i in range(100))
+    expected = index.search(index.intersect('foo'), 'score', k = 5, offset = 3)
+
+    async def main():
+      async with spot.AsyncIndex(index) as aindex:
+        nodes = [await aindex.intersect('foo') for _ in range(10)]
+        results = await asyncio.gather(*[aindex.search(node, 'score', k = 5, offset = 3) for node in nodes])
+        self.assertEqual(results, [expected] * 10)
+        self.assertGreater(aindex.coalesced, 0)
+
+        docs = await aindex.fetch_many([3, 1, 2], fields = ['i'])
+        self.assertEqual(docs, [{ 'i': 2 }, { 'i': 0 }, { 'i': 1 }])
+        self.assertEqual((await aindex.fetch(4))['i'], 3)
+
+        node = await aindex.intersect('bar')
+        results = [(rank, doc['i']) async for rank, _, doc in aindex.iterate(node, '-score', page_size = 7)]
+        self.assertEqual(results, sorted(((i % 10, i) for i in range(1, 100, 2)), key = lambda r: (-r[0], -r[1])))
+
+      # Leaving the block doesn't block the event loop while calls finish.
+      ticks = 0
+      async def tick():
+        nonlocal ticks
+        while True:
+          ticks += 1
+          await asyncio.sleep(0.01)
+      ticker = asyncio.create_task(tick())
+      async with spot.AsyncIndex(index) as aindex:
+        aindex._executor.submit(time.sleep, 0.3)
+      self.assertGreater(ticks, 5)
+      ticker.cancel()
+
+    asyncio.run(main())
+    index.read_pool.close()
+
+  def test_sharded_index(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'])
+    index.add_range('depth', 0, 63)
+    docs = [{
+      'rankings': { 'score': (i * 37) % 211 },
+      'ranges': { 'depth': i % 41 },
+      'tags': ['foo'] if i % 3 == 0 else ['bar'],
+      'i': i,
+    } for i in range(200)]
+    index.insert_documents(docs)
+
+    with spot.ShardedIndex.create('tmp/sharded', 3, ['score'], processes = 2) as sharded:
+      sharded.add_range('depth', 0, 63)
+      docids = sharded.insert_documents(docs[:150])
+      docids.append(sharded.insert_document(docs[150]))
+      docids += sharded.insert_documents(docs[151:])
+      self.assertEqual(len(set(docid % 3 for docid in docids)), 3)
+      self.assertEqual([doc['i'] for doc in sharded.fetch_many(docids)], list(range(200)))
+      self.assertEqual(sharded.fetch(docids[7])['i'], 7)
+
+      for tags, invert in [(['foo'], None), (['bar', ('depth', '<', 10)], None), (['foo', ('depth', '>=', 20)], [True, False])]:
+        for ranking in ['score', '-score']:
+          for k, offset in [(5, 0), (10, 3), (300, 0)]:
+            expected = [(rank, doc['i']) for rank, _, doc in index.search(index.intersect(*tags, invert = invert), ranking, k, offset)]
+            results = sharded.search(tags, ranking, k, offset, invert = invert)
+            self.assertEqual([(rank, doc['i']) for rank, _, doc in results], expected)
+            self.assertEqual([docid for _, docid, _ in results], [docids[i] for _, i in expected])
+
+    # Ties are broken by global docid. Inserting documents into a single
+    # Index in the order of their global docids makes it break them the same way.
+    docs = [{ 'rankings': { 'score': i % 4 }, 'tags': ['foo'] if i % 5 else ['bar'], 'i': i } for i in range(120)]
+    with spot.ShardedIndex.create('tmp/ties', 3, ['score'], processes = 2) as sharded:
+      docids = sharded.insert_documents(docs)
+      self.assertEqual(len(set(docid % 3 for docid in docids)), 3)
+      os.mkdir('tmp/single')
+      index = spot.Index.create(sqlite3.connect("tmp/single/db.sqlite"), 'tmp/single', ['score'])
+      index.insert_documents(doc for _, doc in sorted(zip(docids, docs), key = lambda x: x[0]))
+      for tags in [['foo'], ['bar']]:
+        for ranking in ['score', '-score']:
+          for k, offset in [(7, 0), (20, 13), (300, 0)]:
+            expected = [(rank, doc['i']) for rank, _, doc in index.search(index.intersect(*tags), ranking, k, offset)]
+            results = sharded.search(tags, ranking, k, offset)
+            # The tied matches come from several shards.
+            self.assertGreater(len(set(docid % 3 for rank, docid, _ in results if rank == results[0][0])), 1)
+            self.assertEqual([(rank, doc['i']) for rank, _, doc in results], expected)
+
+  def test_segmented_index(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'], segment_size = 10)
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache(), concurrent_reads = True)
+    index.add_range('depth', 0, 15)
+
+    docs = {}
+    def insert(i):
+      doc = { 'rankings': { 'score': (i * 7) % 50 }, 'ranges': { 'depth': i % 16 }, 'tags': ['foo'] if i % 2 == 0 else ['bar'] }
+      return doc
+
+    def check():
+      for tags in [['foo'], ['bar'], ['foo', ('depth', '<', 8)]]:
+        for ranking in ['score', '-score']:
+          expected = sorted(
+            ((doc['rankings']['score'], docid) for docid, doc in docs.items()
+            if tags[0] in doc['tags'] and (len(tags) == 1 or doc['ranges']['depth'] < 8)),
+            reverse = ranking.startswith('-'),
+          )
+          self.assertEqual(spot.stream(index.intersect(*tags), index.expression_context(ranking)), expected)
+          results = index.search(index.intersect(*tags), ranking, k = 5)
+          self.assertEqual([(rank, docid) for rank, docid, _ in results], expected[:5])
+      # Token counts are updated by vacuum_deleted.
+      index.vacuum_deleted()
+      self.assertEqual(sorted(index.token_search('foo')), [('foo', sum('foo' in doc['tags'] for doc in docs.values()))])
+
+    for docid, doc in zip(index.insert_documents((insert(i) for i in range(25)), batch_size = 10), map(insert, range(25))):
+      docs[docid] = doc
+    for i in range(25, 35):
+      docs[index.insert_document(insert(i))] = insert(i)
+    self.assertEqual(index.segments['names'], ['', 'seg1', 'seg2', 'seg3', 'seg4'])
+    check()
+
+    # Modified documents move to the fresh segment.
+    for docid in [1, 12, 33]:
+      docs[docid] = { 'rankings': { 'score': 100 + docid }, 'ranges': { 'depth': 3 }, 'tags': ['foo', 'baz'] }
+      index.modify_document(docid, docs[docid])
+    for docid in [2, 13, 34, 33]:
+      index.delete_document(docid)
+      del docs[docid]
+    self.assertIsNone(index.fetch(2))
+    check()
+    self.assertEqual(index.insert_document(insert(35)), 36)
+    docs[36] = insert(35)
+    check()
+
+    node = index.intersect('foo')
+    index.compact()
+    self.assertEqual(index.segments['names'], [''])
+    self.assertEqual(index.segments['retired'], ['seg1', 'seg2', 'seg3', 'seg4'])
+    check()
+    # Nodes created before a compaction still work until the next one.
+    ctx = index.expression_context('score')
+    self.assertEqual(spot.stream(node, ctx), sorted((doc['rankings']['score'], docid) for docid, doc in docs.items() if 'foo' in doc['tags']))
+
+    index.delete_document(3)
+    del docs[3]
+    for i in range(36, 48):
+      docs[index.insert_document(insert(i))] = insert(i)
+    self.assertEqual(index.segments['names'], ['', 'seg5', 'seg6'])
+    index.compact()
+    self.assertEqual(index.segments['names'], ['', 'seg7'])
+    self.assertEqual(conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'tokens_score_seg%'").fetchone()[0], 3)
+    check()
+    index.compact(full = True)
+    self.assertEqual(index.segments['names'], [''])
+    check()
+    self.assertEqual(conn.execute("SELECT COUNT(*) FROM tombstones").fetchone()[0], 0)
+
+    # Reopening the index restores its segments and tombstones.
+    index.delete_document(4)
+    del docs[4]
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache())
+    check()
+
+    compactor = spot.Compactor(index, max_segments = 2, interval = 0.01)
+    compactor.start()
+    for i in range(60, 120):
+      docs[index.insert_document(insert(i))] = insert(i)
+    while compactor.compactions == 0 and compactor.is_alive():
+      time.sleep(0.01)
+    compactor.stop()
+    self.assertGreater(compactor.compactions, 0)
+    check()
+
+    # A compaction that stops before metadata.json is written (e.g. a crash)
+    # leaves the segments and tombstones in the database in sync.
+    for i in range(120, 130):
+      docs[index.insert_document(insert(i))] = insert(i)
+    index.delete_document(5)
+    del docs[5]
+    # compact saves twice: before merging, and after swapping the segments.
+    saves = []
+    def crash():
+      saves.append(1)
+      if len(saves) == 2:
+        raise RuntimeError('crash')
+    index.save = crash
+    with self.assertRaises(RuntimeError):
+      index.compact(full = True)
+    index = spot.Index(conn, 'tmp')
+    self.assertEqual(index.segments['names'], [''])
+    check()
+
+  def test_concurrent_compaction(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'], segment_size = 5)
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache(), concurrent_reads = True)
+    docs = {}
+    def insert(i):
+      return { 'rankings': { 'score': i % 13 }, 'tags': ['foo'] if i % 2 == 0 else ['bar'] }
+    for i in range(50):
+      docs[index.insert_document(insert(i))] = insert(i)
+
+    # Readers query while documents are inserted, modified and deleted, and
+    # segments are compacted in the background.
+    compactor = spot.Compactor(index, max_segments = 1, interval = 0.02)
+    errors = []
+    stopped = threading.Event()
+    def read():
+      try:
+        while not stopped.is_set():
+          compactions = compactor.compactions
+          try:
+            hits = [(rank, docid) for rank, docid, _ in index.search(index.intersect('foo'), 'score', k = 20)]
+          except (KeyError, sqlite3.OperationalError):
+            # Nodes that outlive a compaction may use segments the next one
+            # drops (see compact).
+            if compactor.compactions == compactions:
+              raise
+            continue
+          self.assertEqual(hits, sorted(set(hits)))
+      except Exception as e:
+        errors.append(e)
+    readers = [threading.Thread(target = read) for _ in range(2)]
+    for reader in readers:
+      reader.start()
+    compactor.start()
+    try:
+      i = 50
+      while compactor.compactions < 5 and compactor.is_alive():
+        docs[index.insert_document(insert(i))] = insert(i)
+        docid = random.choice(list(docs))
+        if i % 3 == 0:
+          index.delete_document(docid)
+          del docs[docid]
+        else:
+          docs[docid] = insert(i)
+          index.modify_document(docid, docs[docid])
+        i += 1
+    finally:
+      compactor.stop()
+      stopped.set()
+      for reader in readers:
+        reader.join()
+    self.assertEqual(errors, [])
+    self.assertGreaterEqual(compactor.compactions, 5)
+
+    for tag in ['foo', 'bar']:
+      expected = sorted((doc['rankings']['score'], docid) for docid, doc in docs.items() if tag in doc['tags'])
+      self.assertEqual(spot.stream(index.intersect(tag), index.expression_context('score')), expected)
+    index.compact(full = True)
+    self.assertEqual(spot.stream(index.intersect('foo'), index.expression_context('score')), sorted(
+      (doc['rankings']['score'], docid) for docid, doc in docs.items() if 'foo' in doc['tags']
+    ))
+    index.read_pool.close()
+
+  def test_delete_document(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'], pair_counts = True)
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache())
+    docs = {}
+    for i in range(50):
+      doc = { 'rankings': { 'score': i % 10 }, 'tags': ['foo', 'bar'] if i % 2 == 0 else ['bar'], 'i': i }
+      docs[index.insert_document(doc)] = doc
+    docs[3]['tags'] = ['foo']
+    index.modify_document(3, docs[3])
+    docs[4]['rankings']['score'] = 9
+    index.modify_document(4, docs[4])
+
+    def check(tags):
+      expected = sorted((doc['rankings']['score'], docid) for docid, doc in docs.items() if all(tag in doc['tags'] for tag in tags))
+      self.assertEqual(spot.stream(index.intersect(*tags), index.expression_context('score')), expected)
+      if spot.vector_engine.np is not None:
+        self.assertEqual(spot.evaluate(index.intersect(*tags), index.expression_context('score')), expected)
+      self.assertEqual([(rank, docid) for rank, docid, _ in index.search(index.intersect(*tags), 'score', k = 5)], expected[:5])
+
+    numPostings = conn.execute("SELECT COUNT(*) FROM tokens_score").fetchone()[0]
+    for docid in [1, 3, 4, 50]:
+      index.delete_document(docid)
+      del docs[docid]
+    for tags in [['foo'], ['bar'], ['foo', 'bar']]:
+      check(tags)
+    self.assertIsNone(index.fetch(4))
+    self.assertEqual([doc and doc['i'] for doc in index.fetch_many([2, 3, 5], fields = ['i'])], [1, None, 4])
+    # Postings and counts are only cleaned up by vacuum_deleted.
+    self.assertEqual(conn.execute("SELECT COUNT(*) FROM tokens_score").fetchone()[0], numPostings)
+    self.assertEqual(index.token_search('bar'), [('bar', 49)])
+
+    self.assertEqual(index.vacuum_deleted(), 4)
+    self.assertEqual(index.vacuum_deleted(), 0)
+    self.assertEqual(conn.execute("SELECT COUNT(*) FROM tokens_score").fetchone()[0], numPostings - 9)
+    self.assertEqual(index.token_search('bar'), [('bar', 46)])
+    self.assertEqual(index.token_search('foo'), [('foo', 23)])
+    self.assertNotIsInstance(index.intersect('foo'), spot.nodes.SegmentNode)
+    ctx = index.expression_context('score')
+    self.assertEqual(ctx.pair_count(*[index.token_mapper(t, index.ctx) for t in ['foo', 'bar']]), 23)
+    for tags in [['foo'], ['bar'], ['foo', 'bar']]:
+      check(tags)
+
+    # Deleted docids aren't reused, even after reopening the index.
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache())
+    self.assertIsNone(index.fetch(50))
+    self.assertEqual(index.insert_document({ 'rankings': { 'score': 0 }, 'tags': ['foo'] }), 51)
+
+    # Unknown, deleted and vacuumed docids can't be deleted.
+    for docid in [52, 4, 50]:
+      with self.assertRaises(KeyError):
+        index.delete_document(docid)
+    self.assertEqual(index.insert_document({ 'rankings': { 'score': 0 }, 'tags': ['foo'], 'i': 52 }), 52)
+    self.assertEqual(index.fetch(52)['i'], 52)
+
+  def test_delete_segmented_document(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'], segment_size = 5)
+    index.insert_documents({ 'rankings': { 'score': i }, 'tags': ['foo'] } for i in range(3))
+    with self.assertRaises(KeyError):
+      index.delete_document(4)
+    index.delete_document(2)
+    self.assertEqual(index.insert_document({ 'rankings': { 'score': 0 }, 'tags': ['foo'] }), 4)
+    self.assertEqual(spot.stream(index.intersect('foo'), index.expression_context('score')), [(0, 1), (0, 4), (2, 3)])
+
+  def test_train_after_vacuum(self):
+    if spot.document_codec.zstandard is None:
+      return
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    index = spot.Index.create(conn, 'tmp', ['score'], codec = 'json+zstd')
+    docs = [{ 'rankings': { 'score': i }, 'tags': ['foo'], 'body': f"comment number {i} " * 20 } for i in range(50)]
+    index.insert_documents(docs)
+    index.delete_document(1)
+    index.vacuum_deleted()
+    index.train_codec_dictionary(size = 1024)
+    index = spot.Index(conn, 'tmp')
+    self.assertEqual(index.fetch_many(range(1, 51)), [None] + docs[1:])
+
+  def test_modify_documents(self):
+    for segment_size in [None, 20]:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      spot.Index.create(conn, 'tmp', ['score', 'age'], pair_counts = True, segment_size = segment_size)
+      index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache())
+      docs = {}
+      for i in range(60):
+        doc = { 'rankings': { 'score': i % 7, 'age': i }, 'tags': ['foo', 'bar'] if i % 3 == 0 else ['bar'] }
+        docs[index.insert_document(doc)] = doc
+      # Warm the posting cache.
+      spot.stream(index.intersect('foo'), index.expression_context('score'))
+
+      # Re-score every document, and retag some of them.
+      updates = {}
+      for docid, doc in docs.items():
+        doc = { 'rankings': { 'score': (docid * 5) % 11, 'age': doc['rankings']['age'] }, 'tags': doc['tags'] }
+        if docid % 4 == 0:
+          doc['tags'] = ['foo', 'baz']
+        updates[docid] = doc
+      index.modify_documents(updates.items(), batch_size = 25)
+      docs.update(updates)
+
+      for ranking in ['score', 'age']:
+        for tags in [['foo'], ['bar'], ['baz'], ['foo', 'bar']]:
+          expected = sorted((doc['rankings'][ranking], docid) for docid, doc in docs.items() if all(tag in doc['tags'] for tag in tags))
+          self.assertEqual(spot.stream(index.intersect(*tags), index.expression_context(ranking)), expected)
+          self.assertEqual([(rank, docid) for rank, docid, _ in index.search(index.intersect(*tags), ranking, k = 5)], expected[:5])
+      self.assertEqual(index.fetch(8), docs[8])
+      for tag in ['foo', 'bar', 'baz']:
+        self.assertEqual(index.token_search(tag), [(tag, sum(tag in doc['tags'] for doc in docs.values()))])
+      if segment_size is None:
+        # Every document has one posting per tag, plus one for "".
+        numPostings = sum(len(doc['tags']) + 1 for doc in docs.values())
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM tokens_score").fetchone()[0], numPostings)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM tokens_age").fetchone()[0], numPostings)
+
+      # Unknown and deleted documents can't be modified, and nothing in their
+      # batch is applied.
+      index.delete_document(3)
+      for docid in [3, 1000]:
+        with self.assertRaises(KeyError):
+          index.modify_documents([(5, { 'rankings': { 'score': 0, 'age': 0 }, 'tags': ['qux'] }), (docid, docs[5])])
+      self.assertEqual(index.fetch(5), docs[5])
+      self.assertEqual(index.token_search('qux'), [])
+
+  def test_result_cache(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    cache = spot.ResultCache()
+    index = spot.Index(conn, 'tmp', result_cache = cache)
+    index.add_range('depth', 0, 15)
+    docs = {}
+    for i in range(40):
+      doc = { 'rankings': { 'score': i % 9 }, 'tags': ['foo', 'bar'] if i % 2 == 0 else ['bar'], 'ranges': { 'depth': i % 16 } }
+      docs[index.insert_document(doc)] = doc
+
+    def check(tags, invert = None, ranking = 'score', k = 5, offset = 0):
+      matches = index.search(index.intersect(*tags, invert = invert, ranking = ranking), ranking, k, offset)
+      self.assertEqual(index.cached_search(tags, ranking, k, offset, invert = invert), matches)
+
+    queries = [
+      (['foo'], None),
+      (['bar', 'foo'], None),
+      (['bar', 'foo'], [False, True]),
+      (['bar', ('depth', '<', 4)], None),
+      ([('score', '>=', 3)], None),
+    ]
+    for tags, invert in queries:
+      check(tags, invert)
+      check(tags, invert, '-score', offset = 3)
+    self.assertEqual(cache.stats()['hits'], 0)
+    for tags, invert in queries:
+      check(tags, invert)
+    self.assertEqual(cache.stats()['hits'], 5)
+    # Equivalent queries share an entry.
+    index.cached_search(['foo', 'bar'], 'score', 5)
+    index.cached_search([('depth', '<=', 3.5), 'bar'], 'score', 5)
+    self.assertEqual(cache.stats()['hits'], 7)
+
+    # Writes only invalidate pages of queries whose tokens they touch.
+    entries = len(cache)
+    index.insert_document({ 'rankings': { 'score': 0 }, 'tags': ['baz'] })
+    self.assertEqual(len(cache), entries - 2)
+    docid = index.insert_document({ 'rankings': { 'score': 0 }, 'tags': ['foo'] })
+    index.modify_document(2, { 'rankings': { 'score': 0 }, 'tags': ['bar'] })
+    index.delete_document(1)
+    for tags, invert in queries:
+      check(tags, invert)
+      check(tags, invert, '-score', offset = 3)
+    self.assertIn(docid, [hit[1] for hit in index.cached_search(['foo'], 'score', 100)])
+    self.assertGreater(index.result_cache_stats()['hit_rate'], 0)
+    self.assertGreater(index.result_cache_stats()['bytes'], 0)
+
+    cache = spot.ResultCache(ttl = 0)
+    index = spot.Index(conn, 'tmp', result_cache = cache)
+    index.cached_search(['foo'], 'score', 5)
+    index.cached_search(['foo'], 'score', 5)
+    self.assertEqual(cache.stats()['hits'], 0)
+    self.assertEqual(cache.stats()['expirations'], 1)
+
+  def test_bench(self):
+    results = spot.bench.run(num_docs = 300, vocab_size = 200, tokens_per_doc = 5, num_queries = 5, batch_size = 100, max_depth = 15)
+    self.assertEqual(results['config']['num_docs'], 300)
+    self.assertEqual(results['config']['max_depth'], 15)
+    self.assertGreater(results['ingest']['docs_per_second'], 0)
+    self.assertGreater(results['index_bytes'], 0)
+    self.assertEqual(set(results['queries']), set(spot.bench.query_mix()))
+    for stats in list(results['queries'].values()) + list(results['fetch'].values()):
+      self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+    self.assertLessEqual(results['queries']['or']['mean_results'], 10)
+    # The corpus is reproducible.
+    self.assertEqual(list(spot.bench.zipf_corpus(20, seed = 1)), list(spot.bench.zipf_corpus(20, seed = 1)))
+
+  def test_explain(self):
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    index = spot.Index(conn, 'tmp', posting_cache = spot.PostingCache())
+    index.insert_documents({
+      'rankings': { 'score': i % 10 },
+      'tags': ['foo', 'bar'] if i % 3 == 0 else ['bar'],
+    } for i in range(100))
+
+    for expectCacheHits in [False, True]:
+      node = index.intersect('foo', 'bar', 'baz', invert = [False, False, True])
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        profiler = index.explain(node, 'score')
+      self.assertIn("AdaptiveTokenNode('foo')", output.getvalue())
+      self.assertIn("34 results", output.getvalue())
+      # The root is called once per result, plus once to find the end.
+      self.assertEqual(profiler.stats(node).calls, 35)
+      foo = [child for child in node.children if getattr(child, 'token', None) == index.token_mapper('foo', index.ctx)][0]
+      stats = profiler.stats(foo)
+      self.assertEqual(stats.rows, 34)
+      self.assertEqual(stats.cache_hits > 0, expectCacheHits)
+      self.assertEqual(stats.statements > 0, not expectCacheHits)
+
+    # Nodes and contexts that aren't profiled are left alone.
+    self.assertNotIn('next', vars(index.intersect('foo')))
+    profiler = spot.Profiler()
+    node = profiler.instrument(spot.nodes.OrNode([(index.intersect('foo'), False), (index.intersect('bar'), False)]))
+    self.assertEqual(spot.stream(node, profiler.context(index.expression_context('-score'))), spot.stream(index.intersect('bar'), index.expression_context('-score')))
+    self.assertEqual(profiler.stats(node).calls, 101)
+
+  def test_query(self):
+    for segment_size in [None, 10]:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      spot.Index.create(conn, 'tmp', ['score'], segment_size = segment_size)
+      index = spot.Index(conn, 'tmp')
+      index.add_range('depth', 0, 15)
+      index.save()
+      tags = ['foo', 'bar', 'baz', 'qux', 'author:x']
+      docs = {}
+      for i in range(60):
+        doc = { 'rankings': { 'score': i % 13 }, 'tags': [tag for j, tag in enumerate(tags) if (i >> j) & 1], 'ranges': { 'depth': i % 16 } }
+        docs[index.insert_document(doc)] = doc
+
+      queries = {
+        'foo': lambda doc: 'foo' in doc['tags'],
+        'foo (bar OR baz) -qux': lambda doc: 'foo' in doc['tags'] and ('bar' in doc['tags'] or 'baz' in doc['tags']) and 'qux' not in doc['tags'],
+        'foo  bar AND NOT author:x': lambda doc: 'foo' in doc['tags'] and 'bar' in doc['tags'] and 'author:x' not in doc['tags'],
+        'author:x OR -(foo OR bar)': lambda doc: 'author:x' in doc['tags'] or not ('foo' in doc['tags'] or 'bar' in doc['tags']),
+        'foo score:[3 TO 10]': lambda doc: 'foo' in doc['tags'] and 3 <= doc['rankings']['score'] <= 10,
+        'score:{3 TO 10} OR qux': lambda doc: 3 < doc['rankings']['score'] < 10 or 'qux' in doc['tags'],
+        '-score:>=4 bar': lambda doc: doc['rankings']['score'] < 4 and 'bar' in doc['tags'],
+        '-score:[2 TO 10]': lambda doc: not 2 <= doc['rankings']['score'] <= 10,
+        'bar depth:[* TO 5.5] -depth:<2': lambda doc: 'bar' in doc['tags'] and 2 <= doc['ranges']['depth'] <= 5,
+        'foo missing': lambda doc: False,
+        '-missing': lambda doc: True,
+        '"score:>3"': lambda doc: False,
+      }
+      for query, matches in queries.items():
+        for ranking in ['score', '-score']:
+          expected = sorted((doc['rankings']['score'], docid) for docid, doc in docs.items() if matches(doc))
+          if ranking == '-score':
+            expected = expected[::-1]
+          self.assertEqual(spot.stream(index.query(query, ranking), index.expression_context(ranking)), expected, query)
+
+      # Plans are cached, and rebuilt once their unknown tokens exist.
+      misses = index.plan_cache.misses
+      index.query('foo   (bar OR baz) -qux', 'score')
+      self.assertEqual(index.plan_cache.misses, misses)
+      docid = index.insert_document({ 'rankings': { 'score': 1 }, 'tags': ['foo', 'missing'] })
+      self.assertEqual(spot.stream(index.query('foo missing', 'score'), index.expression_context('score')), [(1, docid)])
+
+      # Plans are keyed on queries with whitespace collapsed outside quotes.
+      self.assertEqual(spot.query_parser.normalize(' foo \t "a  b"  bar '), 'foo "a  b" bar')
+      self.assertNotEqual(spot.query_parser.normalize('"a  b"'), spot.query_parser.normalize('"a b"'))
+
+    for query in ['', 'foo (bar', 'foo)', 'OR foo', '"foo']:
+      with self.assertRaises(ValueError):
+        index.query(query)
+    with self.assertRaises(ValueError):
+      index.query('foo age:>3')
+
+  def test_filter_cache(self):
+    class AuthorIndex(spot.Index):
+      def is_filter(self, token_str):
+        return token_str.startswith('author:')
+
+    for segment_size in [None, 15]:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      spot.Index.create(conn, 'tmp', ['score', 'age'], segment_size = segment_size)
+      cache = spot.FilterCache()
+      index = AuthorIndex(conn, 'tmp', filter_cache = cache)
+      docs = {}
+      def insert(i):
+        doc = { 'rankings': { 'score': i % 7, 'age': i }, 'tags': ['foo'] if i % 2 == 0 else ['bar'] }
+        doc['tags'].append(f"author:{i % 3}")
+        docs[index.insert_document(doc)] = doc
+      for i in range(40):
+        insert(i)
+
+      def check():
+        plain = spot.Index(conn, 'tmp')
+        for query in ['foo author:1', 'author:2 -foo', 'foo -author:0', 'author:1 author:2', '-author:1', 'author:0 (foo OR bar)']:
+          for ranking in ['score', '-age']:
+            expected = spot.stream(plain.query(query, ranking), plain.expression_context(ranking))
+            self.assertEqual(spot.stream(index.query(query, ranking), index.expression_context(ranking)), expected, query)
+        expected = spot.stream(plain.intersect('author:0', 'foo'), plain.expression_context('score'))
+        self.assertEqual(spot.stream(index.intersect('author:0', 'foo'), index.expression_context('score')), expected)
+      check()
+      self.assertGreater(cache.stats()['hits'], 0)
+      if segment_size is None:
+        # Filters in an And are only checked against the cached sets.
+        profiler = spot.Profiler()
+        node = profiler.instrument(spot.nodes.AndNode([
+          (spot.nodes.AdaptiveTokenNode(index.token_mapper('foo', index.ctx)), False),
+          (spot.nodes.FilterNode(index.token_mapper('author:1', index.ctx)), True),
+        ]))
+        self.assertEqual(len(spot.stream(node, profiler.context(index.expression_context('score')))), 14)
+        self.assertEqual(profiler.stats(node.children[1]).calls, 0)
+
+      # Writes update the cached sets.
+      for i in range(40, 60):
+        insert(i)
+      for docid in range(1, 60, 4):
+        docs[docid]['tags'] = [tag for tag in docs[docid]['tags'] if tag != 'author:1'] + ['author:2']
+        index.modify_document(docid, docs[docid])
+      index.insert_documents([{ 'rankings': { 'score': 3, 'age': 99 }, 'tags': ['foo', 'author:1'] }] * 3)
+      check()
+
+      if segment_size is None:
+        # Writes made through other connections drop the cached sets.
+        other = spot.Index(sqlite3.connect("tmp/db.sqlite"), 'tmp')
+        other.insert_document({ 'rankings': { 'score': 0, 'age': 100 }, 'tags': ['foo', 'author:1'] })
+        other.modify_document(1, { 'rankings': { 'score': 1, 'age': 0 }, 'tags': ['foo', 'author:0'] })
+        check()
+        hits = cache.stats()['hits']
+        check()
+        self.assertGreater(cache.stats()['hits'], hits)
+
+        # So do writes made by other Index objects on the same connection.
+        spot.Index(conn, 'tmp').modify_document(2, { 'rankings': { 'score': 2, 'age': 1 }, 'tags': ['foo', 'author:1'] })
+        check()
+
+  def test_filter_cache_writes(self):
+    class AuthorIndex(spot.Index):
+      def is_filter(self, token_str):
+        return token_str.startswith('author:')
+
+    # Filter sets built after a compaction ignore the retired segments.
+    if os.path.exists('tmp'):
+      shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'], segment_size = 10)
+    index = AuthorIndex(conn, 'tmp', filter_cache = spot.FilterCache())
+    index.insert_document({ 'rankings': { 'score': 1 }, 'tags': ['t', 'author:x'] })
+    index.insert_document({ 'rankings': { 'score': 2 }, 'tags': ['t'] })
+    index.compact()
+    index.modify_document(1, { 'rankings': { 'score': 1 }, 'tags': ['t', 'author:y'] })
+    ctx = index.expression_context('score')
+    self.assertEqual(spot.stream(index.intersect('t', 'author:x', invert = [False, True]), ctx), [(1, 1), (2, 2)])
+    self.assertEqual(spot.stream(index.intersect('t', 'author:y'), ctx), [(1, 1)])
+
+    # With concurrent reads, the index's own writes keep the cached sets.
+    shutil.rmtree('tmp')
+    os.mkdir('tmp')
+    conn = sqlite3.connect("tmp/db.sqlite")
+    spot.Index.create(conn, 'tmp', ['score'])
+    cache = spot.FilterCache()
+    index = AuthorIndex(conn, 'tmp', filter_cache = cache, concurrent_reads = True)
+    plain = spot.Index(conn, 'tmp', concurrent_reads = True)
+    for i in range(20):
+      index.insert_document({ 'rankings': { 'score': i }, 'tags': ['t', f"author:{i % 3}"] })
+      for query in ['t author:1', 't -author:2']:
+        expected = spot.stream(plain.query(query, 'score'), plain.expression_context('score'))
+        self.assertEqual(spot.stream(index.query(query, 'score'), index.expression_context('score')), expected)
+    self.assertGreater(cache.stats()['hits'], cache.stats()['misses'])
+    index.read_pool.close()
+    plain.read_pool.close()
+
+  def test_scored_search(self):
+    for segment_size in [None, 50]:
+      if os.path.exists('tmp'):
+        shutil.rmtree('tmp')
+      os.mkdir('tmp')
+      conn = sqlite3.connect("tmp/db.sqlite")
+      spot.Index.create(conn, 'tmp', ['score'], segment_size = segment_size, scored = True)
+      index = spot.Index(conn, 'tmp')
+      rng = random.Random(0)
+      vocab = [f"t{i}" for i in range(30)]
+      def make_doc():
+        tags = list(set(rng.choices(vocab, weights = [1 / (i + 1) for i in range(len(vocab))], k = 4)))
+        return {
+          'rankings': { 'score': 0 },
+          'tags': tags,
+          'weights': { tag: rng.choice([0.5, 1, 2, 3]) for tag in tags if rng.random() < 0.5 },
+          'prior': rng.choice([0, 0.25, 1]),
+        }
+      docids = index.insert_documents([make_doc() for _ in range(2000)])
+      docs = dict(zip(docids, index.fetch_many(docids)))
+      for docid in range(1, 2001, 7):
+        docs[docid] = make_doc()
+        index.modify_document(docid, docs[docid])
+      for docid in range(3, 2001, 11):
+        index.delete_document(docid)
+        del docs[docid]
+      index.vacuum_deleted()
+
+      def expected(tokens, k, prior_weight):
+        counts = { token: sum(token in doc['tags'] for doc in docs.values()) for token in tokens }
+        scores = []
+        for docid, doc in docs.items():
+          matches = [token for token in tokens if token in doc['tags']]
+          if len(matches) > 0:
+            score = sum(math.log(1 + (len(docs) - counts[t] + 0.5) / (counts[t] + 0.5)) * doc['weights'].get(t, 1) for t in matches)
+            scores.append((score + prior_weight * doc['prior'], docid))
+        scores.sort(key = lambda r: (-r[0], r[1]))
+        return scores[:k]
+
+      for tokens in [['t0'], ['t0', 't1', 't2'], ['t3', 't20', 't29', 't1', 't0'], ['t5', 'missing']]:
+        for k, prior_weight in [(1, 1.0), (10, 1.0), (25, 0.0), (3000, 2.0)]:
+          results = {
+            method: [(score, docid) for score, docid, _ in index.scored_search(tokens, k, prior_weight, method = method)]
+            for method in ['exhaustive', 'wand', 'block_max_wand']
+          }
+          self.assertEqual(results['wand'], results['exhaustive'])
+          self.assertEqual(results['block_max_wand'], results['exhaustive'])
+          E = expected(tokens, k, prior_weight)
+          self.assertEqual([docid for _, docid in results['exhaustive']], [docid for _, docid in E])
+          for (score, _), (e, _) in zip(results['exhaustive'], E):
+            self.assertAlmostEqual(score, e)
+      self.assertEqual(index.scored_search(['t0'], 1, fields = ['prior'])[0][2].keys(), {'prior'})
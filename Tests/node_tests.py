@@ -1,5 +1,9 @@
 from spot import *
+from spot import vector_engine
+from spot.nodes import NotNode, ListNode, TokenNode2, HeapOrNode
+from spot.docid_set import DocidSet
 
+import sqlite3
 import unittest
 
 class NodeTest(unittest.TestCase):
@@ -210,3 +214,194 @@ class NodeTest(unittest.TestCase):
         assert A == [d for d in range(50) if d % token == 0 or d % 3 == 0]
         assert A[1:] == B
 
+  def test_adaptive_token_node(self):
+    conn = sqlite3.connect(":memory:")
+    c = conn.cursor()
+    index = TokenIndex.create(c, 'foo')
+    for doc_id in range(1000):
+      for token in range(1, 10):
+        if doc_id % token == 0:
+          index.insert(c, rank=doc_id % 7, doc_id=doc_id, token=token)
+    # Token 10 is rare.
+    for doc_id in [3, 500, 997]:
+      index.insert(c, rank=doc_id % 7, doc_id=doc_id, token=10)
+
+    numQueries = [0]
+    docids = index.docids
+    def counting_docids(*args, **kwargs):
+      numQueries[0] += 1
+      return docids(*args, **kwargs)
+    index.docids = counting_docids
+
+    for pageLength in [1, 3, 100]:
+      for r in [1, 5]:
+        ctx = ExpressionContext(c = c, r = r, pageLength = pageLength, index = index)
+        for token in range(1, 10):
+          expected = sorted((d % 7, d) for d in range(1000) if d % token == 0)
+          t = AdaptiveTokenNode(token)
+          A = [ctx.first]
+          while A[-1] != ctx.last:
+            A.append(t.next(ctx, A[-1]))
+          self.assertEqual(A[1:-1], expected)
+
+          for negated in [False, True]:
+            a = AndNode([(AdaptiveTokenNode(token), False), (AdaptiveTokenNode(2), negated)])
+            A = [ctx.first]
+            while A[-1] != ctx.last:
+              A.append(a.next(ctx, A[-1]))
+            self.assertEqual(A[1:-1], [x for x in expected if (x[1] % 2 == 0) != negated])
+
+    # A rare-AND-common query shouldn't page through the common posting list.
+    ctx = ExpressionContext(c = c, r = 1, pageLength = 10, index = index)
+    a = AndNode([(AdaptiveTokenNode(10), False), (AdaptiveTokenNode(1), False)])
+    numQueries[0] = 0
+    A = [ctx.first]
+    while A[-1] != ctx.last:
+      A.append(a.next(ctx, A[-1]))
+    self.assertEqual(A[1:-1], sorted((d % 7, d) for d in [3, 500, 997]))
+    self.assertLess(numQueries[0], 20)
+
+  def test_and_node_plan(self):
+    conn = sqlite3.connect(":memory:")
+    c = conn.cursor()
+    index = TokenIndex.create(c, 'foo')
+    TokenMapper(c)
+    postings = { token: [d for d in range(1000) if d % token == 0] for token in range(1, 10) }
+    postings[10] = [6, 500, 996]
+    for token, docs in postings.items():
+      c.execute("INSERT INTO tokens (rowid, token_str, count) VALUES (?, ?, ?)", (token, f"t{token}", len(docs)))
+      for doc_id in docs:
+        index.insert(c, rank=doc_id % 7, doc_id=doc_id, token=token)
+
+    numQueries = [0]
+    docids = index.docids
+    def counting_docids(*args, **kwargs):
+      numQueries[0] += 1
+      return docids(*args, **kwargs)
+    index.docids = counting_docids
+
+    ctx = ExpressionContext(c = c, r = 1, pageLength = 10, index = index)
+    t1, t2, t3 = AdaptiveTokenNode(1), AdaptiveTokenNode(2), AdaptiveTokenNode(10)
+    a = AndNode([(t1, False), (t2, False), (AdaptiveTokenNode(4), True), (t3, False)])
+    A = [ctx.first]
+    while A[-1] != ctx.last:
+      A.append(a.next(ctx, A[-1]))
+    self.assertEqual(A[1:-1], [(6 % 7, 6)])
+    self.assertEqual(a.plan(ctx)[0], t3)
+    self.assertEqual(a.plan(ctx)[1], [t2, t1])
+    self.assertLess(numQueries[0], 15)
+
+    for n1 in range(1, 10):
+      for n2 in range(1, 10):
+        a = AndNode([(AdaptiveTokenNode(n1), False), (AdaptiveTokenNode(3), False), (AdaptiveTokenNode(n2), True)])
+        A = [ctx.first]
+        while A[-1] != ctx.last:
+          A.append(a.next(ctx, A[-1]))
+        self.assertEqual(A[1:-1], sorted((d % 7, d) for d in range(1000) if d % n1 == 0 and d % 3 == 0 and d % n2 != 0))
+
+  @unittest.skipIf(vector_engine.np is None, 'requires numpy')
+  def test_vector_engine(self):
+    conn = sqlite3.connect(":memory:")
+    c = conn.cursor()
+    index = TokenIndex.create(c, 'foo')
+    for doc_id in range(300):
+      index.insert(c, rank=doc_id % 11, doc_id=doc_id, token=0)
+      for token in range(1, 10):
+        if doc_id % token == 0:
+          index.insert(c, rank=doc_id % 11, doc_id=doc_id, token=token)
+
+    ctx = ExpressionContext(c = c, r = 1, pageLength = 10, index = index)
+    trees = [
+      lambda: AdaptiveTokenNode(3),
+      lambda: AndNode([(AdaptiveTokenNode(2), False), (AdaptiveTokenNode(3), False)]),
+      lambda: AndNode([(AdaptiveTokenNode(2), False), (AdaptiveTokenNode(3), True)]),
+      lambda: NotNode(5),
+      lambda: OrNode([(AdaptiveTokenNode(4), False), (AdaptiveTokenNode(6), False), (AdaptiveTokenNode(9), False)]),
+      lambda: AndNode([
+        (OrNode([(AdaptiveTokenNode(5), False), (AdaptiveTokenNode(7), False)]), False),
+        (ListNode(sorted((d % 11, d) for d in range(0, 300, 2))), False),
+        (EmptyNode(), True),
+      ]),
+      lambda: AndNode([(AdaptiveTokenNode(2), False), (EmptyNode(), False)]),
+    ]
+    for tree in trees:
+      expected = stream(tree(), ctx)
+      self.assertEqual(evaluate(tree(), ctx), expected)
+      # Falls back to streaming.
+      self.assertEqual(evaluate(tree(), ctx, max_postings = 5), expected)
+
+    ctx = ExpressionContext(c = c, r = 1, pageLength = 10, index = index, first = (3, 100))
+    self.assertEqual(evaluate(AdaptiveTokenNode(4), ctx), stream(AdaptiveTokenNode(4), ctx))
+    self.assertEqual(evaluate(AdaptiveTokenNode(4), ctx)[0], (3, 124))
+
+  def test_descending(self):
+    conn = sqlite3.connect(":memory:")
+    c = conn.cursor()
+    index = TokenIndex.create(c, 'foo')
+    for doc_id in range(200):
+      index.insert(c, rank=doc_id % 11, doc_id=doc_id, token=0)
+      for token in range(1, 10):
+        if doc_id % token == 0:
+          index.insert(c, rank=doc_id % 11, doc_id=doc_id, token=token)
+
+    for node in [TokenNode, TokenNode2, AdaptiveTokenNode]:
+      trees = [
+        lambda: node(3),
+        lambda: AndNode([(node(2), False), (node(3), False)]),
+        lambda: AndNode([(node(2), False), (node(3), True)]),
+        lambda: NotNode(5),
+        lambda: OrNode([(node(4), False), (node(6), False), (node(9), False)]),
+        lambda: AndNode([(node(5), False), (ListNode(sorted((d % 11, d) for d in range(0, 200, 2))), False)]),
+      ]
+      for pageLength in [1, 3, 100]:
+        ascending = ExpressionContext(c = c, r = 1, pageLength = pageLength, index = index)
+        descending = ExpressionContext(c = c, r = 1, pageLength = pageLength, index = index, descending = True)
+        for tree in trees:
+          expected = stream(tree(), ascending)[::-1]
+          self.assertEqual(stream(tree(), descending), expected)
+          if vector_engine.np is not None:
+            self.assertEqual(evaluate(tree(), descending), expected)
+
+  def test_heap_or_node(self):
+    conn = sqlite3.connect(":memory:")
+    c = conn.cursor()
+    index = TokenIndex.create(c, 'foo')
+    for doc_id in range(300):
+      for token in range(1, 20):
+        if doc_id % token == 0 or doc_id % 17 == token:
+          index.insert(c, rank=doc_id % 7, doc_id=doc_id, token=token)
+
+    for descending in [False, True]:
+      for pageLength in [1, 4, 100]:
+        ctx = ExpressionContext(c = c, r = 1, pageLength = pageLength, index = index, descending = descending)
+        for tokens in [[1, 2], [3, 5, 7], list(range(4, 20)), [18, 19]]:
+          expected = stream(OrNode([(AdaptiveTokenNode(t), False) for t in tokens]), ctx)
+          self.assertEqual(stream(HeapOrNode([(AdaptiveTokenNode(t), False) for t in tokens]), ctx), expected)
+
+          # x may also move backwards.
+          node = HeapOrNode([(AdaptiveTokenNode(t), False) for t in tokens])
+          node.next(ctx, expected[len(expected) // 2])
+          self.assertEqual(stream(node, ctx), expected)
+
+          a = AndNode([(HeapOrNode([(AdaptiveTokenNode(t), False) for t in tokens]), False), (AdaptiveTokenNode(3), True)])
+          self.assertEqual(stream(a, ctx), [x for x in expected if x[1] % 3 != 0 and x[1] % 17 != 3])
+
+  def test_docid_set(self):
+    A = DocidSet([5, 70000, 3, 5])
+    self.assertEqual(len(A), 3)
+    self.assertEqual(list(A), [3, 5, 70000])
+    self.assertIn(70000, A)
+    self.assertNotIn(4, A)
+
+    # Dense containers switch to bitmaps (and back).
+    A.update(range(100000, 110000, 2))
+    self.assertEqual(len(A), 5003)
+    self.assertEqual(A.nbytes(), 2 * 2 + 8192)
+    self.assertIn(100002, A)
+    self.assertNotIn(100003, A)
+    for x in range(100000, 102000, 2):
+      A.discard(x)
+    A.discard(100001)
+    self.assertEqual(len(A), 4003)
+    self.assertEqual(A.nbytes(), 2 * 2 + 2 * 4001)
+    self.assertEqual(list(A)[:4], [3, 5, 70000, 102000])
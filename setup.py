@@ -9,5 +9,10 @@ setup(
     author='Morgan Redding',
     description='Python package for token-based retrieval',
     install_requires=[],
+    extras_require={
+        'numpy': ['numpy'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+    },
     include_package_data=True
 )
\ No newline at end of file
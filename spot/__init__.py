@@ -1 +1,8 @@
 from spot.retrieval import *
+from spot.vector_engine import evaluate, stream
+from spot.async_index import AsyncIndex
+from spot.sharded_index import ShardedIndex
+from spot.compactor import Compactor
+from spot.nodes import OrNode
+from spot.token_dictionary import TokenDictionary
+from spot.token_mapper import kIntRangePrefix, is_valid_token
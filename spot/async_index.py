@@ -0,0 +1,107 @@
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .nodes import node_key
+
+
+class AsyncIndex:
+  """
+  Wraps an Index for use from asyncio code. Node evaluation and document
+  fetches run on a bounded pool of worker threads, so they never block the
+  event loop, and concurrent identical calls (e.g. the same search made by
+  many clients at once) share a single evaluation.
+
+  The Index must have been opened with concurrent_reads=True. Results of
+  coalesced calls are shared by every caller, so they must not be modified,
+  and a node must not be used by two calls at once (intersect returns a new
+  node per call). Writes should still be made through the Index, from a single thread.
+  """
+  def __init__(self, index, max_workers : int = 4):
+    assert index.read_pool is not None, 'AsyncIndex needs an Index opened with concurrent_reads=True'
+    self.index = index
+    self.coalesced = 0
+    self._executor = ThreadPoolExecutor(max_workers)
+    self._inflight = {}
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    await self.aclose()
+
+  async def aclose(self):
+    """
+    Shuts down the worker threads, waiting for calls in flight to finish on
+    another thread, so the event loop isn't blocked.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, self._executor.shutdown)
+
+  def close(self):
+    # Blocks until calls in flight finish, so use aclose from a running event loop.
+    self._executor.shutdown()
+
+  async def _run(self, key, fn, *args, **kwargs):
+    future = self._inflight.get(key)
+    if future is not None:
+      self.coalesced += 1
+    else:
+      loop = asyncio.get_running_loop()
+      future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+      self._inflight[key] = future
+      future.add_done_callback(lambda _: self._inflight.pop(key, None))
+    # Cancelling one caller mustn't cancel the evaluation the others await.
+    return await asyncio.shield(future)
+
+  async def intersect(self, *tags, **kwargs):
+    # Nodes are stateful, so every caller gets its own.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._executor, functools.partial(self.index.intersect, *tags, **kwargs))
+
+  async def search(self, expr, ranking : str, k : int, offset : int = 0, descending : bool = False, fields : [str] = None):
+    """
+    Same as Index.search.
+    """
+    key = ('search', node_key(expr), ranking, k, offset, descending, None if fields is None else tuple(fields))
+    return await self._run(key, self.index.search, expr, ranking, k, offset, descending, fields)
+
+  async def fetch(self, docid : int):
+    return await self._run(('fetch', docid), self.index.fetch, docid)
+
+  async def fetch_many(self, docids : [int], fields : [str] = None):
+    """
+    Same as Index.fetch_many.
+    """
+    docids = tuple(docids)
+    key = ('fetch_many', docids, None if fields is None else tuple(fields))
+    return await self._run(key, self.index.fetch_many, docids, fields)
+
+  async def iterate(self, expr, ranking : str, descending : bool = False, fields : [str] = None, page_size : int = 100):
+    """
+    Yields the (rank, docid, document) tuples of every match of expr, in the
+    same order as Index.search. Matches are found (and their documents
+    fetched) page_size at a time, so the node tree is only advanced as far
+    as the caller reads:
+
+      async for rank, docid, doc in aindex.iterate(node, 'score'):
+        ...
+    """
+    assert page_size > 0
+    loop = asyncio.get_running_loop()
+    x = None
+    while True:
+      x, results = await loop.run_in_executor(self._executor, self._page, expr, ranking, descending, fields, page_size, x)
+      for result in results:
+        yield result
+      if x is None:
+        break
+
+  def _page(self, expr, ranking, descending, fields, page_size, x):
+    # Returns the position to continue from (None once expr is exhausted) and
+    # the next page of results. Each page gets its own context, since it may
+    # run on a different thread (and so a different connection) than the last.
+    hits, x = self.index._traverse(expr, self.index.expression_context(ranking, descending), page_size, x = x)
+    docs = self.index.fetch_many((docid for _, docid in hits), fields)
+    return x, [(rank, docid, doc) for (rank, docid), doc in zip(hits, docs)]
@@ -0,0 +1,208 @@
+"""
+A reproducible benchmark of an Index on a synthetic corpus, whose tokens are
+Zipf-distributed (like the words of real text). It measures the ingestion
+rate, the size of the index, the latency of each type of query and the
+latency of fetching documents, and reports them as JSON, so that releases
+can be compared:
+
+$ PYTHONPATH=. python3 -m spot.bench --docs 100000 --output bench.json
+
+Every number is deterministic given the arguments, except for the timings.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from .retrieval import Index
+from .nodes import OrNode
+from .posting_cache import PostingCache
+
+
+def zipf_corpus(num_docs : int, vocab_size : int = 10000, tokens_per_doc : int = 20, exponent : float = 1.0, max_depth : int = 1023, seed : int = 0):
+  """
+  Yields num_docs documents, each with up to tokens_per_doc distinct tags
+  drawn from a Zipf distribution over vocab_size tokens ("t0" is the most
+  common), two rankings ("score" and "age") and a "depth" range.
+  """
+  rng = random.Random(seed)
+  cumWeights = list(itertools.accumulate(1 / (i + 1) ** exponent for i in range(vocab_size)))
+  population = range(vocab_size)
+  for i in range(num_docs):
+    yield {
+      'rankings': { 'score': rng.randint(0, 1000), 'age': i },
+      'tags': list(dict.fromkeys(f"t{t}" for t in rng.choices(population, cum_weights = cumWeights, k = tokens_per_doc))),
+      'ranges': { 'depth': rng.randint(0, max_depth) },
+    }
+
+
+def percentile(values : [float], p : float):
+  # Nearest-rank percentile of a non-empty list.
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def _token(rng : random.Random, low : int, high : int):
+  return f"t{rng.randint(low, high)}"
+
+
+def query_mix(vocab_size : int = 10000, max_depth : int = 1023):
+  """
+  Returns a {query type: make_query(rng) -> (tags, invert)} dict of the query
+  types benchmarked, whose arguments are passed to Index.intersect ("or"
+  queries return a list of tags, which are OR-ed).
+  """
+  # Common tokens are among the 100 most frequent, rare ones are not.
+  common = lambda rng: _token(rng, 0, min(99, vocab_size - 1))
+  rare = lambda rng: _token(rng, min(100, vocab_size - 1), vocab_size - 1)
+  return {
+    'single': lambda rng: ([common(rng)], None),
+    'and': lambda rng: ([common(rng), common(rng)], None),
+    'and_rare': lambda rng: ([rare(rng), common(rng)], None),
+    'or': lambda rng: ([common(rng) for _ in range(4)], None),
+    'not': lambda rng: ([common(rng), common(rng)], [False, True]),
+    'range': lambda rng: ([common(rng), ('depth', '<', rng.randint(0, max_depth))], None),
+    'rank_range': lambda rng: ([common(rng), ('score', '>=', rng.randint(0, 1000))], None),
+  }
+
+
+def _search(index : Index, query_type : str, tags : list, invert : list, k : int):
+  if query_type == 'or':
+    node = OrNode([(index.intersect(tag), False) for tag in tags])
+  else:
+    node = index.intersect(*tags, invert = invert, ranking = 'score')
+  return index.search(node, 'score', k)
+
+
+def _directory_size(path : str):
+  return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def run(num_docs : int = 100000, vocab_size : int = 10000, tokens_per_doc : int = 20, exponent : float = 1.0, num_queries : int = 200, k : int = 10, batch_size : int = 10000, max_depth : int = 1023, posting_cache : bool = False, seed : int = 0, path : str = None):
+  """
+  Builds an index of zipf_corpus(...) in path (a temporary directory by
+  default, which is deleted afterwards), runs num_queries queries of every
+  type in query_mix and returns the results as a dict. Latencies are in
+  milliseconds. The posting cache is disabled unless posting_cache is True,
+  so that queries measure reads from SQLite.
+  """
+  config = {
+    'num_docs': num_docs,
+    'vocab_size': vocab_size,
+    'tokens_per_doc': tokens_per_doc,
+    'exponent': exponent,
+    'num_queries': num_queries,
+    'k': k,
+    'batch_size': batch_size,
+    'max_depth': max_depth,
+    'posting_cache': posting_cache,
+    'seed': seed,
+  }
+  tmp = path is None
+  if tmp:
+    path = tempfile.mkdtemp()
+  try:
+    conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+    Index.create(conn, path, ['score', 'age'])
+    index = Index(conn, path, posting_cache = PostingCache() if posting_cache else None)
+    index.add_range('depth', 0, max_depth)
+    index.save()
+
+    start_time = time.perf_counter()
+    index.insert_documents(zipf_corpus(num_docs, vocab_size, tokens_per_doc, exponent, max_depth, seed = seed), batch_size = batch_size)
+    ingestSeconds = time.perf_counter() - start_time
+
+    queries = {}
+    for query_type, make_query in query_mix(vocab_size, max_depth).items():
+      rng = random.Random(f"{seed}-{query_type}")
+      latencies, numResults = [], 0
+      for _ in range(num_queries):
+        tags, invert = make_query(rng)
+        start_time = time.perf_counter()
+        numResults += len(_search(index, query_type, tags, invert, k))
+        latencies.append((time.perf_counter() - start_time) * 1000)
+      queries[query_type] = {
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'mean_results': numResults / num_queries,
+      }
+
+    rng = random.Random(f"{seed}-fetch")
+    fetches = { 'fetch': [], 'fetch_many': [] }
+    for _ in range(num_queries):
+      docid = rng.randint(1, num_docs)
+      start_time = time.perf_counter()
+      index.fetch(docid)
+      fetches['fetch'].append((time.perf_counter() - start_time) * 1000)
+      docids = [rng.randint(1, num_docs) for _ in range(k)]
+      start_time = time.perf_counter()
+      index.fetch_many(docids)
+      fetches['fetch_many'].append((time.perf_counter() - start_time) * 1000)
+    conn.close()
+
+    return {
+      'config': config,
+      'environment': {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+      },
+      'ingest': {
+        'seconds': ingestSeconds,
+        'docs_per_second': num_docs / ingestSeconds,
+      },
+      'index_bytes': _directory_size(path),
+      'queries': queries,
+      'fetch': {
+        name: { 'p50_ms': percentile(latencies, 50), 'p99_ms': percentile(latencies, 99) }
+        for name, latencies in fetches.items()
+      },
+    }
+  finally:
+    if tmp:
+      shutil.rmtree(path)
+
+
+def main(argv : [str] = None):
+  parser = argparse.ArgumentParser(description = 'Benchmarks spot on a synthetic Zipfian corpus.')
+  parser.add_argument('--docs', type = int, default = 100000, help = 'number of documents')
+  parser.add_argument('--vocab', type = int, default = 10000, help = 'number of distinct tokens')
+  parser.add_argument('--tokens-per-doc', type = int, default = 20)
+  parser.add_argument('--exponent', type = float, default = 1.0, help = 'exponent of the Zipf distribution')
+  parser.add_argument('--queries', type = int, default = 200, help = 'number of queries of each type')
+  parser.add_argument('--k', type = int, default = 10, help = 'number of results per query')
+  parser.add_argument('--batch-size', type = int, default = 10000, help = 'batch size of insert_documents')
+  parser.add_argument('--max-depth', type = int, default = 1023, help = 'largest value of the "depth" range')
+  parser.add_argument('--posting-cache', action = 'store_true', help = 'enable the posting cache')
+  parser.add_argument('--seed', type = int, default = 0)
+  parser.add_argument('--output', help = 'file to write the JSON results to (default: stdout)')
+  args = parser.parse_args(argv)
+
+  results = run(
+    num_docs = args.docs,
+    vocab_size = args.vocab,
+    tokens_per_doc = args.tokens_per_doc,
+    exponent = args.exponent,
+    num_queries = args.queries,
+    k = args.k,
+    batch_size = args.batch_size,
+    max_depth = args.max_depth,
+    posting_cache = args.posting_cache,
+    seed = args.seed,
+  )
+  if args.output is None:
+    print(json.dumps(results, indent=2))
+  else:
+    with open(args.output, 'w+') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
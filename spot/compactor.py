@@ -0,0 +1,41 @@
+import sqlite3
+import threading
+
+from .connection_pool import database_file
+
+
+class Compactor(threading.Thread):
+  """
+  Compacts a segmented index (see Index.compact) in a background thread, on
+  its own connection, whenever it has more than max_segments segments
+  besides the base segment. The index should be in WAL mode (see
+  concurrent_reads), so compaction doesn't block queries.
+
+    compactor = Compactor(index)
+    compactor.start()
+    ...
+    compactor.stop()
+  """
+  def __init__(self, index, max_segments : int = 4, interval : float = 1.0):
+    super().__init__(daemon = True)
+    assert index.segments is not None, 'Compactor needs a segmented index'
+    self.index = index
+    self.max_segments = max_segments
+    self.interval = interval
+    self.compactions = 0
+    self._database = database_file(index.conn)
+    self._stopped = threading.Event()
+
+  def run(self):
+    conn = sqlite3.connect(self._database, timeout = 60)
+    try:
+      while not self._stopped.wait(self.interval):
+        if len(self.index.segments['names']) - 1 > self.max_segments:
+          self.index.compact(conn = conn)
+          self.compactions += 1
+    finally:
+      conn.close()
+
+  def stop(self):
+    self._stopped.set()
+    self.join()
@@ -0,0 +1,62 @@
+import pathlib
+import sqlite3
+import threading
+
+
+def database_file(conn : sqlite3.Connection):
+  """
+  Returns the path of the file conn's main database lives in ('' if it is an
+  in-memory or temporary database).
+  """
+  for _, name, path in conn.execute("PRAGMA database_list"):
+    if name == 'main':
+      return path or ''
+  return ''
+
+
+class ConnectionPool:
+  """
+  Gives every thread its own read-only connection to a SQLite database, so
+  queries can run on many threads at once. The database should be in WAL
+  mode, so readers don't block (and aren't blocked by) the writer.
+
+  Connections are opened with check_same_thread=False only so that the
+  connections of threads that have exited can be closed by other threads;
+  each connection is only ever used by the thread that opened it.
+  """
+  def __init__(self, database : str):
+    assert database != '', 'ConnectionPool needs a database file'
+    self.database = database
+    self._uri = pathlib.Path(database).resolve().as_uri() + '?mode=ro'
+    self._local = threading.local()
+    self._connections = []
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._connections)
+
+  def connection(self):
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self._uri, uri = True, check_same_thread = False)
+      self._local.conn = conn
+      with self._lock:
+        alive = []
+        for thread, c in self._connections:
+          if thread.is_alive():
+            alive.append((thread, c))
+          else:
+            c.close()
+        alive.append((threading.current_thread(), conn))
+        self._connections = alive
+    return conn
+
+  def cursor(self):
+    return self.connection().cursor()
+
+  def close(self):
+    with self._lock:
+      for _, conn in self._connections:
+        conn.close()
+      self._connections = []
+    self._local = threading.local()
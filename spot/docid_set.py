@@ -0,0 +1,115 @@
+from array import array
+from bisect import bisect_left
+
+# Containers with more integers than this are stored as bitmaps.
+kMaxArrayLength = 4096
+
+
+def _to_bitmap(values : array):
+  bitmap = bytearray(8192)
+  for low in values:
+    bitmap[low >> 3] |= 1 << (low & 7)
+  return bitmap
+
+
+def _to_array(bitmap : bytearray):
+  values = array('H')
+  for byte, bits in enumerate(bitmap):
+    while bits:
+      bit = bits & -bits
+      values.append((byte << 3) | (bit.bit_length() - 1))
+      bits ^= bit
+  return values
+
+
+class DocidSet:
+  """
+  A compact set of non-negative integers (e.g. docids), in the style of a
+  Roaring bitmap: integers are grouped by their high 16 bits, and each group
+  is stored as a sorted array of its low 16 bits (2 bytes per integer) or,
+  once it has more than kMaxArrayLength integers, as a 65536-bit bitmap.
+  Membership checks take O(1) time for bitmaps and O(log n) for arrays.
+  """
+  def __init__(self, values = ()):
+    self._containers = {}
+    # The number of integers in each container.
+    self._sizes = {}
+    self._len = 0
+    self.update(values)
+
+  def __len__(self):
+    return self._len
+
+  def __contains__(self, x : int):
+    container = self._containers.get(x >> 16)
+    if container is None:
+      return False
+    low = x & 0xFFFF
+    if type(container) is bytearray:
+      return (container[low >> 3] >> (low & 7)) & 1 == 1
+    i = bisect_left(container, low)
+    return i < len(container) and container[i] == low
+
+  def __iter__(self):
+    for high in sorted(self._containers):
+      container = self._containers[high]
+      if type(container) is bytearray:
+        container = _to_array(container)
+      for low in container:
+        yield (high << 16) | low
+
+  def add(self, x : int):
+    assert x >= 0
+    high, low = x >> 16, x & 0xFFFF
+    container = self._containers.get(high)
+    if container is None:
+      container = array('H')
+      self._containers[high] = container
+      self._sizes[high] = 0
+    if type(container) is bytearray:
+      bit = 1 << (low & 7)
+      if container[low >> 3] & bit:
+        return
+      container[low >> 3] |= bit
+    else:
+      i = bisect_left(container, low)
+      if i < len(container) and container[i] == low:
+        return
+      container.insert(i, low)
+      if len(container) > kMaxArrayLength:
+        self._containers[high] = _to_bitmap(container)
+    self._sizes[high] += 1
+    self._len += 1
+
+  def update(self, values):
+    for x in values:
+      self.add(x)
+
+  def discard(self, x : int):
+    high, low = x >> 16, x & 0xFFFF
+    container = self._containers.get(high)
+    if container is None:
+      return
+    if type(container) is bytearray:
+      bit = 1 << (low & 7)
+      if not container[low >> 3] & bit:
+        return
+      container[low >> 3] ^= bit
+      if self._sizes[high] - 1 <= kMaxArrayLength:
+        self._containers[high] = _to_array(container)
+    else:
+      i = bisect_left(container, low)
+      if i == len(container) or container[i] != low:
+        return
+      del container[i]
+    self._sizes[high] -= 1
+    self._len -= 1
+    if self._sizes[high] == 0:
+      del self._containers[high]
+      del self._sizes[high]
+
+  def nbytes(self):
+    """
+    The number of bytes used by the containers.
+    """
+    return sum(len(c) if type(c) is bytearray else c.itemsize * len(c) for c in self._containers.values())
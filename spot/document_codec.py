@@ -0,0 +1,94 @@
+"""
+Codecs for the documents table. A codec is described by a string such as
+"json", "marshal+zlib" or "msgpack+zstd": a serialization format, optionally
+followed by a compression algorithm. msgpack and zstd need the msgpack and
+zstandard packages.
+"""
+
+import json
+import marshal
+import zlib
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+kFormats = ['json', 'marshal', 'msgpack']
+kCompressions = ['zlib', 'zstd']
+
+
+class DocumentCodec:
+  def __init__(self, spec : str = 'json', level : int = None, dictionary : bytes = None):
+    parts = spec.split('+')
+    assert len(parts) <= 2, f"Invalid codec \"{spec}\""
+    self.spec = spec
+    self.format = parts[0]
+    self.compression = parts[1] if len(parts) == 2 else None
+    self.level = level
+    self.dictionary = dictionary
+    assert self.format in kFormats, f"Unknown document format \"{self.format}\""
+    assert self.compression in kCompressions + [None], f"Unknown compression \"{self.compression}\""
+    assert dictionary is None or self.compression == 'zstd', "Only zstd supports dictionaries"
+
+    if self.format == 'json':
+      self._serialize = json.dumps
+      self._deserialize = json.loads
+    elif self.format == 'marshal':
+      self._serialize = marshal.dumps
+      self._deserialize = marshal.loads
+    else:
+      if msgpack is None:
+        raise ImportError('the msgpack codec requires the msgpack package')
+      self._serialize = msgpack.packb
+      self._deserialize = msgpack.unpackb
+
+    if self.compression == 'zstd':
+      if zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package')
+      params = {}
+      if dictionary is not None:
+        params['dict_data'] = zstandard.ZstdCompressionDict(dictionary)
+      self._compressor = zstandard.ZstdCompressor(level = 3 if level is None else level, **params)
+      self._decompressor = zstandard.ZstdDecompressor(**params)
+
+  def encode(self, doc : dict):
+    data = self._serialize(doc)
+    if self.compression is None:
+      return data
+    if isinstance(data, str):
+      data = data.encode()
+    if self.compression == 'zlib':
+      return zlib.compress(data, -1 if self.level is None else self.level)
+    return self._compressor.compress(data)
+
+  def decode(self, data):
+    if self.compression == 'zlib':
+      data = zlib.decompress(data)
+    elif self.compression == 'zstd':
+      data = self._decompressor.decompress(data)
+    return self._deserialize(data)
+
+  def json(self):
+    return {
+      'spec': self.spec,
+      'level': self.level,
+      'dictionary': self.dictionary is not None,
+    }
+
+  @staticmethod
+  def train_dictionary(samples : [dict], spec : str, size : int = 64 * 1024):
+    """
+    Returns a zstd dictionary trained on the serialized samples.
+    """
+    if zstandard is None:
+      raise ImportError('zstd compression requires the zstandard package')
+    serialize = DocumentCodec(spec.split('+')[0])._serialize
+    samples = [serialize(doc) for doc in samples]
+    samples = [s.encode() if isinstance(s, str) else s for s in samples]
+    return zstandard.train_dictionary(size, samples).as_bytes()
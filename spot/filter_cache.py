@@ -0,0 +1,119 @@
+import threading
+
+from collections import OrderedDict
+
+# Rough size of a cache entry, excluding its DocidSet's containers.
+kEntryOverhead = 200
+
+
+def _entry_size(docids):
+  return kEntryOverhead + docids.nbytes()
+
+
+class FilterCache:
+  """
+  A thread-safe LRU cache of the sets of docids (DocidSets) that contain
+  filter tokens (see FilterNode), bounded by the number of bytes the sets
+  use. Sets don't depend on the ranking, so one set serves every ranking.
+
+  Keys are (namespace, token) tuples, where namespace identifies the index.
+  Rather than being invalidated, cached sets are updated by writers (with
+  add and discard, after committing). As with PostingCache, readers should
+  read generation() before reading a set from the database and pass it to
+  put, which drops sets read before the latest update.
+  """
+  def __init__(self, max_bytes : int = 64 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.nbytes = 0
+    self._generation = 0
+    self._entries = OrderedDict()
+    self._sizes = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    with self._lock:
+      docids = self._entries.get(key)
+      if docids is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return docids
+
+  def generation(self):
+    return self._generation
+
+  def put(self, key, docids, generation : int = None):
+    size = _entry_size(docids)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = docids
+      self._sizes[key] = size
+      self.nbytes += size
+      self._evict()
+
+  def add(self, namespace, token : int, docid : int):
+    # Records that a document now contains token.
+    self._update(namespace, token, docid, True)
+
+  def discard(self, namespace, token : int, docid : int):
+    # Records that a document no longer contains token.
+    self._update(namespace, token, docid, False)
+
+  def _update(self, namespace, token, docid, add):
+    key = (namespace, token)
+    with self._lock:
+      self._generation += 1
+      docids = self._entries.get(key)
+      if docids is None:
+        return
+      if add:
+        docids.add(docid)
+      else:
+        docids.discard(docid)
+      size = _entry_size(docids)
+      self.nbytes += size - self._sizes[key]
+      self._sizes[key] = size
+      self._evict()
+
+  def invalidate_namespace(self, namespace):
+    with self._lock:
+      self._generation += 1
+      for key in [key for key in self._entries if key[0] == namespace]:
+        self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+      self._sizes.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'entries': len(self._entries),
+      'bytes': self.nbytes,
+    }
+
+  def _evict(self):
+    while self.nbytes > self.max_bytes:
+      self._remove(next(iter(self._entries)))
+      self.evictions += 1
+
+  def _remove(self, key):
+    del self._entries[key]
+    self.nbytes -= self._sizes.pop(key)
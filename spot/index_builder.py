@@ -0,0 +1,119 @@
+import heapq
+import os
+import struct
+import tempfile
+
+from .token_index import TokenIndex
+
+# Rough in-memory size of one buffered (token, rank, doc_id) tuple.
+kBytesPerPosting = 160
+
+# On-disk format of one posting in a sorted run: (token, rank, doc_id).
+kPostingFormat = struct.Struct('<qdq')
+
+
+class IndexBuilder:
+  """
+  Builds the tokens_<ranking> tables of an Index offline.
+
+  Postings are buffered in memory and, whenever the buffer exceeds
+  memory_budget bytes, sorted by (token, rank, doc_id) and spilled to a
+  temporary file. finish() merges the spilled runs (and any postings already
+  in the index) and writes each table in primary key order into a fresh
+  WITHOUT ROWID table, so every posting costs one sequential write.
+
+  Documents and token counts are written as documents are inserted, but
+  postings are only visible to queries after finish() is called.
+  """
+  def __init__(self, index, memory_budget : int = 256 * 1024 * 1024, batch_size : int = 10000, tmpdir : str = None):
+    assert memory_budget > 0
+    assert index.segments is None, 'IndexBuilder does not support segmented indices'
+    self.index = index
+    self.memory_budget = memory_budget
+    self.batch_size = batch_size
+    self.tmpdir = tmpdir
+    self._buffers = { ti.name: [] for ti in index.token_indices }
+    self._bufferSize = 0
+    self._runs = { ti.name: [] for ti in index.token_indices }
+
+  def insert_document(self, doc : dict):
+    return self.insert_documents([doc])[0]
+
+  def insert_documents(self, docs):
+    docids = []
+    batch = []
+    for doc in docs:
+      batch.append(doc)
+      if len(batch) == self.batch_size:
+        docids += self.index._insert_batch(batch, write_postings = self._buffer)
+        batch = []
+    if len(batch) > 0:
+      docids += self.index._insert_batch(batch, write_postings = self._buffer)
+    return docids
+
+  def num_runs(self):
+    return sum(len(runs) for runs in self._runs.values())
+
+  def _buffer(self, token_index, rows):
+    self._buffers[token_index.name] += ((token, rank, doc_id) for rank, doc_id, token in rows)
+    self._bufferSize += len(rows) * kBytesPerPosting
+    if self._bufferSize >= self.memory_budget:
+      self._spill()
+
+  def _spill(self):
+    for name, buffer in self._buffers.items():
+      if len(buffer) == 0:
+        continue
+      buffer.sort()
+      f = tempfile.TemporaryFile(dir = self.tmpdir)
+      for i in range(0, len(buffer), 10000):
+        f.write(b''.join(kPostingFormat.pack(*posting) for posting in buffer[i:i + 10000]))
+      f.seek(0)
+      self._runs[name].append(f)
+      self._buffers[name] = []
+    self._bufferSize = 0
+
+  def _read_run(self, f, chunkSize):
+    while True:
+      data = f.read(chunkSize * kPostingFormat.size)
+      if len(data) == 0:
+        break
+      yield from kPostingFormat.iter_unpack(data)
+    f.close()
+
+  def finish(self):
+    """
+    Merges all buffered and spilled postings into the index's tables.
+    """
+    conn = self.index.conn
+    c = conn.cursor()
+    readCursor = conn.cursor()
+    for token_index in self.index.token_indices:
+      runs = self._runs[token_index.name]
+      buffer = sorted(self._buffers[token_index.name])
+      if len(runs) == 0 and len(buffer) == 0:
+        continue
+
+      # Each run gets an equal share of the memory budget for its read buffer.
+      chunkSize = max(1024, self.memory_budget // ((len(runs) + 1) * kPostingFormat.size))
+      streams = [self._read_run(f, chunkSize) for f in runs]
+      streams.append(iter(buffer))
+      streams.append(token_index.postings(readCursor))
+
+      newTable = f"{token_index.tableName}_build"
+      c.execute(f"DROP TABLE IF EXISTS {newTable}")
+      TokenIndex.create_table(c, newTable, without_rowid = True)
+      c.executemany(f"INSERT INTO {newTable} (token, rank, doc_id) VALUES (?, ?, ?)", heapq.merge(*streams))
+      c.execute(f"DROP TABLE {token_index.tableName}")
+      c.execute(f"ALTER TABLE {newTable} RENAME TO {token_index.tableName}")
+      self.index._commit()
+      if token_index.cache is not None:
+        token_index.cache.invalidate_table(token_index.namespace, token_index.name)
+
+      self._runs[token_index.name] = []
+      self._buffers[token_index.name] = []
+    self._bufferSize = 0
+    if self.index.result_cache is not None:
+      self.index.result_cache.invalidate_namespace(os.path.abspath(self.index.path))
+    if self.index.filter_cache is not None:
+      self.index.filter_cache.invalidate_namespace(os.path.abspath(self.index.path))
@@ -1,5 +1,6 @@
-import sqlite3, time
+import copy, heapq, sqlite3, time
 
+from bisect import bisect_right
 from collections import deque
 
 kBigNumber = 9e99
@@ -12,7 +13,11 @@ class ExpressionContext:
       pageLength : int,
       index,
       first = (-kBigNumber, kBigNumber),
-      last = (kBigNumber, kBigNumber)
+      last = (kBigNumber, kBigNumber),
+      pair_counts : bool = False,
+      descending : bool = False,
+      segments : dict = None,
+      filters = None,
     ):
     self.c = c
     self.r = r  # (how long it takes to check a doc for a token) / (how long it takes to yield the next docid in a posting list)
@@ -20,16 +25,73 @@ class ExpressionContext:
     self.first = first
     self.last = last
     self.index = index
+    self.pair_counts = pair_counts  # Whether the pair_counts table is maintained
+    # Nodes always yield values in increasing order. To iterate from high to
+    # low, descending contexts have nodes yield (-rank, -doc_id) instead of
+    # (rank, doc_id), so first, last and every comparison are effectively
+    # swapped. Use decode to recover (rank, doc_id).
+    self.descending = descending
+    # For segmented indices, a {segment: (TokenIndex, deleted docids)} dict
+    # (see SegmentNode).
+    self.segments = segments
+    # A function that returns the set of docids that contain a token (see
+    # FilterNode), or None.
+    self.filters = filters
+    self._counts = {}
+    self._segmentContexts = {}
+
+  def decode(self, x):
+    if self.descending:
+      return (-x[0], -x[1])
+    return x
+
+  def segment(self, name : str):
+    """
+    Returns a context that reads from the segment called name, and the set of
+    docids deleted from that segment.
+    """
+    r = self._segmentContexts.get(name)
+    if r is None:
+      if self.segments is None or name not in self.segments:
+        raise KeyError(f"Unknown segment \"{name}\" (nodes must be rebuilt after compaction)")
+      index, deleted = self.segments[name]
+      ctx = copy.copy(self)
+      ctx.index = index
+      r = (ctx, deleted)
+      self._segmentContexts[name] = r
+    return r
 
   def count(self, token):
-    self.c.execute("SELECT count FROM pair_counts WHERE id1 = ? AND id2 = ?", (token, token))
-    return self.c.fetchone()[0]
+    """
+    The number of documents that contain token (or kBigNumber if unknown).
+    """
+    if token == 0:
+      return kBigNumber
+    if token not in self._counts:
+      try:
+        self.c.execute("SELECT count FROM tokens WHERE rowid = ?", (token,))
+        r = self.c.fetchone()
+      except sqlite3.OperationalError:
+        # The index is being used without a TokenMapper.
+        r = None
+      self._counts[token] = kBigNumber if r is None else r[0]
+    return self._counts[token]
 
   def pair_count(self, token1, token2):
+    """
+    The number of documents that contain both tokens (or None if unknown).
+    """
+    if token1 == token2:
+      return self.count(token1)
+    if token1 == 0 or token2 == 0:
+      return self.count(token1 + token2)
+    if not self.pair_counts:
+      return None
     if token2 > token1:
       token1, token2 = token2, token1
     self.c.execute("SELECT count FROM pair_counts WHERE id1 = ? AND id2 = ?", (token1, token2))
-    return self.c.fetchone()[0]
+    r = self.c.fetchone()
+    return 0 if r is None else r[0]
 
 
 class Node:
@@ -39,6 +101,12 @@ class Node:
     """
     raise NotImplementedError('')
 
+  def estimate(self, ctx):
+    """
+    Return an upper bound on the number of values this node yields
+    """
+    return kBigNumber
+
 
 class NotNode(Node):
   def __new__(cls, token):
@@ -51,30 +119,83 @@ class NotNode(Node):
 
 
 class AndNode(Node):
+  """
+  Children are planned the first time next is called: the rarest
+  non-negated child drives the loop, and every other child is only probed
+  (with a seek) at the driver's candidates, stopping at the first miss.
+  Probes are ordered so the ones most likely to miss go first.
+
+  If the context has filters, FilterNode children (other than the driver)
+  are checked before any probe, with a set lookup instead of a seek.
+  """
   def __init__(self, children):
     assert len(children) > 1
     self.children = [child[0] for child in children]
     self.negated = [child[1] for child in children]
+    assert sum(self.negated) < len(self.negated)
+    self._plan = None
+    self._source = None  # The (index, descending) the plan was made for
+
+  def estimate(self, ctx):
+    return min(child.estimate(ctx) for child, n in zip(self.children, self.negated) if not n)
 
-  def is_satisfied(self, vals, x):
-    for v, n in zip(vals, self.negated):
-      if n == (v == x):
-        return False
-    return True
+  def plan(self, ctx):
+    positive = [child for child, n in zip(self.children, self.negated) if not n]
+    negative = [child for child, n in zip(self.children, self.negated) if n]
+    positive.sort(key = lambda child: child.estimate(ctx))
+    driver = positive[0]
+    filters = []
+    if ctx.filters is not None:
+      filters = [(child, n) for child, n in zip(self.children, self.negated) if isinstance(child, FilterNode) and child is not driver]
+      positive = [driver] + [child for child in positive[1:] if not isinstance(child, FilterNode)]
+      negative = [child for child in negative if not isinstance(child, FilterNode)]
+
+    def expected_hits(child):
+      # How many of the driver's values child is expected to accept. Without
+      # pair counts, assume tokens are independent.
+      if isinstance(getattr(driver, 'token', None), int) and isinstance(getattr(child, 'token', None), int):
+        pairCount = ctx.pair_count(driver.token, child.token)
+        if pairCount is not None:
+          return pairCount
+      return child.estimate(ctx)
+
+    positive[1:] = sorted(positive[1:], key = expected_hits)
+    # The most common negated children are the most likely to reject a value.
+    negative.sort(key = lambda child: -child.estimate(ctx))
+    filters = [(ctx.filters(child.token), n) for child, n in filters]
+    return driver, positive[1:], negative, filters
 
   def next(self, ctx, x):
-    vals = [child.next(ctx, x) for child in self.children]
-    x = max(v for (v, n) in zip(vals, self.negated) if not n)
+    if self._plan is None or (ctx.index, ctx.descending) != self._source:
+      self._plan = self.plan(ctx)
+      self._source = (ctx.index, ctx.descending)
+    driver, probes, negative, filters = self._plan
 
     while True:
-      # increment up to x
-      vals = [child.next(ctx, (x[0], x[1] - 1)) for child in self.children]
-      if x == ctx.last or self.is_satisfied(vals, x):
+      x = driver.next(ctx, x)
+      if x == ctx.last:
         return x
+      if len(filters) > 0:
+        docid = abs(x[1])
+        if any((docid in docids) == n for docids, n in filters):
+          continue
+      # The largest possible value that is less than x.
+      before = (x[0], x[1] - 1)
 
-      # increment beyond x
-      vals = [child.next(ctx, x) for child in self.children]
-      x = max(v for (v, n) in zip(vals, self.negated) if not n)
+      miss = None
+      for child in probes:
+        v = child.next(ctx, before)
+        if v != x:
+          miss = v
+          break
+      if miss is not None:
+        if miss == ctx.last:
+          return miss
+        x = (miss[0], miss[1] - 1)
+        continue
+
+      if all(child.next(ctx, before) != x for child in negative):
+        return x
 
 
 class OrNode(Node):
@@ -84,10 +205,45 @@ class OrNode(Node):
     self.negated = [child[1] for child in children]
     assert sum(self.negated) == 0
 
+  def estimate(self, ctx):
+    return min(kBigNumber, sum(child.estimate(ctx) for child in self.children))
+
   def next(self, ctx, x):
     return min([child.next(ctx, x) for child in self.children])
 
 
+class HeapOrNode(OrNode):
+  """
+  An OrNode that keeps its children's next values in a heap, so each call
+  only advances the children whose value is <= x, rather than every child.
+  This is much faster for wide Or queries (e.g. ranges or synonyms).
+  """
+  def __init__(self, children):
+    super().__init__(children)
+    self._heap = None
+    self._x = None
+    self._source = None  # The (index, descending) the heap's values come from
+
+  def next(self, ctx, x):
+    if self._heap is None or x < self._x or (ctx.index, ctx.descending) != self._source:
+      self._source = (ctx.index, ctx.descending)
+      self._heap = [(child.next(ctx, x), i) for i, child in enumerate(self.children)]
+      self._heap = [(v, i) for v, i in self._heap if v != ctx.last]
+      heapq.heapify(self._heap)
+    self._x = x
+    heap = self._heap
+    while len(heap) > 0 and heap[0][0] <= x:
+      i = heap[0][1]
+      v = self.children[i].next(ctx, x)
+      if v == ctx.last:
+        heapq.heappop(heap)
+      else:
+        heapq.heapreplace(heap, (v, i))
+    if len(heap) == 0:
+      return ctx.last
+    return heap[0][0]
+
+
 class TokenNode(Node):
   """
   A token node that iterates over all docids. This is appropriate for Or-based
@@ -98,14 +254,22 @@ class TokenNode(Node):
     super().__init__()
     self.token = token
     self._cache = deque()
+    self._source = None  # The (index, descending) the cache was read from
+
+  def estimate(self, ctx):
+    return ctx.count(self.token)
 
   def next(self, ctx, x):
+    if (ctx.index, ctx.descending) != self._source:
+      self._source = (ctx.index, ctx.descending)
+      self._cache = deque()
     if len(self._cache) == 0:
       self._cache += ctx.index.docids(
         c = ctx.c,
         token = self.token,
         n = ctx.pageLength,
         where = x,
+        descending = ctx.descending,
       )
     if len(self._cache) == 0:
       self._cache.append(ctx.last)
@@ -118,6 +282,7 @@ class TokenNode(Node):
           token = self.token,
           n = ctx.pageLength,
           where = self._cache[0],
+          descending = ctx.descending,
         )
       self._cache.popleft()
       if len(self._cache) == 0:
@@ -137,30 +302,197 @@ class TokenNode2(Node):
     self.token = token
     self._cache = deque()
 
+  def estimate(self, ctx):
+    return ctx.count(self.token)
+
   def next(self, ctx, x):
     r = ctx.index.docids(
         c = ctx.c,
         token = self.token,
         n = ctx.pageLength,
         where = x,
+        descending = ctx.descending,
       )
     if len(r) == 0:
       return ctx.last
     return r[0]
 
 
+class AdaptiveTokenNode(Node):
+  """
+  A token node that caches a page of docids, like TokenNode, but seeks
+  directly to x (like TokenNode2) whenever x jumps past the cached page.
+
+  The page length adapts to how the node is used: it doubles (up to
+  ctx.pageLength) every time a page is consumed to its end, and halves (down
+  to ctx.r, the relative cost of a seek) every time a request skips past the
+  cached page. This makes it appropriate for both sides of an And query.
+  """
+  def __init__(self, token : int):
+    super().__init__()
+    self.token = token
+    self._cache = []
+    self._start = None  # The cache holds every docid in (self._start, self._cache[-1]]
+    self._exhausted = False  # True if there are no docids after self._cache[-1]
+    self._pageLength = None
+    self._source = None  # The (index, descending) the cache was read from
+
+  def _fetch(self, ctx, x):
+    self._cache = ctx.index.docids(
+      c = ctx.c,
+      token = self.token,
+      n = self._pageLength,
+      where = x,
+      descending = ctx.descending,
+    )
+    self._start = x
+    self._exhausted = len(self._cache) < self._pageLength
+
+  def estimate(self, ctx):
+    return ctx.count(self.token)
+
+  def next(self, ctx, x):
+    if (ctx.index, ctx.descending) != self._source:
+      # The node is being reused with another ranking or direction, so its
+      # cached docids (and page length) no longer apply.
+      self._source = (ctx.index, ctx.descending)
+      self._cache = []
+      self._start = None
+      self._exhausted = False
+      self._pageLength = ctx.pageLength
+    cache = self._cache
+    if self._start is None or x < self._start:
+      self._fetch(ctx, x)
+    elif len(cache) == 0 or x >= cache[-1]:
+      if self._exhausted:
+        return ctx.last
+      minPageLength = min(max(1, int(ctx.r)), ctx.pageLength)
+      if len(cache) > 0 and x == cache[-1]:
+        self._pageLength = min(self._pageLength * 2, ctx.pageLength)
+      else:
+        self._pageLength = max(self._pageLength // 2, minPageLength)
+      self._fetch(ctx, x)
+
+    cache = self._cache
+    i = bisect_right(cache, x)
+    if i == len(cache):
+      return ctx.last
+    return cache[i]
+
+
+class FilterNode(AdaptiveTokenNode):
+  """
+  A token node for filters (e.g. "author:x"). Inside an AndNode whose
+  context has filters, it is checked with an O(1) lookup in the set of
+  docids that contain token (which is shared by every ranking), rather than
+  by seeking through its postings. Elsewhere it is an AdaptiveTokenNode.
+  """
+  pass
+
+
+class RankRangeNode(Node):
+  """
+  Restricts a node to the values whose rank is in [low, high] (inclusive,
+  with None meaning unbounded) by seeking straight to low and stopping at
+  high, rather than filtering with extra tokens.
+  """
+  def __init__(self, child, low = None, high = None):
+    super().__init__()
+    self.child = child
+    self.low = low
+    self.high = high
+
+  def estimate(self, ctx):
+    return self.child.estimate(ctx)
+
+  def next(self, ctx, x):
+    if ctx.descending:
+      low = None if self.high is None else -self.high
+      high = None if self.low is None else -self.low
+    else:
+      low, high = self.low, self.high
+    if low is not None and x < (low, -kBigNumber):
+      x = (low, -kBigNumber)
+    x = self.child.next(ctx, x)
+    if high is not None and x != ctx.last and x[0] > high:
+      return ctx.last
+    return x
+
+
+class SegmentNode(Node):
+  """
+  Evaluates child against one segment of an index (see ctx.segment),
+  skipping the documents deleted from (or moved out of) that segment. The
+  base segment of an index that isn't segmented is called "".
+  """
+  def __init__(self, child, segment : str):
+    super().__init__()
+    self.child = child
+    self.segment = segment
+
+  def estimate(self, ctx):
+    return self.child.estimate(ctx.segment(self.segment)[0])
+
+  def next(self, ctx, x):
+    segmentContext, deleted = ctx.segment(self.segment)
+    x = self.child.next(segmentContext, x)
+    while x != ctx.last and abs(x[1]) in deleted:
+      x = self.child.next(segmentContext, x)
+    return x
+
+
 class EmptyNode(Node):
+  def estimate(self, ctx):
+    return 0
+
   def next(self, ctx, x):
     return ctx.last
 
 
 class ListNode(Node):
+  """
+  A node that yields the values of a sorted list of (rank, doc_id) tuples.
+  """
   def __init__(self, A):
     super().__init__()
     self.A = A
 
+  def estimate(self, ctx):
+    return len(self.A)
+
   def next(self, ctx, x):
+    if ctx.descending:
+      for a in reversed(self.A):
+        a = (-a[0], -a[1])
+        if a > x:
+          return a
+      return ctx.last
     for a in self.A:
       if a > x:
         return a
     return ctx.last
+
+
+def node_key(node):
+  """
+  Returns a hashable key that is equal for structurally identical node trees
+  (e.g. two calls to Index.intersect with the same arguments), regardless of
+  their internal state. Unknown node types are only equal to themselves.
+  """
+  if isinstance(node, FilterNode):
+    return ('filter', node.token)
+  if isinstance(node, (TokenNode, TokenNode2, AdaptiveTokenNode)):
+    return ('token', node.token)
+  if isinstance(node, AndNode):
+    return ('and',) + tuple((node_key(child), n) for child, n in zip(node.children, node.negated))
+  if isinstance(node, OrNode):
+    return ('or',) + tuple(node_key(child) for child in node.children)
+  if isinstance(node, RankRangeNode):
+    return ('rank_range', node_key(node.child), node.low, node.high)
+  if isinstance(node, SegmentNode):
+    return ('segment', node.segment, node_key(node.child))
+  if isinstance(node, EmptyNode):
+    return ('empty',)
+  if isinstance(node, ListNode):
+    return ('list',) + tuple(map(tuple, node.A))
+  return ('node', id(node))
@@ -0,0 +1,154 @@
+import threading
+
+from array import array
+from collections import OrderedDict
+
+# Rough size of a cache entry, excluding its arrays.
+kEntryOverhead = 200
+
+
+def _int_array(values : [int]):
+  # Use the narrowest signed typecode that fits every value.
+  low, high = min(values, default = 0), max(values, default = 0)
+  for typecode in 'bhiq':
+    a = array(typecode)
+    limit = 1 << (a.itemsize * 8 - 1)
+    if -limit <= low and high < limit:
+      a.extend(values)
+      return a
+  raise OverflowError('docid delta does not fit in 64 bits')
+
+
+def _entry_size(encoded):
+  ranks, deltas = encoded
+  return kEntryOverhead + ranks.itemsize * len(ranks) + deltas.itemsize * len(deltas)
+
+
+def encode_postings(postings : [tuple]):
+  """
+  Packs a list of (rank, doc_id) tuples into an array of ranks and an array of
+  delta-encoded doc_ids.
+  """
+  ranks = array('d', (rank for rank, _ in postings))
+  deltas = []
+  last = 0
+  for _, doc_id in postings:
+    deltas.append(doc_id - last)
+    last = doc_id
+  return ranks, _int_array(deltas)
+
+
+def decode_postings(encoded):
+  ranks, deltas = encoded
+  postings = []
+  doc_id = 0
+  for rank, delta in zip(ranks, deltas):
+    doc_id += delta
+    postings.append((rank, doc_id))
+  return postings
+
+
+class PostingCache:
+  """
+  A thread-safe LRU cache of pages of postings (the results of
+  TokenIndex.docids), bounded by the number of bytes its encoded pages use.
+
+  Keys are (namespace, ranking, token, where, n, descending) tuples, where
+  namespace identifies the index. Writers must call invalidate for every
+  token they touch, both before writing and after committing.
+
+  Readers on other connections may still see the old postings until the
+  writer commits, so they should read generation() before querying and pass
+  it to put, which drops pages read before the latest invalidation.
+  """
+  def __init__(self, max_bytes : int = 64 * 1024 * 1024):
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.nbytes = 0
+    self._generation = 0
+    self._entries = OrderedDict()
+    self._keysByToken = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    with self._lock:
+      encoded = self._entries.get(key)
+      if encoded is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+    return decode_postings(encoded)
+
+  def generation(self):
+    return self._generation
+
+  def put(self, key, postings : [tuple], generation : int = None):
+    encoded = encode_postings(postings)
+    size = _entry_size(encoded)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = encoded
+      self._keysByToken.setdefault(key[:3], set()).add(key)
+      self.nbytes += size
+      while self.nbytes > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+        self.evictions += 1
+
+  def invalidate(self, namespace, ranking : str, token : int):
+    with self._lock:
+      self._generation += 1
+      for key in self._keysByToken.pop((namespace, ranking, token), ()):
+        self._remove(key, False)
+
+  def invalidate_table(self, namespace, ranking : str):
+    with self._lock:
+      self._generation += 1
+      for tableKey in [k for k in self._keysByToken if k[:2] == (namespace, ranking)]:
+        for key in self._keysByToken.pop(tableKey):
+          self._remove(key, False)
+
+  def invalidate_namespace(self, namespace):
+    with self._lock:
+      self._generation += 1
+      for tableKey in [k for k in self._keysByToken if k[0] == namespace]:
+        for key in self._keysByToken.pop(tableKey):
+          self._remove(key, False)
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+      self._keysByToken.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'entries': len(self._entries),
+      'bytes': self.nbytes,
+    }
+
+  def _remove(self, key, updateTokenKeys = True):
+    self.nbytes -= _entry_size(self._entries.pop(key))
+    if updateTokenKeys:
+      keys = self._keysByToken[key[:3]]
+      keys.discard(key)
+      if len(keys) == 0:
+        del self._keysByToken[key[:3]]
+
+
+# A cache that every Index in this process can share (see Index.__init__).
+kPostingCache = PostingCache()
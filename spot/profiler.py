@@ -0,0 +1,152 @@
+import copy, time
+
+from .nodes import AndNode, OrNode, RankRangeNode, SegmentNode, kBigNumber
+
+
+class NodeStats:
+  def __init__(self):
+    self.calls = 0         # Calls to next
+    self.statements = 0    # SELECTs issued by TokenIndex.docids
+    self.rows = 0          # Postings returned by TokenIndex.docids
+    self.cache_hits = 0    # Pages of postings found in the posting cache
+    self.seconds = 0.0     # Wall time spent in next (including children)
+
+  def json(self):
+    return {
+      'calls': self.calls,
+      'statements': self.statements,
+      'rows': self.rows,
+      'cache_hits': self.cache_hits,
+      'seconds': self.seconds,
+    }
+
+
+def children(node):
+  """
+  Returns the (child, negated) tuples of a node.
+  """
+  if isinstance(node, (AndNode, OrNode)):
+    return list(zip(node.children, node.negated))
+  if isinstance(node, (RankRangeNode, SegmentNode)):
+    return [(node.child, False)]
+  return []
+
+
+class _ProfiledTokenIndex:
+  # Wraps a TokenIndex, attributing the work done by docids to the node
+  # whose next is running.
+  def __init__(self, index, profiler):
+    self._index = index
+    self._profiler = profiler
+
+  def __getattr__(self, name):
+    return getattr(self._index, name)
+
+  def docids(self, *args, **kwargs):
+    cache = self._index.cache
+    hits = 0 if cache is None else cache.hits
+    r = self._index.docids(*args, **kwargs)
+    stack = self._profiler._stack
+    if len(stack) > 0:
+      stats = stack[-1]
+      if cache is not None and cache.hits > hits:
+        stats.cache_hits += 1
+      else:
+        stats.statements += 1
+      stats.rows += len(r)
+    return r
+
+
+class Profiler:
+  """
+  Collects per-node statistics (NodeStats) of a node tree's evaluation.
+
+  Profiling is opt-in and costs nothing when it isn't used: instrument
+  replaces the next method of every node in a tree with a wrapper that
+  counts calls and time, and context returns a copy of an ExpressionContext
+  whose TokenIndex counts the statements, rows and cache hits of the node
+  that is running. Uninstrumented nodes and contexts are never slowed down.
+
+    profiler = Profiler()
+    node = profiler.instrument(index.intersect('foo', 'bar'))
+    spot.stream(node, profiler.context(index.expression_context('score')))
+    profiler.stats(node).statements
+  """
+  def __init__(self):
+    self._stats = {}
+    self._stack = []
+
+  def stats(self, node):
+    return self._stats[id(node)]
+
+  def instrument(self, node):
+    """
+    Instruments every node of a tree (in place) and returns the root.
+    """
+    for child, _ in children(node):
+      self.instrument(child)
+    if id(node) in self._stats:
+      return node
+    stats = NodeStats()
+    self._stats[id(node)] = stats
+    unprofiled = node.next
+    stack = self._stack
+    def profiled_next(ctx, x):
+      stats.calls += 1
+      stack.append(stats)
+      start_time = time.perf_counter()
+      try:
+        return unprofiled(ctx, x)
+      finally:
+        stats.seconds += time.perf_counter() - start_time
+        stack.pop()
+    node.next = profiled_next
+    return node
+
+  def context(self, ctx):
+    """
+    Returns a copy of ctx whose token indices (including those of its
+    segments) are profiled.
+    """
+    ctx = copy.copy(ctx)
+    ctx.index = _ProfiledTokenIndex(ctx.index, self)
+    if ctx.segments is not None:
+      ctx.segments = {
+        name: (_ProfiledTokenIndex(index, self), deleted)
+        for name, (index, deleted) in ctx.segments.items()
+      }
+    ctx._segmentContexts = {}
+    return ctx
+
+  def report(self, node, ctx, names : dict = {}):
+    """
+    Returns the instrumented tree as text, one node per line, with every
+    node's estimated number of matches (see Node.estimate) and its stats.
+    names maps tokens to their strings.
+    """
+    lines = ['%-40s %10s %8s %6s %8s %6s %10s' % ('node', 'estimate', 'calls', 'sql', 'rows', 'hits', 'time (ms)')]
+    def visit(node, depth, negated):
+      label = type(node).__name__
+      if hasattr(node, 'token'):
+        label += f"({names.get(node.token, node.token)!r})"
+      elif isinstance(node, RankRangeNode):
+        label += f"[{node.low}, {node.high}]"
+      elif isinstance(node, SegmentNode):
+        label += f"({node.segment!r})"
+      if negated:
+        label = 'NOT ' + label
+      estimate = node.estimate(ctx)
+      stats = self._stats.get(id(node), NodeStats())
+      lines.append('%-40s %10s %8i %6i %8i %6i %10.3f' % (
+        '  ' * depth + label,
+        '?' if estimate >= kBigNumber else '%i' % estimate,
+        stats.calls,
+        stats.statements,
+        stats.rows,
+        stats.cache_hits,
+        stats.seconds * 1000,
+      ))
+      for child, n in children(node):
+        visit(child, depth + 1, n)
+    visit(node, 0, False)
+    return '\n'.join(lines)
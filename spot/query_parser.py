@@ -0,0 +1,186 @@
+import re, threading
+
+from collections import OrderedDict
+
+# Number of compiled query plans each Index caches (see Index.query).
+kPlanCacheSize = 1024
+
+kRangePattern = re.compile(r'([^\s()":]+):([\[{])\s*(\S+?)\s+TO\s+(\S+?)\s*([\]}])')
+kComparisonPattern = re.compile(r'^([^\s()":]+):(<=|>=|<|>)(\S+)$')
+kWordPattern = re.compile(r'[^\s()"]+')
+
+
+def _number(s : str):
+  # Returns s as a number (None for "*"), or raises ValueError.
+  if s == '*':
+    return None
+  return float(s)
+
+
+def _lex(query : str):
+  i = 0
+  while i < len(query):
+    if query[i].isspace():
+      i += 1
+      continue
+    if query[i] in '()':
+      yield (query[i],)
+      i += 1
+      continue
+    if query[i] == '-' and i + 1 < len(query) and not query[i + 1].isspace():
+      yield ('NOT',)
+      i += 1
+      continue
+    if query[i] == '"':
+      j = query.find('"', i + 1)
+      if j == -1:
+        raise ValueError(f"Unterminated quote at position {i} of \"{query}\"")
+      yield ('tag', query[i + 1:j])
+      i = j + 1
+      continue
+    m = kRangePattern.match(query, i)
+    if m is not None:
+      name, opening, low, high, closing = m.groups()
+      try:
+        yield ('range', name, _number(low), opening == '[', _number(high), closing == ']')
+        i = m.end()
+        continue
+      except ValueError:
+        pass
+    m = kWordPattern.match(query, i)
+    word = m.group()
+    i = m.end()
+    if word in ('AND', 'OR', 'NOT'):
+      yield (word,)
+      continue
+    m = kComparisonPattern.match(word)
+    if m is not None:
+      name, op, value = m.groups()
+      try:
+        value = float(value)
+        if op[0] == '<':
+          yield ('range', name, None, True, value, op == '<=')
+        else:
+          yield ('range', name, value, op == '>=', None, True)
+        continue
+      except ValueError:
+        pass
+    yield ('tag', word)
+
+
+def parse(query : str):
+  """
+  Parses a query into a tree of tuples:
+
+    ('tag', token)
+    ('range', name, low, low_inclusive, high, high_inclusive)
+    ('not', child)
+    ('and', [child, ...])
+    ('or', [child, ...])
+
+  Terms separated by whitespace (or AND) must all match, OR binds tighter
+  than AND, and a term can be negated with a leading "-" (or NOT) and
+  grouped with parentheses. Range predicates are written as
+  name:[low TO high] (inclusive), name:{low TO high} (exclusive) or
+  name:<x (also <=, >, >=), where "*" is unbounded. Tokens that contain
+  spaces, parentheses or a leading "-" must be quoted. For example:
+
+    foo (bar OR baz) -qux score:[3 TO 10]
+  """
+  tokens = list(_lex(query))
+  pos = 0
+
+  def peek():
+    return tokens[pos][0] if pos < len(tokens) else None
+
+  def take(kind):
+    nonlocal pos
+    if peek() != kind:
+      found = 'the end of the query' if peek() is None else f"\"{peek()}\""
+      raise ValueError(f"Expected \"{kind}\" but found {found} in \"{query}\"")
+    pos += 1
+    return tokens[pos - 1]
+
+  def and_expr():
+    children = [or_expr()]
+    while peek() not in (None, ')'):
+      if peek() == 'AND':
+        take('AND')
+      children.append(or_expr())
+    return children[0] if len(children) == 1 else ('and', children)
+
+  def or_expr():
+    children = [unary()]
+    while peek() == 'OR':
+      take('OR')
+      children.append(unary())
+    return children[0] if len(children) == 1 else ('or', children)
+
+  def unary():
+    nonlocal pos
+    if peek() == 'NOT':
+      take('NOT')
+      return ('not', unary())
+    if peek() == '(':
+      take('(')
+      r = and_expr()
+      take(')')
+      return r
+    if peek() in ('tag', 'range'):
+      pos += 1
+      return tokens[pos - 1]
+    found = 'the end of the query' if peek() is None else f"\"{peek()}\""
+    raise ValueError(f"Expected a term but found {found} in \"{query}\"")
+
+  if len(tokens) == 0:
+    raise ValueError('Empty query')
+  r = and_expr()
+  if pos < len(tokens):
+    raise ValueError(f"Unexpected \"{peek()}\" in \"{query}\"")
+  return r
+
+
+def normalize(query : str):
+  # Outside of quotes (which can't be escaped), runs of whitespace only
+  # separate tokens, so they are equivalent. Quoted tags are kept as is.
+  parts = query.strip().split('"')
+  parts[::2] = [re.sub(r'\s+', ' ', part) for part in parts[::2]]
+  return '"'.join(parts)
+
+
+class PlanCache:
+  """
+  A thread-safe LRU cache of query plans, keyed by (normalized query,
+  ranking). A plan is the parsed query with its tokens resolved to ids (see
+  Index.query), from which nodes can be built without any SQL.
+  """
+  def __init__(self, max_size : int = kPlanCacheSize):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._plans = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._plans)
+
+  def get(self, key):
+    with self._lock:
+      plan = self._plans.get(key)
+      if plan is None:
+        self.misses += 1
+        return None
+      self._plans.move_to_end(key)
+      self.hits += 1
+      return plan
+
+  def put(self, key, plan):
+    with self._lock:
+      self._plans[key] = plan
+      self._plans.move_to_end(key)
+      while len(self._plans) > self.max_size:
+        self._plans.popitem(last = False)
+
+  def clear(self):
+    with self._lock:
+      self._plans.clear()
@@ -0,0 +1,121 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from .posting_cache import encode_postings, decode_postings, _entry_size
+
+
+class ResultCache:
+  """
+  A thread-safe LRU cache of query results (the (rank, docid) tuples of a
+  page of hits, see Index.cached_search), bounded by the number of bytes its
+  encoded pages use. Entries expire after ttl seconds (if ttl is not None).
+
+  Keys are tuples whose first element is a namespace identifying the index.
+  Every entry is registered under the tokens it depends on, and writers call
+  invalidate with the tokens of every document they insert, modify or delete
+  (after committing): a page of hits can only change if some document that
+  has all of the query's (non-negated) tokens changes.
+
+  As with PostingCache, readers should read generation() before querying and
+  pass it to put, so that results computed before a write committed aren't
+  cached after its invalidation.
+  """
+  def __init__(self, max_bytes : int = 16 * 1024 * 1024, ttl : float = None):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.invalidations = 0
+    self.nbytes = 0
+    self._generation = 0
+    self._entries = OrderedDict()
+    self._keysByToken = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      if self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+        self._remove(key)
+        self.expirations += 1
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+    return decode_postings(entry[1])
+
+  def generation(self):
+    return self._generation
+
+  def put(self, key, hits : [tuple], tokens : [str], generation : int = None):
+    # tokens are the (non-negated) tokens every hit must have.
+    encoded = encode_postings(hits)
+    size = _entry_size(encoded)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      if generation is not None and generation != self._generation:
+        return
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = (time.monotonic(), encoded, tuple(tokens))
+      for token in tokens:
+        self._keysByToken.setdefault((key[0], token), set()).add(key)
+      self.nbytes += size
+      while self.nbytes > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+        self.evictions += 1
+
+  def invalidate(self, namespace, tokens : [str]):
+    with self._lock:
+      self._generation += 1
+      for token in tokens:
+        for key in list(self._keysByToken.get((namespace, token), ())):
+          self._remove(key)
+          self.invalidations += 1
+
+  def invalidate_namespace(self, namespace):
+    with self._lock:
+      self._generation += 1
+      for key in [key for key in self._entries if key[0] == namespace]:
+        self._remove(key)
+        self.invalidations += 1
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+      self._keysByToken.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+      'evictions': self.evictions,
+      'expirations': self.expirations,
+      'invalidations': self.invalidations,
+      'entries': len(self._entries),
+      'bytes': self.nbytes,
+    }
+
+  def _remove(self, key):
+    _, encoded, tokens = self._entries.pop(key)
+    self.nbytes -= _entry_size(encoded)
+    for token in tokens:
+      keys = self._keysByToken[(key[0], token)]
+      keys.discard(key)
+      if len(keys) == 0:
+        del self._keysByToken[(key[0], token)]
@@ -1,12 +1,29 @@
+import heapq
+import itertools
 import json
+import math
 import os
 import re
 import shutil
 import sqlite3
+import threading
 
+from collections import Counter, deque
+
+from .connection_pool import ConnectionPool, database_file
 from .token_index import TokenIndex
-from .nodes import TokenNode, AndNode, OrNode, ExpressionContext, EmptyNode
-from .token_mapper import TokenMapper, kIntRangePrefix
+from .nodes import TokenNode, AdaptiveTokenNode, AndNode, HeapOrNode, ExpressionContext, EmptyNode, RankRangeNode, SegmentNode, FilterNode
+from .docid_set import DocidSet
+from .score_index import ScoreIndex
+from .wand import ScoredList, top_k, exhaustive_top_k
+from .filter_cache import FilterCache
+from .document_codec import DocumentCodec
+from .index_builder import IndexBuilder
+from .posting_cache import PostingCache, kPostingCache
+from .profiler import Profiler, children as profiler_children
+from .query_parser import PlanCache, parse, normalize
+from .result_cache import ResultCache
+from .token_mapper import TokenMapper, kMaxVariables, token_pairs
 
 
 def num_bits(low, high):
@@ -25,36 +42,44 @@ class IntRange:
   Given a range (e.g. "[4, 15]") returns a list of tokens which, when OR-ed together, represent it.
 
   Given an integer, returns the tokens that should be associated with the document
+
+  Tokens cover aligned blocks of branching_factor ** level integers, so a
+  larger branching factor means fewer tokens per document but more tokens
+  per range (up to 2 * (branching_factor - 1) per level). Floats are floored.
   """
-  def __init__(self, name, low, high):
+  def __init__(self, name, low, high, branching_factor = 2):
+    assert branching_factor >= 2
     self.name = name
     self.low = low
     self.high = high
+    self.branching_factor = branching_factor
     self.num_bits = num_bits(low, high)
+    self.num_levels = 1
+    while branching_factor ** self.num_levels <= high - low:
+      self.num_levels += 1
 
-  def less_than(self, x : int):
-    return self.range(self.low, x - 1)
+  def less_than(self, x : float):
+    return self.range(self.low, math.ceil(x) - 1)
 
-  def greater_than(self, x : int):
-    return self.range(x + 1, self.high)
+  def greater_than(self, x : float):
+    return self.range(math.floor(x) + 1, self.high)
 
   def range(self, low, high, inclusive = True):
-    low -= self.low
-    high -= self.low
+    low = max(low, self.low) - self.low
+    high = min(high, self.high) - self.low
     if not inclusive:
       low += 1
       high -= 1
-    return self._range(low, high, 1 << (self.num_bits - 1))
+    return self._range(low, high, self.num_levels - 1)
 
-  def _range(self, low, high, step):
+  def _range(self, low, high, level):
     if low > high:
       return []
-    if step == 1:
-      assert low == high
-      return [f"#{self.name}:{low}:{low}"]
+    if level == 0:
+      return [f"#{self.name}:{a}:{a}" for a in range(low, high + 1)]
+    step = self.branching_factor ** level
     r = []
 
-    # todo: simplify
     a0 = (low // step) * step
     if a0 < low:
       a0 += step
@@ -65,14 +90,14 @@ class IntRange:
       a += step
 
     if len(r) == 0:
-      return self._range(low, high, step // 2)
-    return self._range(low, a0 - 1, step // 2) + r + self._range(a, high, step // 2)
+      return self._range(low, high, level - 1)
+    return self._range(low, a0 - 1, level - 1) + r + self._range(a, high, level - 1)
 
   def tokens(self, x : int):
-    x -= self.low
+    x = math.floor(x) - self.low
     r = []
-    for bit in range(self.num_bits):
-      step = 1 << bit
+    for level in range(self.num_levels):
+      step = self.branching_factor ** level
       a = x // step * step
       r.append(f"#{self.name}:{a}:{a + step - 1}")
     return r
@@ -82,6 +107,7 @@ class IntRange:
       'name': self.name,
       'low': self.low,
       'high': self.high,
+      'branching_factor': self.branching_factor,
     }
 
   @staticmethod
@@ -89,13 +115,84 @@ class IntRange:
     return re.match(r"^#\w+:\d+:\d+$", x)
 
 
+def range_bounds(op : str, value : float, negated : bool = False):
+  """
+  Returns the inclusive (low, high) integer bounds of a range predicate such
+  as ("<", 4.5), where a bound of None is unbounded.
+  """
+  if negated:
+    op = kNegatedRangeOps[op]
+  if op == '<':
+    return (None, math.ceil(value) - 1)
+  if op == '<=':
+    return (None, math.floor(value))
+  if op == '>':
+    return (math.floor(value) + 1, None)
+  if op == '>=':
+    return (math.ceil(value), None)
+  raise ValueError(f"Invalid range operator \"{op}\"")
+
+kNegatedRangeOps = { '<': '>=', '<=': '>', '>': '<=', '>=': '<' }
+
+def query_key(tags : list, invert : list):
+  """
+  Returns a hashable key that is the same for every equivalent list of tags
+  (and inversion flags) passed to Index.intersect, regardless of their order
+  or how their range predicates are written.
+  """
+  terms = set()
+  for tag, neg in zip(tags, invert):
+    if isinstance(tag, str):
+      terms.add(('token', tag, bool(neg)))
+    else:
+      name, op, value = tag
+      low, high = range_bounds(op, value, neg)
+      terms.add(('range', name, low, high))
+  return tuple(sorted(terms, key = repr))
+
+# Number of an Index's latest commits it remembers, to tell its own writes
+# from other writers' (see Index._check_filters).
+kMaxOwnVersions = 1024
+
+# Number of postings compact writes per transaction.
+kCompactionChunkSize = 100000
+
+
+def _without(postings, deleted : set):
+  # Filters (token, rank, doc_id) tuples.
+  for posting in postings:
+    if posting[2] not in deleted:
+      yield posting
+
+
 class Index:
   @classmethod
-  def create(cls, conn : sqlite3.Connection, path : str, rankings : [str] = [], force = False):
+  def create(cls, conn : sqlite3.Connection, path : str, rankings : [str] = [], force = False, pair_counts : bool = False, codec : str = 'json', codec_level : int = None, fields : [str] = [], segment_size : int = None, scored : bool = False):
+    # If pair_counts is True, the number of documents containing each pair of
+    # tokens is maintained, which lets AndNode plan better (at the cost of
+    # writes that are quadratic in the number of tokens per document).
+    #
+    # codec determines how documents are stored (see DocumentCodec), e.g.
+    # "json" (the default), "marshal+zlib" or "msgpack+zstd".
+    #
+    # Each of the top-level document keys in fields is also stored in its own
+    # column, so fetch_many can return it without decoding whole documents.
+    #
+    # If segment_size is given, the index is segmented: postings of new (and
+    # modified) documents are written to a small fresh segment, which is
+    # sealed once it holds segment_size documents, and segments are merged
+    # by compact (see also Compactor). This keeps writes cheap no matter how
+    # large the index is, at the cost of queries visiting every segment.
+    #
+    # If scored is True, every posting is also stored with a weight (see
+    # doc2weights and doc2prior), ordered by doc_id, for scored_search.
+    codec = DocumentCodec(codec, codec_level)
+    for field in fields:
+      assert re.match(r"^\w+$", field), f"Invalid field \"{field}\""
     ctx = conn.cursor()
-    ctx.execute("""
+    ctx.execute(f"""
       CREATE TABLE documents (
-        data BLOB
+        data BLOB{''.join(f", field_{field} BLOB" for field in fields)}
     )
     """)
 
@@ -103,17 +200,36 @@ class Index:
     for ranking in rankings:
       token_indices.append(TokenIndex.create(ctx, ranking))
 
+    segments = None
+    if segment_size is not None:
+      assert segment_size > 0
+      # The base segment is called "" and uses the tokens_<ranking> tables.
+      segments = { 'names': [''], 'fresh': None, 'next_id': 1, 'retired': [], 'segment_size': segment_size }
+      ctx.execute("CREATE TABLE document_segments (doc_id INTEGER PRIMARY KEY, segment TEXT)")
+      ctx.execute("CREATE TABLE segments (id INTEGER PRIMARY KEY, data TEXT)")
+      ctx.execute("INSERT INTO segments (id, data) VALUES (0, ?)", (json.dumps(segments),))
+
+    if scored:
+      ScoreIndex.create(ctx)
+
     conn.commit()
 
     metadata = {
       'token_indices': [ti.json() for ti in token_indices],
-      'token_mapper': {},
+      'token_mapper': { 'pair_counts': pair_counts },
       'ranges': {},
+      'codec': codec.json(),
+      'fields': fields,
+      'segments': segments,
+      'scored': scored,
     }
 
     with open(os.path.join(path, 'metadata.json'), 'w+') as f:
       json.dump(metadata, f, indent=2)
 
+    # Forget any postings cached for a previous index at this path.
+    kPostingCache.invalidate_namespace(os.path.abspath(path))
+
     return cls(conn, path)
 
   def doc2ranges(self, doc):
@@ -128,71 +244,994 @@ class Index:
     # Subclass this to automatically add rankings based on the document.
     return doc['rankings']
 
-  def insert_document(self, doc : dict):
+  def doc2weights(self, doc):
+    # Subclass this to weight a document's tokens in scored indices (tokens
+    # without a weight get 1).
+    return doc.get('weights', {})
+
+  def doc2prior(self, doc):
+    # Subclass this to give documents a prior in scored indices.
+    return doc.get('prior', 0)
+
+  def _score_rows(self, docid : int, doc : dict, tokens, token2int : dict):
+    weights = self.doc2weights(doc)
+    rows = [(0, docid, float(self.doc2prior(doc)))]
+    rows += ((token2int[token], docid, float(weights.get(token, 1))) for token in tokens)
+    return rows
+
+  def is_filter(self, token_str : str):
+    # Subclass this to have intersect and query check tokens (e.g. "author:x")
+    # with FilterNodes, which use the filter cache (see __init__).
+    return False
+
+  def _all_tokens(self, doc):
     tokens = self.doc2tokens(doc)
-    rankings = self.doc2rankings(doc)
     ranges = self.doc2ranges(doc)
-
     for name in ranges:
       tokens += self.ranges[name].tokens(ranges[name])
+    return tokens
 
-    self.ctx.execute("INSERT INTO documents (data) VALUES (?)", (json.dumps(doc),))
-    docid = self.ctx.lastrowid
+  def insert_document(self, doc : dict):
+    with self._writeLock:
+      tokens = list(dict.fromkeys(self._all_tokens(doc)))
+      rankings = self.doc2rankings(doc)
+      segment = self._fresh_segment()
 
-    token2int = {}
-    for token in tokens:
-      token2int[token] = self.token_mapper.increment(token, self.ctx)
-    for token_index in self.token_indices:
-      rank = int(rankings[token_index.name])
-      token_index.insert(self.ctx, rank, docid, 0)
+      self.ctx.execute(f"INSERT INTO documents ({self._documentColumns}) VALUES ({self._documentParams})", self._document_row(doc))
+      docid = self.ctx.lastrowid
+
+      token2int = {}
       for token in tokens:
-        token_index.insert(self.ctx, rank, docid, token2int[token])
-    self.conn.commit()
+        token2int[token] = self.token_mapper.increment(token, self.ctx)
+      if self.pair_counts:
+        self.token_mapper.increment_pairs(Counter(token_pairs(token2int.values())), self.ctx)
+      for token_index in self.token_indices:
+        rank = int(rankings[token_index.name])
+        token_index = self._segment_index(token_index.name, segment)
+        token_index.insert(self.ctx, rank, docid, 0)
+        for token in tokens:
+          token_index.insert(self.ctx, rank, docid, token2int[token])
+      if self.segments is not None:
+        self.ctx.execute("INSERT INTO document_segments (doc_id, segment) VALUES (?, ?)", (docid, segment))
+      if self.score_index is not None:
+        self.score_index.insert_many(self.ctx, self._score_rows(docid, doc, tokens, token2int))
+      self._commit()
+      self._invalidate_results(tokens)
+      self._update_filters(docid, [token2int[token] for token in tokens], True)
+      self._wrote_to_fresh(1)
     return docid
 
+  def insert_documents(self, docs, batch_size : int = 10000):
+    """
+    Bulk version of insert_document. Documents are written in batches of
+    batch_size, each in a single transaction: token counts are aggregated in
+    memory and the documents, tokens and tokens_<ranking> tables are filled
+    with executemany. Returns the list of new docids.
+    """
+    assert batch_size > 0
+    docids = []
+    batch = []
+    for doc in docs:
+      batch.append(doc)
+      if len(batch) == batch_size:
+        docids += self._insert_batch(batch)
+        batch = []
+    if len(batch) > 0:
+      docids += self._insert_batch(batch)
+    return docids
+
+  def _insert_batch(self, docs : [dict], write_postings = None):
+    # write_postings(token_index, rows) is called with the (rank, doc_id, token)
+    # rows of every ranking table. By default they are inserted immediately.
+    with self._writeLock:
+      segment = self._fresh_segment()
+      self.ctx.execute("SELECT COALESCE(MAX(rowid), 0) FROM documents")
+      firstDocid = self.ctx.fetchone()[0] + 1
+      docids = list(range(firstDocid, firstDocid + len(docs)))
+      self.ctx.executemany(f"INSERT INTO documents (rowid, {self._documentColumns}) VALUES (?, {self._documentParams})", (
+        (docid,) + self._document_row(doc) for docid, doc in zip(docids, docs)
+      ))
+
+      allTokens = [set(self._all_tokens(doc)) for doc in docs]
+      counts = {}
+      for tokens in allTokens:
+        for token in tokens:
+          counts[token] = counts.get(token, 0) + 1
+      token2int = self.token_mapper.increment_many(counts, self.ctx)
+      if self.pair_counts:
+        pairCounts = Counter()
+        for tokens in allTokens:
+          pairCounts.update(token_pairs(token2int[token] for token in tokens))
+        self.token_mapper.increment_pairs(pairCounts, self.ctx)
+
+      allRankings = [self.doc2rankings(doc) for doc in docs]
+      for token_index in self.token_indices:
+        rows = []
+        for docid, tokens, rankings in zip(docids, allTokens, allRankings):
+          rank = int(rankings[token_index.name])
+          rows.append((rank, docid, 0))
+          for token in tokens:
+            rows.append((rank, docid, token2int[token]))
+        if write_postings is None:
+          self._segment_index(token_index.name, segment).insert_many(self.ctx, rows)
+        else:
+          write_postings(token_index, rows)
+      if self.segments is not None:
+        self.ctx.executemany("INSERT INTO document_segments (doc_id, segment) VALUES (?, ?)", (
+          (docid, segment) for docid in docids
+        ))
+      if self.score_index is not None:
+        self.score_index.insert_many(self.ctx, [
+          row for docid, doc, tokens in zip(docids, docs, allTokens) for row in self._score_rows(docid, doc, tokens, token2int)
+        ])
+      self._commit()
+      self._invalidate_results(counts)
+      if self.filter_cache is not None:
+        for docid, tokens in zip(docids, allTokens):
+          self._update_filters(docid, [token2int[token] for token in tokens], True)
+      self._wrote_to_fresh(len(docs))
+    return docids
+
+  def builder(self, **kwargs):
+    """
+    Returns an IndexBuilder, which is much faster than insert_documents when
+    (re)building a large index.
+    """
+    return IndexBuilder(self, **kwargs)
+
   def modify_document(self, docid : int, doc : dict):
-    olddoc = self.fetch(docid)
-    A = set(self.doc2tokens(olddoc))
-    B = set(self.doc2tokens(doc))
-    addedTokens = list(B - A)
-    deletedTokens = list(A - B)
-    unchangedTokens = list(A.intersection(B))
-
-    token2int = {}
-    for token in addedTokens:
-      token2int[token] = self.token_mapper.increment(token, self.ctx)
-    for token in deletedTokens:
-      token2int[token] = self.token_mapper.decrement(token, self.ctx)
-
-    rankings = doc['rankings']
+    self.modify_documents([(docid, doc)])
+
+  def modify_documents(self, updates, batch_size : int = 10000):
+    """
+    Replaces documents, given an iterable of (docid, document) tuples (or a
+    {docid: document} dict). Updates are applied in batches of batch_size,
+    each in a single transaction: only the postings of added and removed
+    tokens are written, unless a document's rank changed, in which case all
+    of its postings in that ranking are moved to the new rank.
+
+    Raises KeyError if a document doesn't exist (or is deleted), in which case
+    none of its batch is applied.
+    """
+    assert batch_size > 0
+    if isinstance(updates, dict):
+      updates = updates.items()
+    batch = []
+    for update in updates:
+      batch.append(update)
+      if len(batch) == batch_size:
+        self._modify_batch(batch)
+        batch = []
+    if len(batch) > 0:
+      self._modify_batch(batch)
+
+  def _modify_batch(self, updates : [tuple]):
+    # Later updates of the same document win.
+    updates = dict(updates)
+    docids = list(updates)
+    with self._writeLock:
+      for docid in docids:
+        if docid in self._deleted:
+          raise KeyError(f"Document {docid} is deleted")
+      oldDocs = {}
+      for i in range(0, len(docids), kMaxVariables):
+        chunk = docids[i:i + kMaxVariables]
+        self.ctx.execute(f"SELECT rowid, data FROM documents WHERE rowid IN ({','.join('?' * len(chunk))})", chunk)
+        for docid, data in self.ctx.fetchall():
+          oldDocs[docid] = self.codec.decode(data)
+      for docid in docids:
+        if docid not in oldDocs:
+          raise KeyError(f"No document {docid}")
+      segment = self._fresh_segment()
+
+      oldTokens = { docid: set(self._all_tokens(oldDocs[docid])) for docid in docids }
+      newTokens = { docid: set(self._all_tokens(updates[docid])) for docid in docids }
+      added, removed = Counter(), Counter()
+      for docid in docids:
+        added.update(newTokens[docid] - oldTokens[docid])
+        removed.update(oldTokens[docid] - newTokens[docid])
+      token2int = self.token_mapper.lookup_many(set().union({''}, *oldTokens.values(), *newTokens.values()), self.ctx)
+      token2int.update(self.token_mapper.increment_many(added, self.ctx))
+      self.token_mapper.decrement_many(removed, self.ctx)
+      if self.pair_counts:
+        pairCounts = Counter()
+        for docid in docids:
+          oldPairs = set(token_pairs(token2int[token] for token in oldTokens[docid]))
+          newPairs = set(token_pairs(token2int[token] for token in newTokens[docid]))
+          pairCounts.update(newPairs - oldPairs)
+          pairCounts.subtract(oldPairs - newPairs)
+        self.token_mapper.increment_pairs(pairCounts, self.ctx)
+
+      oldRankings = { docid: self.doc2rankings(oldDocs[docid]) for docid in docids }
+      newRankings = { docid: self.doc2rankings(updates[docid]) for docid in docids }
+      numMoved = 0
+      if self.segments is None:
+        for token_index in self.token_indices:
+          deletes, inserts = [], []
+          for docid in docids:
+            oldRank = int(oldRankings[docid][token_index.name])
+            newRank = int(newRankings[docid][token_index.name])
+            if oldRank == newRank:
+              deletes += ((oldRank, docid, token2int[token]) for token in oldTokens[docid] - newTokens[docid])
+              inserts += ((newRank, docid, token2int[token]) for token in newTokens[docid] - oldTokens[docid])
+            else:
+              deletes += ((oldRank, docid, token2int[token]) for token in oldTokens[docid] | {''})
+              inserts += ((newRank, docid, token2int[token]) for token in newTokens[docid] | {''})
+          if token_index.delete_many(self.ctx, deletes) < len(deletes):
+            # Some postings have a stale rank (see vacuum_deleted).
+            for _, docid, token in deletes:
+              token_index.delete(self.ctx, docid, token)
+          token_index.insert_many(self.ctx, inserts)
+      else:
+        for docid in docids:
+          numMoved += self._rewrite_postings(
+            docid,
+            segment,
+            [token2int[token] for token in oldTokens[docid]],
+            [token2int[token] for token in newTokens[docid]],
+            oldRankings[docid],
+            newRankings[docid],
+          )
+
+      if self.score_index is not None:
+        # Weights may change even if tokens don't, so every posting is rewritten.
+        self.score_index.delete_many(self.ctx, [
+          (token, docid) for docid in docids for token in [0] + [token2int[t] for t in oldTokens[docid]]
+        ])
+        self.score_index.insert_many(self.ctx, [
+          row for docid in docids for row in self._score_rows(docid, updates[docid], newTokens[docid], token2int)
+        ])
+
+      self.ctx.executemany(f"UPDATE documents SET ({self._documentColumns}) = ({self._documentParams}) WHERE rowid = ?", (
+        self._document_row(updates[docid]) + (docid,) for docid in docids
+      ))
+      self._commit()
+      self._invalidate_results(set().union(*oldTokens.values(), *newTokens.values()))
+      if self.filter_cache is not None:
+        for docid in docids:
+          self._update_filters(docid, [token2int[token] for token in newTokens[docid] - oldTokens[docid]], True)
+          self._update_filters(docid, [token2int[token] for token in oldTokens[docid] - newTokens[docid]], False)
+      self._wrote_to_fresh(numMoved)
+
+  def delete_document(self, docid : int):
+    """
+    Deletes a document in O(1) time: its docid is added to an in-memory
+    DocidSet of tombstones, which queries filter out. Its postings and token
+    counts are only cleaned up by vacuum_deleted (and, for segmented
+    indices, compact). Nodes created before the deletion may still yield it.
+
+    Raises KeyError if there is no such document (or it is already deleted).
+    """
+    with self._writeLock:
+      if docid in self._deleted:
+        raise KeyError(f"Document {docid} is already deleted")
+      self.ctx.execute("SELECT data FROM documents WHERE rowid = ?", (docid,))
+      row = self.ctx.fetchone()
+      if row is None or row[0] is None:
+        raise KeyError(f"No document {docid}")
+      if self.segments is None:
+        segment = ''
+      else:
+        self.ctx.execute("SELECT segment FROM document_segments WHERE doc_id = ?", (docid,))
+        r = self.ctx.fetchone()
+        if r is None:
+          raise KeyError(f"No document {docid}")
+        segment = r[0]
+        self.ctx.execute("DELETE FROM document_segments WHERE doc_id = ?", (docid,))
+      self._add_tombstone(segment, docid)
+      self.ctx.execute("INSERT INTO deleted_documents (doc_id, vacuumed) VALUES (?, 0)", (docid,))
+      self._deleted.add(docid)
+      self._commit()
+      if self.result_cache is not None:
+        self._invalidate_results(self._all_tokens(self.codec.decode(row[0])))
+
+  def vacuum_deleted(self):
+    """
+    Cleans up after every document deleted since the last call, in batch:
+    decrements token (and pair) counts, deletes postings (except from
+    segmented indices, where compact drops them) and clears documents' data.
+    Deleted docids are never reused. Returns the number of documents
+    vacuumed.
+    """
+    with self._writeLock:
+      self.ctx.execute("SELECT doc_id FROM deleted_documents WHERE vacuumed = 0")
+      docids = [row[0] for row in self.ctx.fetchall()]
+      docs = {}
+      for i in range(0, len(docids), kMaxVariables):
+        chunk = docids[i:i + kMaxVariables]
+        self.ctx.execute(f"SELECT rowid, data FROM documents WHERE rowid IN ({','.join('?' * len(chunk))})", chunk)
+        for docid, data in self.ctx.fetchall():
+          docs[docid] = self.codec.decode(data)
+
+      allTokens = { docid: set(self._all_tokens(doc)) for docid, doc in docs.items() }
+      counts = Counter()
+      for tokens in allTokens.values():
+        counts.update(tokens)
+      token2int = self.token_mapper.decrement_many(counts, self.ctx)
+      if self.pair_counts:
+        pairCounts = Counter()
+        for tokens in allTokens.values():
+          pairCounts.update(token_pairs(token2int[token] for token in tokens))
+        self.token_mapper.increment_pairs({ pair: -n for pair, n in pairCounts.items() }, self.ctx)
+
+      if self.segments is None:
+        for token_index in self.token_indices:
+          rows = []
+          for docid, tokens in allTokens.items():
+            rank = int(self.doc2rankings(docs[docid])[token_index.name])
+            rows.append((rank, docid, 0))
+            rows += ((rank, docid, token2int[token]) for token in tokens)
+          if token_index.delete_many(self.ctx, rows) < len(rows):
+            # Some postings have a stale rank, so look them up by doc_id.
+            for _, docid, token in rows:
+              token_index.delete(self.ctx, docid, token)
+        self.ctx.executemany("DELETE FROM tombstones WHERE segment = '' AND doc_id = ?", ((docid,) for docid in docids))
+
+      if self.score_index is not None:
+        self.score_index.delete_many(self.ctx, [
+          (token, docid) for docid, tokens in allTokens.items() for token in [0] + [token2int[t] for t in tokens]
+        ])
+
+      nulls = ', '.join(['NULL'] * (1 + len(self.fields)))
+      self.ctx.executemany(f"UPDATE documents SET ({self._documentColumns}) = ({nulls}) WHERE rowid = ?", ((docid,) for docid in docids))
+      self.ctx.executemany("UPDATE deleted_documents SET vacuumed = 1 WHERE doc_id = ?", ((docid,) for docid in docids))
+      self._commit()
+      if self.segments is None:
+        for docid in docids:
+          self._tombstones[''].discard(docid)
+    return len(docids)
+
+  def _segment_index(self, ranking : str, segment : str):
+    # Returns the TokenIndex of a ranking in a segment ("" is the base segment,
+    # which is also used by indices that aren't segmented).
+    with self._segmentLock:
+      token_index = self._segmentIndices.get((ranking, segment))
+      if token_index is None:
+        if segment == '':
+          token_index = [ti for ti in self.token_indices if ti.name == ranking][0]
+        else:
+          token_index = TokenIndex(f"{ranking}_{segment}")
+          if self.posting_cache is not None:
+            token_index.attach_cache(self.posting_cache, os.path.abspath(self.path))
+        self._segmentIndices[(ranking, segment)] = token_index
+      return token_index
+
+  def _segment_names(self, retired : bool = True):
+    # Returns the names of the segments (including retired ones, unless
+    # retired is False), as of a single point in time (see compact).
+    if self.segments is None:
+      return ['']
+    with self._segmentLock:
+      return self.segments['names'] + (self.segments['retired'] if retired else [])
+
+  def _save_segments(self, c, segments : dict):
+    # The segments are stored in the database (metadata.json only has a copy),
+    # so they change in the same transaction as the tables and tombstones they
+    # describe. Doesn't commit.
+    c.execute("INSERT OR REPLACE INTO segments (id, data) VALUES (0, ?)", (json.dumps(segments),))
+
+  def _fresh_segment(self):
+    # Returns the segment new postings are written to, creating it if needed.
+    # Must be called before anything else is written, since it commits.
+    if self.segments is None:
+      return ''
+    if self.segments['fresh'] is None:
+      name = f"seg{self.segments['next_id']}"
+      self.segments['next_id'] += 1
+      for token_index in self.token_indices:
+        TokenIndex.create_table(self.ctx, f"tokens_{token_index.name}_{name}", without_rowid = True)
+      self._save_segments(self.ctx, dict(self.segments, names = self.segments['names'] + [name], fresh = name))
+      self.conn.commit()
+      with self._segmentLock:
+        self._tombstones[name] = DocidSet()
+        self.segments['names'].append(name)
+      self.segments['fresh'] = name
+      self._freshSize = 0
+      self.save()
+    return self.segments['fresh']
+
+  def _wrote_to_fresh(self, numDocs : int):
+    # Seals the fresh segment once it is full.
+    if self.segments is None or self.segments['fresh'] is None:
+      return
+    self._freshSize += numDocs
+    if self._freshSize >= self.segments['segment_size']:
+      self.segments['fresh'] = None
+      self._save_segments(self.ctx, self.segments)
+      self.conn.commit()
+      self.save()
+
+  def _add_tombstone(self, segment : str, docid : int):
+    self.ctx.execute("INSERT OR IGNORE INTO tombstones (segment, doc_id) VALUES (?, ?)", (segment, docid))
+    self._tombstones.setdefault(segment, DocidSet()).add(docid)
+
+  def _rewrite_postings(self, docid : int, segment : str, oldTokens : [int], newTokens : [int], oldRankings : dict, newRankings : dict):
+    # Moves a document's postings to the fresh segment (or rewrites them, if
+    # they are already there). Returns whether the document was moved.
+    self.ctx.execute("SELECT segment FROM document_segments WHERE doc_id = ?", (docid,))
+    oldSegment = self.ctx.fetchone()[0]
+    for token_index in self.token_indices:
+      oldRank = int(oldRankings[token_index.name])
+      newRank = int(newRankings[token_index.name])
+      token_index = self._segment_index(token_index.name, segment)
+      if oldSegment == segment:
+        token_index.delete_many(self.ctx, [(oldRank, docid, token) for token in [0] + oldTokens])
+      token_index.insert_many(self.ctx, [(newRank, docid, token) for token in [0] + newTokens])
+    if oldSegment == segment:
+      return False
+    self._add_tombstone(oldSegment, docid)
+    self.ctx.execute("UPDATE document_segments SET segment = ? WHERE doc_id = ?", (segment, docid))
+    return True
+
+  def compact(self, full : bool = False, conn : sqlite3.Connection = None):
+    """
+    Merges the segments of a segmented index into one, dropping the postings
+    of deleted documents. The fresh segment is sealed first. Segments are
+    merged into the base segment if full is True or if they hold at least
+    half as many documents as it does, and into a new segment otherwise.
+
+    Postings are read without blocking writes (which go to a new fresh
+    segment) or queries, and written in chunks, each while holding the write
+    lock, so writes are only blocked for one chunk at a time and never
+    interleave with the merge's transactions. Merged segments are only
+    dropped by the next compaction, so nodes created before a compaction can
+    still be used until then.
+
+    conn, if given, is used instead of the index's connection (see
+    Compactor).
+    """
+    assert self.segments is not None, 'compact needs a segmented index'
+    if conn is None:
+      conn = self.conn
+    c = conn.cursor()
+    with self._writeLock:
+      for name in self.segments['retired']:
+        for token_index in self.token_indices:
+          c.execute(f"DROP TABLE IF EXISTS tokens_{token_index.name}_{name}")
+
+      merging = [name for name in self.segments['names'] if name != '']
+      c.execute("SELECT segment, COUNT(*) FROM document_segments GROUP BY segment")
+      sizes = dict(c.fetchall())
+      if full or sum(sizes.get(name, 0) for name in merging) * 2 >= sizes.get('', 0):
+        merging.insert(0, '')
+        target = ''
+      elif len(merging) > 1:
+        target = f"seg{self.segments['next_id']}"
+        self.segments['next_id'] += 1
+      else:
+        merging = []
+      self._save_segments(c, dict(self.segments, retired = [], fresh = None))
+      conn.commit()
+
+      with self._segmentLock:
+        for name in self.segments['retired']:
+          for token_index in self.token_indices:
+            token_index = self._segmentIndices.pop((token_index.name, name), None)
+            if token_index is not None and token_index.cache is not None:
+              token_index.cache.invalidate_table(token_index.namespace, token_index.name)
+          self._tombstones.pop(name, None)
+        self.segments['retired'] = []
+      self.segments['fresh'] = None
+      self.save()
+      if len(merging) == 0:
+        return
+      deleted = { name: set(self._tombstones.get(name, ())) for name in merging }
+
+    # Sealed segments are never written to, so they can be read without
+    # holding the lock. Writes made through conn take it, so they can't
+    # interleave with the index's write transactions.
+    newTables = []
     for token_index in self.token_indices:
-      rank = int(rankings[token_index.name])
-      for token in addedTokens:
-        token_index.insert(self.ctx, rank, docid, token2int[token])
-      for token in deletedTokens:
-        token_index.delete(self.ctx, docid, token2int[token])
+      newTable = f"tokens_{token_index.name}_{target or 'base'}_merge"
+      newTables.append(newTable)
+      with self._writeLock:
+        c.execute(f"DROP TABLE IF EXISTS {newTable}")
+        TokenIndex.create_table(c, newTable, without_rowid = True)
+        conn.commit()
+      merged = heapq.merge(*[
+        _without(self._segment_index(token_index.name, name).postings(conn.cursor()), deleted[name])
+        for name in merging
+      ])
+      while True:
+        chunk = list(itertools.islice(merged, kCompactionChunkSize))
+        if len(chunk) == 0:
+          break
+        # Commit often, so writers aren't blocked for long.
+        with self._writeLock:
+          c.executemany(f"INSERT INTO {newTable} (token, rank, doc_id) VALUES (?, ?, ?)", chunk)
+          conn.commit()
 
-    self.ctx.execute("UPDATE documents SET data = ? WHERE rowid = ?", (json.dumps(doc), docid))
+    with self._writeLock:
+      for token_index, newTable in zip(self.token_indices, newTables):
+        if target == '':
+          c.execute(f"DROP TABLE {token_index.tableName}")
+        c.execute(f"ALTER TABLE {newTable} RENAME TO {self._segment_index(token_index.name, target).tableName}")
+      params = ','.join('?' * len(merging))
+      c.execute(f"UPDATE document_segments SET segment = ? WHERE segment IN ({params})", [target] + merging)
+      # Documents deleted (or moved) while merging are still in the target.
+      newlyDeleted = DocidSet()
+      for name in merging:
+        newlyDeleted.update(docid for docid in self._tombstones.get(name, ()) if docid not in deleted[name])
+      c.execute(f"DELETE FROM tombstones WHERE segment IN ({params})", merging)
+      c.executemany("INSERT INTO tombstones (segment, doc_id) VALUES (?, ?)", ((target, docid) for docid in newlyDeleted))
+      names = [name for name in self.segments['names'] if name not in merging and name != '']
+      names = [''] + ([] if target == '' else [target]) + names
+      retired = [name for name in merging if name != '']
+      # The new segments are committed with the tables and tombstones they
+      # describe, so a crash never leaves them out of sync.
+      self._save_segments(c, dict(self.segments, names = names, retired = retired))
+      conn.commit()
+      if target == '':
+        for token_index in self.token_indices:
+          if token_index.cache is not None:
+            token_index.cache.invalidate_table(token_index.namespace, token_index.name)
 
+      # Readers see either the old segments or the new ones (see
+      # _segment_names), never a mix.
+      with self._segmentLock:
+        self._tombstones[target] = newlyDeleted
+        self.segments['names'] = names
+        self.segments['retired'] = retired
+      self.save()
+
+  def _commit(self):
+    # Every commit that changes documents bumps the write version, so that
+    # readers can tell this Index's writes from other writers' (see
+    # _check_filters).
+    self.ctx.execute("UPDATE write_version SET version = version + 1")
+    self.ctx.execute("SELECT version FROM write_version")
+    version = self.ctx.fetchone()[0]
     self.conn.commit()
+    self._ownVersions.append(version)
+    for token_index in self.token_indices:
+      token_index.committed()
+    with self._segmentLock:
+      segmentIndices = list(self._segmentIndices.values())
+    for token_index in segmentIndices:
+      token_index.committed()
+
+  def _invalidate_results(self, tokens):
+    # Every document has the token "", which queries without (non-negated)
+    # tokens depend on.
+    if self.result_cache is not None:
+      self.result_cache.invalidate(os.path.abspath(self.path), itertools.chain([''], tokens))
+
+  def _update_filters(self, docid : int, tokens : [int], add : bool):
+    if self.filter_cache is not None:
+      namespace = os.path.abspath(self.path)
+      for token in tokens:
+        if add:
+          self.filter_cache.add(namespace, token, docid)
+        else:
+          self.filter_cache.discard(namespace, token, docid)
+
+  def _check_filters(self, c):
+    # Writes made by other writers (other processes, connections or Index
+    # objects) don't update the filter cache, so its sets of this index are
+    # dropped whenever the write version has been bumped by anyone else since
+    # the last check. The first check always drops them.
+    c.execute("SELECT version FROM write_version")
+    version = c.fetchone()[0]
+    with self._filterLock:
+      last = self._filterVersion
+      if last is not None and version <= last:
+        return
+      if last is None or sum(1 for v in list(self._ownVersions) if last < v <= version) != version - last:
+        self.filter_cache.invalidate_namespace(os.path.abspath(self.path))
+      self._filterVersion = version
+
+  def _filter_set(self, token : int):
+    # Returns the DocidSet of documents that contain token (see FilterNode).
+    c = self._read_cursor()
+    self._check_filters(c)
+    key = (os.path.abspath(self.path), token)
+    docids = self.filter_cache.get(key)
+    if docids is not None:
+      return docids
+    generation = self.filter_cache.generation()
+    docids = DocidSet()
+    # Retired segments' postings were merged into another segment, and their
+    # tombstones aren't updated any more.
+    for name in self._segment_names(retired = False):
+      # Skip the postings of documents moved out of (or deleted from) a segment.
+      tombstones = self._tombstones.get(name, ())
+      c.execute(f"SELECT doc_id FROM {self._segment_index(self.token_indices[0].name, name).tableName} WHERE token = ?", (token,))
+      docids.update(docid for docid, in c.fetchall() if docid not in tombstones)
+    self.filter_cache.put(key, docids, generation)
+    return docids
+
+  def _read_cursor(self):
+    # Queries get their own cursor, from the thread's pooled connection if
+    # concurrent_reads is enabled (see __init__).
+    if self.read_pool is None:
+      return self.conn.cursor()
+    return self.read_pool.cursor()
 
   def fetch(self, docid):
-    self.ctx.execute("SELECT data FROM documents WHERE rowid = ?", (docid,))
-    return json.loads(self.ctx.fetchone()[0])
+    c = self._read_cursor()
+    if docid in self._deleted:
+      return None
+    c.execute("SELECT data FROM documents WHERE rowid = ?", (docid,))
+    return self.codec.decode(c.fetchone()[0])
+
+  def _document_row(self, doc : dict):
+    return (self.codec.encode(doc),) + tuple(json.dumps(doc.get(field)) for field in self.fields)
+
+  def fetch_many(self, docids : [int], fields : [str] = None):
+    """
+    Returns the documents with the given docids (in the same order), using a
+    single SELECT.
+
+    If fields is given, only those top-level keys are returned (missing keys
+    are None). Fields stored in their own columns (see create) are read
+    directly. Otherwise, JSON documents are projected by SQLite, and other
+    codecs fall back to decoding whole documents.
+    """
+    if fields is not None:
+      for field in fields:
+        if not isinstance(field, str):
+          raise ValueError(f"Fields must be strings, not {field!r}")
+    # Parameters bound by the columns, ahead of the docids.
+    paths = []
+    if fields is None:
+      columns = ['data']
+      decode = lambda row: self.codec.decode(row[0])
+    elif all(field in self.fields for field in fields):
+      columns = [f"field_{field}" for field in fields]
+      decode = lambda row: { field: json.loads(value) for field, value in zip(fields, row) }
+    elif self.codec.spec == 'json' and sqlite3.sqlite_version_info >= (3, 38, 0) and not any('"' in field for field in fields):
+      # SQLite's JSON paths can't escape a '"' in a key, so those fields are
+      # read by decoding whole documents (below).
+      columns = ['data -> ?'] * len(fields)
+      paths = [f'$."{field}"' for field in fields]
+      decode = lambda row: { field: None if value is None else json.loads(value) for field, value in zip(fields, row) }
+    else:
+      columns = ['data']
+      def decode(row):
+        doc = self.codec.decode(row[0])
+        return { field: doc.get(field) for field in fields }
+
+    c = self._read_cursor()
+    docs = {}
+    docids = list(docids)
+    for i in range(0, len(docids), kMaxVariables):
+      chunk = docids[i:i + kMaxVariables]
+      c.execute(f"SELECT rowid, {', '.join(columns)} FROM documents WHERE rowid IN ({','.join('?' * len(chunk))})", paths + chunk)
+      for row in c.fetchall():
+        if row[0] not in self._deleted:
+          docs[row[0]] = decode(row[1:])
+    return [None if docid in self._deleted else docs[docid] for docid in docids]
+
+  def search(self, expr, ranking : str, k : int, offset : int = 0, descending : bool = False, fields : [str] = None):
+    """
+    Returns the (rank, docid, document) tuples of the k best matches of expr
+    (a node, such as one returned by intersect), skipping the first offset.
+    Matches are sorted from low to high rank, unless descending is True (or
+    ranking starts with a "-").
+
+    The node tree is only advanced until k + offset matches are found, and
+    the documents (or just the given fields, see fetch_many) are fetched with
+    a single SELECT.
+    """
+    hits, _ = self._traverse(expr, self.expression_context(ranking, descending), k, offset)
+    docs = self.fetch_many((docid for _, docid in hits), fields)
+    return [(rank, docid, doc) for (rank, docid), doc in zip(hits, docs)]
+
+  def cached_search(self, tags : list, ranking : str, k : int, offset : int = 0, descending : bool = False, fields : [str] = None, invert : list = None):
+    """
+    Same as search(intersect(*tags, invert=invert, ranking=ranking), ...), but
+    the page of (rank, docid) hits is cached in the index's result cache (if
+    it has one, see __init__). Documents are always fetched.
+    """
+    if ranking.startswith('-'):
+      ranking = ranking[1:]
+      descending = not descending
+    tags = list(tags)
+    if invert is None:
+      invert = [False] * len(tags)
+    if self.result_cache is None:
+      hits = self._hits(tags, invert, ranking, k, offset, descending)
+    else:
+      key = (os.path.abspath(self.path), query_key(tags, invert), ranking, descending, offset, k)
+      hits = self.result_cache.get(key)
+      if hits is None:
+        generation = self.result_cache.generation()
+        hits = self._hits(tags, invert, ranking, k, offset, descending)
+        tokens = set(tag for tag, neg in zip(tags, invert) if isinstance(tag, str) and not neg)
+        self.result_cache.put(key, hits, tokens or [''], generation)
+    docs = self.fetch_many((docid for _, docid in hits), fields)
+    return [(rank, docid, doc) for (rank, docid), doc in zip(hits, docs)]
+
+  def explain(self, expr, ranking : str, descending : bool = False, k : int = None):
+    """
+    Evaluates expr (until its first k matches, or all of them) with a
+    Profiler, and prints its node tree with every node's estimated number of
+    matches (from token counts), calls to next, SELECTs, rows, posting cache
+    hits and time. Returns the Profiler. expr is instrumented in place.
+    """
+    profiler = Profiler()
+    profiler.instrument(expr)
+    ctx = profiler.context(self.expression_context(ranking, descending))
+    numResults = len(self._traverse(expr, ctx, k)[0])
+
+    tokens, stack = set(), [expr]
+    while len(stack) > 0:
+      node = stack.pop()
+      if isinstance(getattr(node, 'token', None), int):
+        tokens.add(node.token)
+      stack += [child for child, _ in profiler_children(node)]
+    names = { 0: '' }
+    for token in tokens - {0}:
+      ctx.c.execute("SELECT token_str FROM tokens WHERE rowid = ?", (token,))
+      row = ctx.c.fetchone()
+      if row is not None:
+        names[token] = row[0]
+    print(profiler.report(expr, ctx, names))
+    print(f"{numResults} results")
+    return profiler
+
+  def scored_search(self, tokens : [str], k : int, prior_weight : float = 1.0, fields : [str] = None, method : str = 'block_max_wand'):
+    """
+    Returns the (score, docid, document) tuples of the k documents with the
+    highest scores among those that have any of the tokens (an Or query),
+    from high to low (ties go to lower docids). Requires a scored index
+    (see create). A document's score is
+
+      sum(idf(token) * weight(token)) + prior_weight * prior
+
+    over the tokens it has, where weights and priors come from doc2weights
+    and doc2prior, and idf(token) = log(1 + (N - n + 0.5) / (n + 0.5)) for a
+    token in n of the N documents.
+
+    method is "block_max_wand" (the default), "wand" or "exhaustive" (which
+    scores every matching document). WAND skips documents whose upper bound
+    (from every token's largest weight) can't make the top k, and block-max
+    WAND also skips blocks of docids using per-block largest weights.
+    """
+    assert self.score_index is not None, 'scored_search needs an index created with scored=True'
+    assert method in ('block_max_wand', 'wand', 'exhaustive'), f"Unknown method \"{method}\""
+    assert prior_weight >= 0, 'prior_weight must be non-negative'
+    c = self._read_cursor()
+    # Docids are never reused, so this is the number of documents.
+    c.execute("SELECT COALESCE(MAX(rowid), 0) FROM documents")
+    numDocs = c.fetchone()[0] - len(self._deleted)
+    token2int = self.token_mapper.lookup_many(dict.fromkeys(tokens), c)
+    token2int.pop('', None)
+    counts = {}
+    if len(token2int) > 0:
+      c.execute(f"SELECT rowid, count FROM tokens WHERE rowid IN ({','.join('?' * len(token2int))})", list(token2int.values()))
+      counts = dict(c.fetchall())
+    lists = []
+    for order, token in enumerate(token2int.values()):
+      # Counts include deleted documents until they're vacuumed.
+      n = min(counts[token], numDocs)
+      idf = math.log(1 + (numDocs - n + 0.5) / (n + 0.5))
+      lists.append(ScoredList(c, self.score_index, token, idf, order))
+    prior = None
+    if prior_weight != 0:
+      prior = ScoredList(c, self.score_index, 0, prior_weight)
+
+    if method == 'exhaustive':
+      hits = exhaustive_top_k(lists, k, prior, self._deleted)
+    else:
+      hits = top_k(lists, k, prior, self._deleted, block_max = method == 'block_max_wand')
+    docs = self.fetch_many((docid for _, docid in hits), fields)
+    return [(score, docid, doc) for (score, docid), doc in zip(hits, docs)]
 
-  def intersect(self, *tags, invert=None):
+  def _hits(self, tags, invert, ranking, k, offset, descending):
+    node = self.intersect(*tags, invert = invert, ranking = ranking)
+    return self._traverse(node, self.expression_context(ranking, descending), k, offset)[0]
+
+  def _traverse(self, expr, ctx, k : int = None, offset : int = 0, x = None):
+    # Advances expr from x (or from the start, if x is None) until it has
+    # yielded offset + k more matches (or all of them, if k is None). Returns
+    # the (rank, docid) of the last k of them, and the position to continue
+    # from, which is None once expr is exhausted.
+    if x is None:
+      x = ctx.first
+    hits = []
+    while k is None or len(hits) < offset + k:
+      x = expr.next(ctx, x)
+      if x == ctx.last:
+        return hits[offset:], None
+      hits.append(ctx.decode(x))
+    return hits[offset:], x
+
+  def intersect(self, *tags, invert=None, token_node=AdaptiveTokenNode, ranking=None):
+    """
+    Returns a node that yields the documents matching every tag. A tag is
+    either a token or a range predicate like ("depth", "<", 4), where the
+    operator is one of <, <=, > and >=. Any tag can be negated via invert.
+
+    If the node will be used with ranking, predicates on the ranking itself
+    are applied as bounds on the traversal instead of with range tokens.
+    """
+    return self._segmented(lambda: self._intersect(*tags, invert=invert, token_node=token_node, ranking=ranking))
+
+  def _segmented(self, make_node):
+    # Returns make_node() wrapped so that it skips deleted documents, or, for
+    # segmented indices, an Or of one tree per segment.
+    if self.segments is None:
+      node = make_node()
+      if len(self._tombstones['']) > 0 and not isinstance(node, EmptyNode):
+        node = SegmentNode(node, '')
+      return node
+    nodes = []
+    for name in self._segment_names(retired = False):
+      node = make_node()
+      if isinstance(node, EmptyNode):
+        return node
+      nodes.append((SegmentNode(node, name), False))
+    if len(nodes) == 1:
+      return nodes[0][0]
+    return HeapOrNode(nodes)
+
+  def query(self, query : str, ranking : str = None, token_node = AdaptiveTokenNode):
+    """
+    Returns a node that yields the documents matching a query string, such
+    as "foo (bar OR baz) -qux score:[3 TO 10]" (see query_parser.parse). As
+    with intersect, predicates on ranking are applied as bounds on the
+    traversal; predicates on other names need a range (see add_range).
+
+    Plans (parsed queries, with their tokens resolved to ids) are cached in
+    self.plan_cache, so repeated queries need no parsing or token lookups.
+    Plans of queries with unknown tokens are rebuilt once new tokens exist.
+    """
+    if ranking is not None:
+      ranking = ranking.lstrip('-')
+    key = (normalize(query), ranking)
+    entry = self.plan_cache.get(key)
+    if entry is not None and entry[1] is not None and entry[1] != self._max_token():
+      entry = None
+    if entry is None:
+      maxToken = self._max_token()
+      plan, complete = self._plan(parse(query), ranking)
+      entry = (plan, None if complete else maxToken)
+      self.plan_cache.put(key, entry)
+    plan = entry[0]
+    return self._segmented(lambda: self._compile(plan, token_node))
+
+  def _max_token(self):
+    # Tokens are never deleted, so this only changes when tokens are added.
+    c = self._read_cursor()
+    c.execute("SELECT COALESCE(MAX(rowid), 0) FROM tokens")
+    return c.fetchone()[0]
+
+  def _plan(self, tree, ranking : str):
+    # Resolves a parsed query into a plan of tuples:
+    #   ('token', token), ('filter', token), ('all',), ('empty',), ('rank', low, high),
+    #   ('or', [plan, ...]) and ('and', [(plan, negated), ...], low, high),
+    # where ('all',) matches every document and and-nodes are restricted to
+    # ranks in [low, high]. Also returns whether every token was found.
+    def bounds(node):
+      _, name, low, lowInclusive, high, highInclusive = node
+      low = None if low is None else range_bounds('>=' if lowInclusive else '>', low)[0]
+      high = None if high is None else range_bounds('<=' if highInclusive else '<', high)[1]
+      return low, high
+
+    def range_tokens(node):
+      low, high = bounds(node)
+      intRange = self.ranges[node[1]]
+      return intRange.range(intRange.low if low is None else low, intRange.high if high is None else high)
+
+    strs = []
+    stack = [tree]
+    while len(stack) > 0:
+      node = stack.pop()
+      if node[0] == 'tag':
+        strs.append(node[1])
+      elif node[0] == 'range':
+        if node[1] != ranking:
+          if node[1] not in self.ranges:
+            raise ValueError(f"Unknown range \"{node[1]}\"")
+          strs += range_tokens(node)
+      elif node[0] == 'not':
+        stack.append(node[1])
+      else:
+        stack += node[1]
+    token2int = self.token_mapper.lookup_many(strs, self._read_cursor())
+    complete = all(t in token2int for t in strs)
+
+    def resolve(node):
+      if node[0] == 'tag':
+        if node[1] not in token2int:
+          return ('empty',)
+        return ('filter' if self.is_filter(node[1]) else 'token', token2int[node[1]])
+      if node[0] == 'range':
+        if node[1] == ranking:
+          return resolve_and([(node, False)])
+        tokens = [('token', token2int[t]) for t in range_tokens(node) if t in token2int]
+        if len(tokens) == 0:
+          return ('empty',)
+        return tokens[0] if len(tokens) == 1 else ('or', tokens)
+      if node[0] == 'not':
+        return resolve_and([(node, False)])
+      if node[0] == 'and':
+        return resolve_and([(child, False) for child in node[1]])
+      children = [resolve(child) for child in node[1]]
+      children = [child for child in children if child[0] != 'empty']
+      if len(children) == 0:
+        return ('empty',)
+      return children[0] if len(children) == 1 else ('or', children)
+
+    def resolve_and(children):
+      rankLow, rankHigh = None, None
+      plans = []
+      for child, neg in children:
+        while child[0] == 'not':
+          child, neg = child[1], not neg
+        if child[0] == 'range' and child[1] == ranking and (not neg or child[2] is None or child[4] is None):
+          # Predicates on the ranking bound the traversal, like in intersect.
+          low, high = bounds(child)
+          if neg and low is None and high is None:
+            return ('empty',)
+          if neg:
+            low, high = (None, low - 1) if low is not None else (high + 1, None)
+          if low is not None:
+            rankLow = low if rankLow is None else max(rankLow, low)
+          if high is not None:
+            rankHigh = high if rankHigh is None else min(rankHigh, high)
+          continue
+        if child[0] == 'range' and child[1] == ranking:
+          plan = ('rank',) + bounds(child)
+        else:
+          plan = resolve(child)
+        if plan[0] == 'empty':
+          if neg:
+            continue
+          return plan
+        plans.append((plan, neg))
+      if rankLow is not None and rankHigh is not None and rankLow > rankHigh:
+        return ('empty',)
+      if all(neg for _, neg in plans):
+        plans.append((('all',), False))
+      if len(plans) == 1 and rankLow is None and rankHigh is None:
+        return plans[0][0]
+      return ('and', plans, rankLow, rankHigh)
+
+    return resolve(tree), complete
+
+  def _compile(self, plan, token_node):
+    # Builds a new node tree from a plan (see _plan).
+    if plan[0] == 'token':
+      return token_node(plan[1])
+    if plan[0] == 'filter':
+      return FilterNode(plan[1])
+    if plan[0] == 'all':
+      return token_node(0)
+    if plan[0] == 'empty':
+      return EmptyNode()
+    if plan[0] == 'rank':
+      return RankRangeNode(token_node(0), plan[1], plan[2])
+    if plan[0] == 'or':
+      return HeapOrNode([(self._compile(child, token_node), False) for child in plan[1]])
+    _, children, low, high = plan
+    if len(children) == 1:
+      node = self._compile(children[0][0], token_node)
+    else:
+      node = AndNode([(self._compile(child, token_node), neg) for child, neg in children])
+    if low is not None or high is not None:
+      node = RankRangeNode(node, low, high)
+    return node
+
+  def _intersect(self, *tags, invert=None, token_node=AdaptiveTokenNode, ranking=None):
     if invert is not None:
       assert isinstance(invert, list) or isinstance(invert, tuple)
       assert len(invert) == len(tags)
     else:
       invert = [False] * len(tags)
+    if ranking is not None:
+      ranking = ranking.lstrip('-')
+    c = self._read_cursor()
 
     token_nodes = []
     range_tokens = []
+    rank_low, rank_high = None, None
     for neg, tag in zip(invert, tags):
       if isinstance(tag, str):
-        if self.token_mapper.exists(tag, self.ctx):
-          token_nodes.append((TokenNode(self.token_mapper(tag, self.ctx)), neg))
+        if self.token_mapper.exists(tag, c):
+          node_class = FilterNode if self.is_filter(tag) else token_node
+          token_nodes.append((node_class(self.token_mapper(tag, c)), neg))
           continue
         elif neg:
           # Skip non-existent, negated tokens.
@@ -201,37 +1240,48 @@ class Index:
           # A non-existent token automatically implies 0 results.
           return EmptyNode()
       range_name, op, value = tag
-      assert neg is False # todo: support negated range queries?
-      assert op in ['>', '<']
-      if op == '<':
-        T = self.ranges[range_name].less_than(value)
-      else:
-        T = self.ranges[range_name].greater_than(value)
+      # Negated ranges are turned into the complementary range.
+      low, high = range_bounds(op, value, neg)
+      if range_name == ranking:
+        if low is not None:
+          rank_low = low if rank_low is None else max(rank_low, low)
+        if high is not None:
+          rank_high = high if rank_high is None else min(rank_high, high)
+        continue
+      intRange = self.ranges[range_name]
+      T = intRange.range(intRange.low if low is None else low, intRange.high if high is None else high)
       range_tokens.append([])
       for t in T:
-        if self.token_mapper.exists(t, self.ctx):
-          range_tokens[-1].append(self.token_mapper(t, self.ctx))
+        if self.token_mapper.exists(t, c):
+          range_tokens[-1].append(self.token_mapper(t, c))
+
+    if rank_low is not None and rank_high is not None and rank_low > rank_high:
+      return EmptyNode()
 
     range_nodes = []
     for tokens in range_tokens:
       if len(tokens) == 0:
         return EmptyNode()
-      T = [(TokenNode(token), False) for token in tokens]
+      T = [(token_node(token), False) for token in tokens]
       if len(T) == 1:
         range_nodes.append(T[0][0])
       else:
-        range_nodes.append(OrNode(T))
+        range_nodes.append(HeapOrNode(T))
 
     all_nodes = token_nodes + [ (node, False) for node in range_nodes ]
 
     if sum(x[1] for x in all_nodes) == len(all_nodes):
       # all nodes are inverted
-      all_nodes.append((TokenNode(0), False))
+      all_nodes.append((token_node(0), False))
 
     if len(all_nodes) == 1:
       assert not all_nodes[0][1]
-      return all_nodes[0][0]
-    return AndNode(all_nodes)
+      node = all_nodes[0][0]
+    else:
+      node = AndNode(all_nodes)
+    if rank_low is not None or rank_high is not None:
+      node = RankRangeNode(node, rank_low, rank_high)
+    return node
 
   def save(self):
     ranges = {}
@@ -240,35 +1290,187 @@ class Index:
     with open(os.path.join(self.path, 'metadata.json'), 'w+') as f:
       json.dump({
         'token_indices': [ti.json() for ti in self.token_indices],
-        'token_mapper': {},
+        'token_mapper': { 'pair_counts': self.pair_counts },
         'ranges': ranges,
+        'codec': self.codec.json(),
+        'fields': self.fields,
+        'segments': self.segments,
+        'scored': self.score_index is not None,
       }, f, indent=2)
 
-  def add_range(self, name, low, high):
-    self.ranges[name] = IntRange(name, low, high)
+  def add_range(self, name, low, high, branching_factor = 2):
+    self.ranges[name] = IntRange(name, low, high, branching_factor)
 
   def token_search(self, query : str):
-    return self.token_mapper.search(query, self.ctx)
+    return self.token_mapper.search(query, self._read_cursor())
 
-  def expression_context(self, ranking : str):
+  def expression_context(self, ranking : str, descending : bool = False):
+    # A ranking of "-score" is the same as "score" with descending = True.
+    if ranking.startswith('-'):
+      ranking = ranking[1:]
+      descending = not descending
     index = [i for i in self.token_indices if i.name == ranking]
     assert len(index) == 1
+    segments = {
+      name: (self._segment_index(ranking, name), self._tombstones.get(name, frozenset()))
+      for name in self._segment_names()
+    }
     return ExpressionContext(
-      self.ctx,
+      self._read_cursor(),
       r = 1,
       pageLength = 1000,
       index = index[0],
+      pair_counts = self.pair_counts,
+      descending = descending,
+      segments = segments,
+      filters = None if self.filter_cache is None else self._filter_set,
     )
 
-  def __init__(self, conn, path):
+  def _load_codec(self, data):
+    dictionary = None
+    if data.get('dictionary', False):
+      self.ctx.execute("SELECT data FROM codec_dictionary")
+      dictionary = self.ctx.fetchone()[0]
+    return DocumentCodec(data['spec'], data['level'], dictionary)
+
+  def train_codec_dictionary(self, num_samples : int = 1000, size : int = 64 * 1024):
+    """
+    Trains a zstd dictionary on a random sample of documents and re-encodes
+    every document with it. This usually compresses small documents much
+    better than compressing each one on its own. Requires a "+zstd" codec.
+    """
+    assert self.codec.compression == 'zstd', 'Only zstd supports dictionaries'
+    with self._writeLock:
+      # Vacuumed documents' data is NULL (see vacuum_deleted).
+      self.ctx.execute("SELECT data FROM documents WHERE data IS NOT NULL ORDER BY RANDOM() LIMIT ?", (num_samples,))
+      samples = [self.codec.decode(row[0]) for row in self.ctx.fetchall()]
+      dictionary = DocumentCodec.train_dictionary(samples, self.codec.spec, size)
+      codec = DocumentCodec(self.codec.spec, self.codec.level, dictionary)
+
+      self.ctx.execute("CREATE TABLE IF NOT EXISTS codec_dictionary (data BLOB)")
+      self.ctx.execute("DELETE FROM codec_dictionary")
+      self.ctx.execute("INSERT INTO codec_dictionary (data) VALUES (?)", (dictionary,))
+      rows = self.conn.execute("SELECT rowid, data FROM documents WHERE data IS NOT NULL")
+      self.ctx.executemany("UPDATE documents SET data = ? WHERE rowid = ?", (
+        (codec.encode(self.codec.decode(data)), docid) for docid, data in rows.fetchall()
+      ))
+      self.conn.commit()
+      self.codec = codec
+      self.save()
+
+  def cache_stats(self):
+    """
+    Returns the hit, miss and eviction counters (and size) of the posting
+    cache this index uses, or None if it has none.
+    """
+    if self.posting_cache is None:
+      return None
+    return self.posting_cache.stats()
+
+  def result_cache_stats(self):
+    """
+    Returns the hit rate, counters and size (in bytes) of the index's result
+    cache, or None if it has none.
+    """
+    if self.result_cache is None:
+      return None
+    return self.result_cache.stats()
+
+  def __init__(self, conn, path, posting_cache : PostingCache = None, in_memory_tokens : bool = False, concurrent_reads : bool = False, result_cache : ResultCache = None, filter_cache : FilterCache = None):
+    # If a posting_cache is given (e.g. kPostingCache, which can be shared by
+    # every Index in the process), pages of postings are cached in it. Writes
+    # made through Index objects that share the cache invalidate it, but it
+    # has no way to notice writes made through other connections, so queries
+    # return stale results while other writers (e.g. processes) are active.
+    #
+    # If in_memory_tokens is True, the tokens table is loaded into memory (see
+    # TokenMapper), which makes token lookups and token_search much faster.
+    #
+    # If concurrent_reads is True, the database is switched to WAL mode and
+    # queries (search, fetch, intersect, ...) run on a read-only connection
+    # per thread, so they can be made from any number of threads at once.
+    # conn is still used for writes, which must all be made from one thread,
+    # and must be opened on a database file. Queries only see committed data.
+    #
+    # If a result_cache is given, cached_search caches pages of hits in it.
+    # Writes made through this Index invalidate the pages they may change,
+    # but writes made by other processes don't, so the cache should have a
+    # ttl if there are any.
+    #
+    # If a filter_cache is given, FilterNodes (see is_filter) inside And
+    # queries are checked against cached sets of docids. Writes made through
+    # this Index update the cached sets, and writes made by any other writer
+    # (e.g. another process, or another Index) drop them.
     with open(os.path.join(path, 'metadata.json'), 'r') as f:
       metadata = json.load(f)
     self.conn = conn
     self.ctx = self.conn.cursor()
     self.path = path
+    self.read_pool = None
+    if concurrent_reads:
+      self.conn.execute("PRAGMA journal_mode=WAL")
+      self.read_pool = ConnectionPool(database_file(conn))
     self.token_indices = [TokenIndex(**data) for data in metadata['token_indices']]
+    self.posting_cache = posting_cache
+    self.result_cache = result_cache
+    self.filter_cache = filter_cache
+    # The write version the filter cache was last checked at, and the
+    # versions of this Index's recent commits (see _check_filters).
+    self._filterVersion = None
+    self._filterLock = threading.Lock()
+    self._ownVersions = deque(maxlen = kMaxOwnVersions)
+    self.plan_cache = PlanCache()
+    self.score_index = ScoreIndex() if metadata.get('scored', False) else None
+    if posting_cache is not None:
+      for token_index in self.token_indices:
+        token_index.attach_cache(posting_cache, os.path.abspath(path))
     self.ranges = {}
     for k in metadata['ranges']:
       self.ranges[k] = IntRange(**metadata['ranges'][k])
-    self.token_mapper = TokenMapper(self.ctx)
+    self.token_mapper = TokenMapper(self.ctx, in_memory = in_memory_tokens)
+    self.pair_counts = metadata['token_mapper'].get('pair_counts', False)
+    self.codec = self._load_codec(metadata.get('codec', { 'spec': 'json', 'level': None }))
+    self.fields = metadata.get('fields', [])
+    self._documentColumns = ', '.join(['data'] + [f"field_{field}" for field in self.fields])
+    self._documentParams = ', '.join('?' * (1 + len(self.fields)))
+
+    # See create (segment_size) and compact. _writeLock is held by every
+    # write, so a Compactor can run in another thread. _segmentLock guards
+    # the segments' names, _segmentIndices and _tombstones' keys, so readers
+    # never see them half-swapped by compact.
+    self.segments = metadata.get('segments')
+    self._writeLock = threading.RLock()
+    self._segmentLock = threading.Lock()
+    self._segmentIndices = {}
+
+    # Tombstones hide the postings of deleted (and, in segmented indices,
+    # moved) documents from a segment, and deleted_documents is the set of
+    # deleted docids (see delete_document).
+    self.ctx.execute("CREATE TABLE IF NOT EXISTS tombstones (segment TEXT, doc_id INTEGER, PRIMARY KEY (segment, doc_id))")
+    self.ctx.execute("CREATE TABLE IF NOT EXISTS deleted_documents (doc_id INTEGER PRIMARY KEY, vacuumed INTEGER)")
+    # A counter bumped by every commit that changes documents (see _commit).
+    self.ctx.execute("CREATE TABLE IF NOT EXISTS write_version (version INTEGER)")
+    self.ctx.execute("INSERT INTO write_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM write_version)")
+    if self.segments is not None:
+      # The segments in the database are authoritative (see _save_segments).
+      # Indices created before they were stored there start storing them with
+      # their next write.
+      self.ctx.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, data TEXT)")
+      self.ctx.execute("SELECT data FROM segments WHERE id = 0")
+      row = self.ctx.fetchone()
+      if row is not None:
+        self.segments = json.loads(row[0])
+    self.conn.commit()
+    names = [''] if self.segments is None else self.segments['names'] + self.segments['retired']
+    self._tombstones = { name: DocidSet() for name in names }
+    self.ctx.execute("SELECT segment, doc_id FROM tombstones")
+    for segment, docid in self.ctx.fetchall():
+      self._tombstones.setdefault(segment, DocidSet()).add(docid)
+    self.ctx.execute("SELECT doc_id FROM deleted_documents")
+    self._deleted = DocidSet(row[0] for row in self.ctx.fetchall())
+    if self.segments is not None:
+      self._freshSize = 0
+      if self.segments['fresh'] is not None:
+        self.ctx.execute("SELECT COUNT(*) FROM document_segments WHERE segment = ?", (self.segments['fresh'],))
+        self._freshSize = self.ctx.fetchone()[0]
 
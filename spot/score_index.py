@@ -0,0 +1,74 @@
+import sqlite3
+
+# Postings are grouped into blocks of 2 ** kBlockBits consecutive docids,
+# and the largest weight of each token's postings in every block is stored
+# (see block_max_wand).
+kBlockBits = 10
+
+
+class ScoreIndex:
+  """
+  Manages the tables behind scored retrieval (see Index.scored_search): a
+  table of (token, doc_id, weight) postings, ordered by doc_id within each
+  token, and a table of the largest weight of each token in every block of
+  docids. Token 0 holds every document's prior.
+
+  Block maxima are only ever raised, so after postings are deleted (or
+  their weights lowered) they remain upper bounds, just looser ones.
+  """
+  @staticmethod
+  def create(c : sqlite3.Cursor):
+    c.execute("""CREATE TABLE scored_postings (
+      token INTEGER,
+      doc_id INTEGER,
+      weight REAL,
+      PRIMARY KEY (token, doc_id)
+    ) WITHOUT ROWID""")
+    c.execute("""CREATE TABLE scored_blocks (
+      token INTEGER,
+      block INTEGER,
+      max_weight REAL,
+      PRIMARY KEY (token, block)
+    ) WITHOUT ROWID""")
+
+  def insert_many(self, c : sqlite3.Cursor, rows : [tuple]):
+    """
+    Inserts a list of (token, doc_id, weight) tuples and raises the block
+    maxima they fall in.
+    """
+    blocks = {}
+    for token, doc_id, weight in rows:
+      assert weight >= 0, 'Weights and priors must be non-negative'
+      key = (token, doc_id >> kBlockBits)
+      blocks[key] = max(blocks.get(key, weight), weight)
+    c.executemany("INSERT INTO scored_postings (token, doc_id, weight) VALUES (?, ?, ?)", rows)
+    c.executemany("""
+      INSERT INTO scored_blocks (token, block, max_weight) VALUES (?, ?, ?)
+      ON CONFLICT (token, block) DO UPDATE SET max_weight = MAX(max_weight, excluded.max_weight)
+    """, ((token, block, weight) for (token, block), weight in blocks.items()))
+
+  def delete_many(self, c : sqlite3.Cursor, rows : [tuple]):
+    """
+    Deletes a list of (token, doc_id) tuples.
+    """
+    c.executemany("DELETE FROM scored_postings WHERE token = ? AND doc_id = ?", rows)
+
+  def postings(self, c : sqlite3.Cursor, token : int, doc_id : int, n : int):
+    """
+    Returns the first n (doc_id, weight) tuples of token with a doc_id of at
+    least doc_id.
+    """
+    c.execute("SELECT doc_id, weight FROM scored_postings WHERE token = ? AND doc_id >= ? ORDER BY doc_id LIMIT ?", (token, doc_id, n))
+    return c.fetchall()
+
+  def weight(self, c : sqlite3.Cursor, token : int, doc_id : int):
+    c.execute("SELECT weight FROM scored_postings WHERE token = ? AND doc_id = ?", (token, doc_id))
+    r = c.fetchone()
+    return 0.0 if r is None else r[0]
+
+  def blocks(self, c : sqlite3.Cursor, token : int):
+    """
+    Returns the (block, max weight) tuples of token, ordered by block.
+    """
+    c.execute("SELECT block, max_weight FROM scored_blocks WHERE token = ? ORDER BY block", (token,))
+    return c.fetchall()
@@ -0,0 +1,173 @@
+import heapq
+import json
+import os
+import sqlite3
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .retrieval import Index
+
+# Indices opened by this (worker) process, keyed by (class, shard path).
+_workerIndices = {}
+
+
+def _open_shard(index_class, path : str):
+  # Shards are reopened whenever their metadata changes (e.g. after
+  # add_range). The posting cache is disabled, since other processes write
+  # to the same shards.
+  mtime = os.stat(os.path.join(path, 'metadata.json')).st_mtime_ns
+  entry = _workerIndices.get((index_class, path))
+  if entry is None or entry[0] != mtime:
+    if entry is not None:
+      entry[1].conn.close()
+    conn = sqlite3.connect(os.path.join(path, 'db.sqlite'))
+    entry = (mtime, index_class(conn, path, posting_cache = None))
+    _workerIndices[(index_class, path)] = entry
+  return entry[1]
+
+
+def _insert_documents(index_class, path : str, docs : [dict]):
+  return _open_shard(index_class, path).insert_documents(docs)
+
+
+def _hits(index_class, path : str, tags : list, invert : list, ranking : str, limit : int, descending : bool):
+  index = _open_shard(index_class, path)
+  node = index.intersect(*tags, invert = invert, ranking = ranking)
+  return index._traverse(node, index.expression_context(ranking, descending), limit)[0]
+
+
+def _fetch_many(index_class, path : str, docids : [int], fields : [str]):
+  return _open_shard(index_class, path).fetch_many(docids, fields)
+
+
+class ShardedIndex:
+  """
+  Hash-partitions documents across num_shards Index shards (each in its own
+  SQLite file), so that inserts and queries can use one process per shard.
+
+  Queries are given as the arguments of Index.intersect, which is run on
+  every shard in a process pool, and the shards' results are combined with a
+  k-way merge. Docids are global: a document with docid d in shard s has the
+  global docid d * num_shards + s, which preserves the order of docids within
+  each shard, so results are sorted by (rank, global docid).
+
+  index_class (a subclass of Index, e.g. to override doc2tokens) must be
+  importable by the worker processes.
+  """
+  @classmethod
+  def create(cls, path : str, num_shards : int, rankings : [str] = [], index_class = Index, processes : int = None, **kwargs):
+    # kwargs are passed to Index.create.
+    assert num_shards > 0
+    os.makedirs(path, exist_ok = True)
+    for shard in range(num_shards):
+      shardPath = os.path.join(path, f"shard_{shard}")
+      os.makedirs(shardPath, exist_ok = True)
+      conn = sqlite3.connect(os.path.join(shardPath, 'db.sqlite'))
+      # WAL mode lets queries read a shard while another process writes to it.
+      conn.execute("PRAGMA journal_mode=WAL")
+      index_class.create(conn, shardPath, rankings, **kwargs)
+      conn.close()
+    with open(os.path.join(path, 'sharded.json'), 'w+') as f:
+      json.dump({ 'num_shards': num_shards }, f, indent=2)
+    return cls(path, index_class, processes)
+
+  def __init__(self, path : str, index_class = Index, processes : int = None):
+    with open(os.path.join(path, 'sharded.json'), 'r') as f:
+      metadata = json.load(f)
+    self.path = path
+    self.num_shards = metadata['num_shards']
+    self.index_class = index_class
+    self.shard_paths = [os.path.join(path, f"shard_{shard}") for shard in range(self.num_shards)]
+    self._pool = ProcessPoolExecutor(processes or min(self.num_shards, os.cpu_count()))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self._pool.shutdown()
+
+  def doc2shard(self, doc : dict):
+    # Subclass this to partition documents by some key.
+    return zlib.crc32(json.dumps(doc, sort_keys = True).encode()) % self.num_shards
+
+  def _map(self, fn, argsByShard : dict):
+    # Runs fn(index_class, shard path, *args) for every shard in argsByShard,
+    # in parallel, and returns a {shard: result} dict.
+    futures = {
+      shard: self._pool.submit(fn, self.index_class, self.shard_paths[shard], *args)
+      for shard, args in argsByShard.items()
+    }
+    return { shard: future.result() for shard, future in futures.items() }
+
+  def insert_documents(self, docs):
+    """
+    Inserts documents into their shards (in parallel) and returns their
+    global docids.
+    """
+    docs = list(docs)
+    shards = [self.doc2shard(doc) for doc in docs]
+    partitions = { shard: [] for shard in set(shards) }
+    for doc, shard in zip(docs, shards):
+      partitions[shard].append(doc)
+    localDocids = self._map(_insert_documents, { shard: (partition,) for shard, partition in partitions.items() })
+    iters = { shard: iter(docids) for shard, docids in localDocids.items() }
+    return [next(iters[shard]) * self.num_shards + shard for shard in shards]
+
+  def insert_document(self, doc : dict):
+    return self.insert_documents([doc])[0]
+
+  def hits(self, tags : list, ranking : str, limit : int = None, descending : bool = False, invert : list = None):
+    """
+    Returns the first limit (or all) (rank, global docid) tuples matching
+    Index.intersect(*tags, invert=invert), in ranked order.
+    """
+    tags = list(tags)
+    if ranking.startswith('-'):
+      ranking = ranking[1:]
+      descending = not descending
+    results = self._map(_hits, { shard: (tags, invert, ranking, limit, descending) for shard in range(self.num_shards) })
+    streams = [
+      [(rank, docid * self.num_shards + shard) for rank, docid in hits]
+      for shard, hits in results.items()
+    ]
+    if descending:
+      merged = heapq.merge(*streams, key = lambda hit: (-hit[0], -hit[1]))
+    else:
+      merged = heapq.merge(*streams)
+    return list(merged)[:limit]
+
+  def fetch_many(self, docids : [int], fields : [str] = None):
+    docids = list(docids)
+    byShard = {}
+    for docid in docids:
+      byShard.setdefault(docid % self.num_shards, []).append(docid // self.num_shards)
+    docs = self._map(_fetch_many, { shard: (local, fields) for shard, local in byShard.items() })
+    docs = {
+      local * self.num_shards + shard: doc
+      for shard in docs for local, doc in zip(byShard[shard], docs[shard])
+    }
+    return [docs[docid] for docid in docids]
+
+  def fetch(self, docid : int):
+    return self.fetch_many([docid])[0]
+
+  def search(self, tags : list, ranking : str, k : int, offset : int = 0, descending : bool = False, fields : [str] = None, invert : list = None):
+    """
+    Like Index.search, but with the arguments of Index.intersect (tags and
+    invert) instead of a node. Each shard finds at most offset + k matches.
+    """
+    hits = self.hits(tags, ranking, offset + k, descending, invert)[offset:]
+    docs = self.fetch_many((docid for _, docid in hits), fields)
+    return [(rank, docid, doc) for (rank, docid), doc in zip(hits, docs)]
+
+  def add_range(self, name, low, high, branching_factor = 2):
+    for shardPath in self.shard_paths:
+      conn = sqlite3.connect(os.path.join(shardPath, 'db.sqlite'))
+      index = self.index_class(conn, shardPath, posting_cache = None)
+      index.add_range(name, low, high, branching_factor)
+      index.save()
+      conn.close()
@@ -0,0 +1,147 @@
+import heapq
+import sqlite3
+
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+
+
+def _sorted_columns(rows):
+  rows = sorted(rows, key = itemgetter(1))
+  return (
+    array('q', map(itemgetter(0), rows)),
+    list(map(itemgetter(1), rows)),
+    array('q', map(itemgetter(2), rows)),
+  )
+
+
+class TokenDictionary:
+  """
+  An in-memory copy of the tokens table.
+
+  Token strings are mapped to their ids with a dict. For prefix search, the
+  strings are also kept in a sorted list, with their counts in the leaves of
+  a max segment tree, so the k most common tokens with a given prefix are
+  found in O(k log n) time, no matter how many tokens share the prefix.
+
+  Tokens added after the dictionary is built are kept in a small unsorted
+  pending dict, which is merged into the sorted list once it grows to a
+  fraction of its size.
+  """
+  def __init__(self, rows = ()):
+    # rows is an iterable of (token, token_str, count) tuples.
+    self._build(*_sorted_columns(rows))
+
+  @staticmethod
+  def load(c : sqlite3.Cursor):
+    # Sorting by token_str here is cheap, since tokenIndex covers it, and
+    # gives the same order as Python (SQLite compares UTF-8 bytes).
+    c.execute("SELECT rowid, token_str, count FROM tokens ORDER BY token_str")
+    ids, strs, counts = array('q'), [], array('q')
+    for token, token_str, count in c:
+      ids.append(token)
+      strs.append(token_str)
+      counts.append(count)
+    r = TokenDictionary.__new__(TokenDictionary)
+    r._build(ids, strs, counts)
+    return r
+
+  def __len__(self):
+    return len(self._ids)
+
+  def __contains__(self, token_str : str):
+    return token_str in self._ids
+
+  def get(self, token_str : str):
+    return self._ids.get(token_str)
+
+  def count(self, token_str : str):
+    if token_str in self._pending:
+      return self._pending[token_str]
+    pos = self._pos[self._ids[token_str]]
+    return self._tree[self._size + pos]
+
+  def add(self, token_str : str, token : int, count : int):
+    assert token_str not in self._ids
+    self._ids[token_str] = token
+    self._pending[token_str] = count
+    if len(self._pending) > max(1024, len(self._sorted) // 16):
+      self._build(*_sorted_columns((t, s, self.count(s)) for s, t in self._ids.items()))
+
+  def increment(self, token_str : str, delta : int = 1):
+    if token_str in self._pending:
+      self._pending[token_str] += delta
+      return
+    i = self._size + self._pos[self._ids[token_str]]
+    self._tree[i] += delta
+    i //= 2
+    while i > 0:
+      self._tree[i] = max(self._tree[2 * i], self._tree[2 * i + 1])
+      i //= 2
+
+  def search(self, query : str, k : int = 20):
+    """
+    Returns the (token_str, count) tuples of the k most common tokens that
+    start with query, most common first.
+    """
+    lo = bisect_left(self._sorted, query)
+    hi = bisect_left(self._sorted, query + '\U0010ffff')
+    # Best-first search over the segment tree nodes that cover [lo, hi).
+    heap = []
+    lo += self._size
+    hi += self._size
+    while lo < hi:
+      if lo & 1:
+        heap.append((-self._tree[lo], lo))
+        lo += 1
+      if hi & 1:
+        hi -= 1
+        heap.append((-self._tree[hi], hi))
+      lo //= 2
+      hi //= 2
+    heapq.heapify(heap)
+    for token_str, count in self._pending.items():
+      if token_str.startswith(query):
+        heapq.heappush(heap, (-count, -1, token_str))
+
+    r = []
+    tree = self._tree
+    while len(heap) > 0 and len(r) < k:
+      node = heapq.heappop(heap)
+      count, i = -node[0], node[1]
+      if i == -1:
+        r.append((node[2], count))
+        continue
+      # Walk down to the leaf with the max count, saving the other branches.
+      while i < self._size:
+        i *= 2
+        if tree[i] < tree[i + 1]:
+          i += 1
+          heapq.heappush(heap, (-tree[i - 1], i - 1))
+        else:
+          heapq.heappush(heap, (-tree[i + 1], i + 1))
+      r.append((self._sorted[i - self._size], count))
+    return r
+
+  def _build(self, ids : array, strs : [str], counts : array):
+    # The three arguments must be sorted by token string.
+    self._sorted = strs
+    self._ids = dict(zip(strs, ids))
+    self._pending = {}
+
+    # self._tree[1] is the root and node i has children 2i and 2i + 1. Leaves
+    # are the counts of self._sorted (or -1 past its end).
+    self._size = 1
+    while self._size < len(strs):
+      self._size *= 2
+    levels = [counts]
+    counts.extend([-1] * (self._size - len(strs)))
+    while len(levels[-1]) > 1:
+      levels.append(array('q', map(max, levels[-1][0::2], levels[-1][1::2])))
+    self._tree = array('q', [-1])
+    for level in reversed(levels):
+      self._tree.extend(level)
+
+    self._pos = array('q', [-1]) * (max(ids, default = 0) + 1)
+    for pos, token in enumerate(ids):
+      self._pos[token] = pos
@@ -8,17 +8,23 @@ class TokenIndex:
   of Expression Nodes.
   """
   @staticmethod
-  def create(c : sqlite3.Cursor, name : str):
+  def create(c : sqlite3.Cursor, name : str, without_rowid : bool = False):
     assert isinstance(c, sqlite3.Cursor)
     assert isinstance(name, str)
-    c.execute(f"""CREATE TABLE tokens_{name} (
+    TokenIndex.create_table(c, f"tokens_{name}", without_rowid)
+    index = TokenIndex(name)
+    return index
+
+  @staticmethod
+  def create_table(c : sqlite3.Cursor, tableName : str, without_rowid : bool = False):
+    # A WITHOUT ROWID table stores postings directly in the primary key's
+    # B-tree, rather than in a rowid table plus a separate index.
+    c.execute(f"""CREATE TABLE {tableName} (
       rank REAL,
       doc_id INTEGER,
       token INTEGER,
       PRIMARY KEY (token, rank, doc_id)
-    )""")
-    index = TokenIndex(name)
-    return index
+    ){' WITHOUT ROWID' if without_rowid else ''}""")
 
   def json(self):
     return { "name": self.name }
@@ -26,13 +32,60 @@ class TokenIndex:
   def __init__(self, name : str):
     self.name = name
     self.tableName = f"tokens_{name}"
+    self.cache = None
+    self.namespace = None
+    self._uncommitted = set()
+
+  def attach_cache(self, cache, namespace):
+    """
+    Caches the results of docids in a PostingCache. namespace must uniquely
+    identify the database this table lives in.
+    """
+    self.cache = cache
+    self.namespace = namespace
+
+  def _invalidate(self, tokens):
+    if self.cache is not None:
+      for token in tokens:
+        self.cache.invalidate(self.namespace, self.name, token)
+        self._uncommitted.add(token)
+
+  def committed(self):
+    """
+    Must be called after committing writes to this table. Readers on other
+    connections may have cached the old postings until the commit.
+    """
+    if self.cache is not None:
+      for token in self._uncommitted:
+        self.cache.invalidate(self.namespace, self.name, token)
+    self._uncommitted = set()
 
-  def docids(self, c : sqlite3.Cursor, token : int, n : int, where : float):
-    query = f"SELECT rank, doc_id FROM {self.tableName} WHERE token = ? AND (rank, doc_id) > (?, ?) ORDER BY token ASC, rank ASC, doc_id ASC LIMIT ?"
+  def docids(self, c : sqlite3.Cursor, token : int, n : int, where : float, descending : bool = False):
+    """
+    Returns the first n (rank, doc_id) tuples of token that come after where.
+
+    If descending is True, postings are walked from high to low and returned
+    as (-rank, -doc_id) tuples (as is where), so callers can treat both
+    directions as increasing sequences.
+    """
+    if self.cache is not None:
+      key = (self.namespace, self.name, token, tuple(where), n, descending)
+      r = self.cache.get(key)
+      if r is not None:
+        return r
+      generation = self.cache.generation()
+    if descending:
+      query = f"SELECT -rank, -doc_id FROM {self.tableName} WHERE token = ? AND (rank, doc_id) < (?, ?) ORDER BY token DESC, rank DESC, doc_id DESC LIMIT ?"
+      where = (-where[0], -where[1])
+    else:
+      query = f"SELECT rank, doc_id FROM {self.tableName} WHERE token = ? AND (rank, doc_id) > (?, ?) ORDER BY token ASC, rank ASC, doc_id ASC LIMIT ?"
     c.execute(query, (
       token, where[0], where[1], n
     ))
-    return c.fetchall()
+    r = c.fetchall()
+    if self.cache is not None:
+      self.cache.put(key, r, generation)
+    return r
 
   def intersect(self, c : sqlite3.Cursor, tokens : [int], n : int, where : float = None):
     assert len(tokens) > 0
@@ -51,6 +104,17 @@ class TokenIndex:
 
   # TODO: intersect
 
+  def posting_list(self, c : sqlite3.Cursor, token : int, limit : int = -1, descending : bool = False):
+    """
+    Returns a cursor over the (rank, doc_id) tuples of token, in order (or
+    over (-rank, -doc_id) tuples, from high to low, if descending is True).
+    """
+    if descending:
+      c.execute(f"SELECT -rank, -doc_id FROM {self.tableName} WHERE token = ? ORDER BY token DESC, rank DESC, doc_id DESC LIMIT ?", (token, limit))
+    else:
+      c.execute(f"SELECT rank, doc_id FROM {self.tableName} WHERE token = ? ORDER BY token ASC, rank ASC, doc_id ASC LIMIT ?", (token, limit))
+    return c
+
   def tokens(self, c : sqlite3.Cursor, doc_id : int):
     assert isinstance(doc_id, int)
     c.execute(f"SELECT token FROM {self.tableName} WHERE doc_id={doc_id}")
@@ -61,12 +125,57 @@ class TokenIndex:
     assert isinstance(rank, int)
     assert isinstance(doc_id, int)
     assert isinstance(token, int)
+    self._invalidate([token])
     c.execute(f"INSERT INTO {self.tableName} (rank, doc_id, token) VALUES (?, ?, ?)", (
       rank,
       doc_id,
       token,
     ))
 
+  def insert_many(self, c : sqlite3.Cursor, rows):
+    """
+    Inserts an iterable of (rank, doc_id, token) tuples with a single
+    executemany.
+    """
+    assert isinstance(c, sqlite3.Cursor)
+    if self.cache is not None:
+      rows = list(rows)
+      self._invalidate(set(row[2] for row in rows))
+    c.executemany(f"INSERT INTO {self.tableName} (rank, doc_id, token) VALUES (?, ?, ?)", rows)
+
+  def delete_many(self, c : sqlite3.Cursor, rows):
+    """
+    Deletes a list of (rank, doc_id, token) tuples with a single executemany,
+    and returns the number of postings deleted.
+    """
+    assert isinstance(c, sqlite3.Cursor)
+    self._invalidate(set(row[2] for row in rows))
+    c.executemany(f"DELETE FROM {self.tableName} WHERE token = ? AND rank = ? AND doc_id = ?", (
+      (token, rank, doc_id) for rank, doc_id, token in rows
+    ))
+    return c.rowcount
+
+  def postings(self, c : sqlite3.Cursor, pageLength : int = 10000):
+    """
+    Yields every (token, rank, doc_id) tuple in primary key order.
+
+    Every page is read with its own SELECT, so no statement stays open (and
+    pins an old snapshot of the database) while the caller writes through
+    the same connection between pages.
+    """
+    c.execute(f"SELECT token, rank, doc_id FROM {self.tableName} ORDER BY token ASC, rank ASC, doc_id ASC LIMIT ?", (pageLength,))
+    rows = c.fetchall()
+    while len(rows) > 0:
+      yield from rows
+      if len(rows) < pageLength:
+        break
+      c.execute(f"""
+        SELECT token, rank, doc_id FROM {self.tableName}
+        WHERE (token, rank, doc_id) > (?, ?, ?)
+        ORDER BY token ASC, rank ASC, doc_id ASC LIMIT ?
+      """, rows[-1] + (pageLength,))
+      rows = c.fetchall()
+
   def print(self, c : sqlite3.Cursor):
     for row in c.execute(f"SELECT * FROM {self.tableName}"):
       print(row)
@@ -75,6 +184,7 @@ class TokenIndex:
     assert isinstance(c, sqlite3.Cursor)
     assert isinstance(doc_id, int)
     assert isinstance(token, int)
+    self._invalidate([token])
     c.execute(f"DELETE FROM {self.tableName} WHERE doc_id = ? AND token = ?", (
       doc_id,
       token,
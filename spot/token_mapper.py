@@ -1,63 +1,213 @@
 import re
 import sqlite3
-from functools import lru_cache
+import threading
+
+from collections import OrderedDict
+
+from .token_dictionary import TokenDictionary
 
 kIntRangePrefix = '#'
 
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER (for versions before 3.32).
+kMaxVariables = 999
+
+# How many token ids TokenMapper remembers (when not in_memory).
+kLookupCacheSize = 4096
+
 
 def is_valid_token(name : str) -> bool:
   if name[:len(kIntRangePrefix)] == kIntRangePrefix:
-    return re.match(r"\d+:\d+", name[kIntRangePrefix:])
+    return re.match(r"^#\w+:\d+:\d+$", name) is not None
   return re.match(r"^[^#\s\"][^\s\"]*$", name) is not None
 
 
+def token_pairs(tokens : [int]):
+  """
+  Yields every (id1, id2) pair of distinct, non-zero tokens, with id1 > id2.
+  """
+  tokens = sorted(set(token for token in tokens if token != 0), reverse = True)
+  for i in range(len(tokens)):
+    for j in range(i + 1, len(tokens)):
+      yield (tokens[i], tokens[j])
+
+
 class TokenMapper:
-  def __init__(self, c : sqlite3.Cursor):
+  """
+  Maps token strings to integer ids, and counts how many documents contain
+  each token, using the tokens table.
+
+  If in_memory is True, the whole table is also loaded into a
+  TokenDictionary, which answers lookups and prefix searches without SQL. It
+  is kept in sync by this class's methods, so every write to the tokens
+  table must go through the same TokenMapper.
+
+  A TokenMapper can be shared by threads, each passing its own cursor.
+  """
+  def __init__(self, c : sqlite3.Cursor, in_memory : bool = False):
     c.execute("""CREATE TABLE IF NOT EXISTS tokens  (
       token_str BLOB,
       count INTEGER
     )""")
     c.execute("CREATE INDEX IF NOT EXISTS tokenIndex ON tokens(token_str, count)")
+    c.execute("""CREATE TABLE IF NOT EXISTS pair_counts (
+      id1 INTEGER,
+      id2 INTEGER,
+      count INTEGER,
+      PRIMARY KEY (id1, id2)
+    )""")
+    self.dictionary = TokenDictionary.load(c) if in_memory else None
+    # An LRU cache of token ids. Ids never change, so unlike the cursor used
+    # to look them up, they can be shared by threads.
+    self._ids = OrderedDict()
+    self._idsLock = threading.Lock()
 
   def exists(self, token_str : str, c : sqlite3.Cursor):
     if token_str == '':
       return True
     if token_str[:len(kIntRangePrefix)] == kIntRangePrefix:
-      assert IntRange.valid_token(token_str), f"Invalid int token \"{token_str}\""
+      assert is_valid_token(token_str), f"Invalid int token \"{token_str}\""
     else:
       assert is_valid_token(token_str), f"Invalid tag \"{token_str}\""
+    if self.dictionary is not None:
+      return token_str in self.dictionary
     c.execute("SELECT rowid FROM tokens WHERE token_str = ?", (token_str,))
     return c.fetchone() is not None
 
   def increment(self, token_str : str, c : sqlite3.Cursor):
     if self.exists(token_str, c):
       c.execute("UPDATE tokens SET count = count + 1 WHERE token_str = ?", (token_str,))
+      if self.dictionary is not None:
+        self.dictionary.increment(token_str)
       return self(token_str, c)
     else:
       c.execute("INSERT INTO tokens (token_str, count) VALUES (?, ?)", (token_str, 1))
+      if self.dictionary is not None:
+        self.dictionary.add(token_str, c.lastrowid, 1)
       return c.lastrowid
 
+  def increment_many(self, counts : dict, c : sqlite3.Cursor):
+    """
+    Bulk version of increment. Takes a {token_str: count} dict and returns a
+    {token_str: token} dict. Issues one SELECT per chunk of tokens (unless
+    the tokens are in memory) and one executemany each for the updates and
+    inserts.
+    """
+    tokens = [token for token in counts if token != '']
+    for token in tokens:
+      assert is_valid_token(token), f"Invalid tag \"{token}\""
+    token2int = self.lookup_many(tokens, c)
+    if self.dictionary is not None:
+      for token in token2int:
+        self.dictionary.increment(token, counts[token])
+    c.executemany("UPDATE tokens SET count = count + ? WHERE rowid = ?", (
+      (counts[token], token2int[token]) for token in token2int
+    ))
+
+    newTokens = [token for token in tokens if token not in token2int]
+    c.execute("SELECT COALESCE(MAX(rowid), 0) FROM tokens")
+    nextId = c.fetchone()[0] + 1
+    for i, token in enumerate(newTokens):
+      token2int[token] = nextId + i
+      if self.dictionary is not None:
+        self.dictionary.add(token, nextId + i, counts[token])
+    c.executemany("INSERT INTO tokens (rowid, token_str, count) VALUES (?, ?, ?)", (
+      (token2int[token], token, counts[token]) for token in newTokens
+    ))
+    if '' in counts:
+      token2int[''] = 0
+    return token2int
+
+  def increment_pairs(self, pairCounts : dict, c : sqlite3.Cursor):
+    """
+    Adds a {(id1, id2): delta} dict (see token_pairs) to the pair_counts table.
+    """
+    c.executemany("""INSERT INTO pair_counts (id1, id2, count) VALUES (?, ?, ?)
+      ON CONFLICT (id1, id2) DO UPDATE SET count = count + excluded.count""", (
+      (id1, id2, delta) for (id1, id2), delta in pairCounts.items() if delta != 0
+    ))
+
   def decrement(self, token_str : str, c : sqlite3.Cursor):
     assert self.exists(token_str, c)
     c.execute("UPDATE tokens SET count = count - 1 WHERE token_str = ?", (token_str,))
+    if self.dictionary is not None:
+      self.dictionary.increment(token_str, -1)
     return self(token_str, c)
 
+  def lookup_many(self, tokens : [str], c : sqlite3.Cursor):
+    """
+    Returns a {token_str: token} dict of the given tokens that exist (and ""),
+    with one SELECT per chunk of tokens (unless the tokens are in memory).
+    """
+    token2int = {}
+    tokens = list(tokens)
+    if '' in tokens:
+      token2int[''] = 0
+    if self.dictionary is not None:
+      for token in tokens:
+        if token in self.dictionary:
+          token2int[token] = self.dictionary.get(token)
+      return token2int
+    tokens = [token for token in tokens if token != '']
+    for i in range(0, len(tokens), kMaxVariables):
+      chunk = tokens[i:i + kMaxVariables]
+      c.execute(f"SELECT rowid, token_str FROM tokens WHERE token_str IN ({','.join('?' * len(chunk))})", chunk)
+      for rowid, token_str in c.fetchall():
+        token2int[token_str] = rowid
+    return token2int
+
+  def decrement_many(self, counts : dict, c : sqlite3.Cursor):
+    """
+    Bulk version of decrement. Takes a {token_str: count} dict of existing
+    tokens and returns a {token_str: token} dict.
+    """
+    token2int = self.lookup_many(counts, c)
+    assert len(token2int) == len(counts), 'decrement_many was given unknown tokens'
+    c.executemany("UPDATE tokens SET count = count - ? WHERE rowid = ?", (
+      (counts[token], token2int[token]) for token in counts if token != ''
+    ))
+    if self.dictionary is not None:
+      for token in counts:
+        if token != '':
+          self.dictionary.increment(token, -counts[token])
+    return token2int
+
   def search(self, query, c : sqlite3.Cursor):
+    if self.dictionary is not None:
+      return self.dictionary.search(query)
     assert '"' not in query
     c.execute(f'SELECT token_str, count FROM tokens WHERE token_str LIKE "{query}%" ORDER BY count DESC LIMIT 20')
     return c.fetchall()
 
-  @lru_cache(maxsize = 512)
   def __call__(self, token_str : str, c : sqlite3.Cursor):
+    if self.dictionary is None or token_str == '':
+      return self._lookup(token_str, c)
+    token = self.dictionary.get(token_str)
+    if token is None:
+      token = self._lookup(token_str, c)
+      self.dictionary.add(token_str, token, 0)
+    return token
+
+  def _lookup(self, token_str : str, c : sqlite3.Cursor):
     if token_str == '':
       return 0
+    with self._idsLock:
+      token = self._ids.get(token_str)
+      if token is not None:
+        self._ids.move_to_end(token_str)
+        return token
     if token_str[:len(kIntRangePrefix)] == kIntRangePrefix:
-      assert IntRange.valid_token(token_str), f"Invalid int token \"{token_str}\""
+      assert is_valid_token(token_str), f"Invalid int token \"{token_str}\""
     else:
       assert is_valid_token(token_str), f"Invalid tag \"{token_str}\""
     c.execute("SELECT rowid FROM tokens WHERE token_str = ?", (token_str,))
     r = c.fetchone()
     if r is not None:
-      return r[0]
-    c.execute("INSERT INTO tokens (token_str, count) VALUES (?, ?)", (token_str, 0))
-    return c.lastrowid
+      token = r[0]
+    else:
+      c.execute("INSERT INTO tokens (token_str, count) VALUES (?, ?)", (token_str, 0))
+      token = c.lastrowid
+    with self._idsLock:
+      self._ids[token_str] = token
+      if len(self._ids) > kLookupCacheSize:
+        self._ids.popitem(last = False)
+    return token
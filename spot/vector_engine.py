@@ -0,0 +1,122 @@
+"""
+An alternative to calling Node.next repeatedly: every posting list in a node
+tree is loaded into a NumPy array and And/Or/Not are evaluated with
+vectorized set operations. This is much faster for small and medium posting
+lists, but needs memory proportional to their size, so trees with a posting
+list longer than max_postings are evaluated by streaming instead.
+
+Requires NumPy.
+"""
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from .nodes import AndNode, OrNode, EmptyNode, ListNode, RankRangeNode, SegmentNode, kBigNumber
+
+kPostingDtype = [('rank', '<f8'), ('doc_id', '<i8')]
+
+kDefaultMaxPostings = 1000000
+
+
+class TooManyPostings(Exception):
+  pass
+
+
+def stream(node, ctx):
+  """
+  Returns every (rank, doc_id) tuple yielded by node, using Node.next.
+  """
+  A = [ctx.first]
+  while A[-1] != ctx.last:
+    A.append(node.next(ctx, A[-1]))
+  return [ctx.decode(a) for a in A[1:-1]]
+
+
+def evaluate(node, ctx, max_postings : int = kDefaultMaxPostings):
+  """
+  Returns the same list of (rank, doc_id) tuples as stream(node, ctx).
+
+  This assumes that all of a document's postings in a table have the same
+  rank (which Index guarantees).
+  """
+  if np is None:
+    raise ImportError('evaluate requires numpy')
+  try:
+    A = _evaluate(node, ctx, max_postings)
+  except TooManyPostings:
+    return stream(node, ctx)
+  # Like the nodes, A holds (-rank, -doc_id) keys in descending contexts.
+  rank, doc_id = A['rank'], A['doc_id']
+  afterFirst = (rank > ctx.first[0]) | ((rank == ctx.first[0]) & (doc_id > ctx.first[1]))
+  beforeLast = (rank < ctx.last[0]) | ((rank == ctx.last[0]) & (doc_id < ctx.last[1]))
+  A = A[afterFirst & beforeLast]
+  if ctx.descending:
+    return list(zip((-A['rank']).tolist(), (-A['doc_id']).tolist()))
+  return A.tolist()
+
+
+def _sort(A):
+  return A[np.lexsort((A['doc_id'], A['rank']))]
+
+
+def _evaluate(node, ctx, max_postings):
+  if isinstance(getattr(node, 'token', None), int):
+    estimate = node.estimate(ctx)
+    if estimate > max_postings and estimate != kBigNumber:
+      raise TooManyPostings()
+    cursor = ctx.index.posting_list(ctx.c, node.token, max_postings + 1, ctx.descending)
+    A = np.fromiter(cursor, dtype = kPostingDtype)
+    if len(A) > max_postings:
+      raise TooManyPostings()
+    return A
+
+  if isinstance(node, EmptyNode):
+    return np.empty(0, dtype = kPostingDtype)
+
+  if isinstance(node, ListNode):
+    A = np.array(node.A, dtype = kPostingDtype)
+    if ctx.descending:
+      A['rank'] *= -1
+      A['doc_id'] *= -1
+    return _sort(A)
+
+  if isinstance(node, OrNode):
+    A = _sort(np.concatenate([_evaluate(child, ctx, max_postings) for child in node.children]))
+    if len(A) == 0:
+      return A
+    isNew = np.ones(len(A), dtype = bool)
+    isNew[1:] = (A['rank'][1:] != A['rank'][:-1]) | (A['doc_id'][1:] != A['doc_id'][:-1])
+    return A[isNew]
+
+  if isinstance(node, AndNode):
+    positive = [_evaluate(child, ctx, max_postings) for child, n in zip(node.children, node.negated) if not n]
+    negative = [_evaluate(child, ctx, max_postings) for child, n in zip(node.children, node.negated) if n]
+    positive.sort(key = len)
+    A = positive[0]
+    for B in positive[1:]:
+      A = A[np.isin(A['doc_id'], B['doc_id'], assume_unique = True)]
+    for B in negative:
+      A = A[~np.isin(A['doc_id'], B['doc_id'], assume_unique = True)]
+    return A
+
+  if isinstance(node, RankRangeNode):
+    A = _evaluate(node.child, ctx, max_postings)
+    rank = -A['rank'] if ctx.descending else A['rank']
+    if node.low is not None:
+      A, rank = A[rank >= node.low], rank[rank >= node.low]
+    if node.high is not None:
+      A = A[rank <= node.high]
+    return A
+
+  if isinstance(node, SegmentNode):
+    segmentContext, deleted = ctx.segment(node.segment)
+    A = _evaluate(node.child, segmentContext, max_postings)
+    if len(deleted) == 0:
+      return A
+    deleted = np.fromiter(deleted, dtype = '<i8', count = len(deleted))
+    return A[~np.isin(np.abs(A['doc_id']), deleted)]
+
+  # Unknown nodes are materialized by streaming them.
+  return np.array(stream(node, ctx), dtype = kPostingDtype)
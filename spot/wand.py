@@ -0,0 +1,160 @@
+"""
+Top-k retrieval of the documents with the largest sum of token weights (see
+Index.scored_search), using WAND or block-max WAND (Ding & Suel, 2011): the
+posting lists are walked in doc_id order, and documents (or whole blocks of
+docids) whose upper bound can't beat the current k-th best score are skipped
+without being scored.
+"""
+
+import heapq
+
+from bisect import bisect_left
+
+from .score_index import kBlockBits
+
+kEnd = float('inf')
+
+
+class ScoredList:
+  """
+  A cursor over the (doc_id, weight) postings of a token, whose scores are
+  weight * multiplier (e.g. the token's IDF).
+  """
+  def __init__(self, c, score_index, token : int, multiplier : float, order : int = 0, pageLength : int = 256):
+    self.c = c
+    self.score_index = score_index
+    self.token = token
+    self.multiplier = multiplier
+    # The position of the token in the query, so scores are always summed in
+    # the same order.
+    self.order = order
+    self.pageLength = pageLength
+    blocks = score_index.blocks(c, token)
+    self._blocks = [block for block, _ in blocks]
+    self._blockMax = [weight * multiplier for _, weight in blocks]
+    self.max_score = max(self._blockMax, default = 0.0)
+    self._page = []
+    self._i = 0
+    self.doc_id = -1
+    self.next_geq(0)
+
+  def next_geq(self, doc_id : int):
+    """
+    Moves to the first posting with a doc_id of at least doc_id.
+    """
+    if doc_id <= self.doc_id:
+      return
+    i = bisect_left(self._page, (doc_id,), self._i)
+    if i == len(self._page):
+      self._page = self.score_index.postings(self.c, self.token, doc_id, self.pageLength)
+      i = 0
+    self._i = i
+    self.doc_id = self._page[i][0] if i < len(self._page) else kEnd
+
+  def score(self):
+    return self._page[self._i][1] * self.multiplier
+
+  def block_max(self, doc_id : int):
+    """
+    An upper bound on the score of any posting in doc_id's block.
+    """
+    block = doc_id >> kBlockBits
+    i = bisect_left(self._blocks, block)
+    if i < len(self._blocks) and self._blocks[i] == block:
+      return self._blockMax[i]
+    return 0.0
+
+
+def _push(heap, k, score, doc_id):
+  # Keeps the k best (score, -doc_id) tuples, so ties go to lower doc_ids.
+  item = (score, -doc_id)
+  if len(heap) < k:
+    heapq.heappush(heap, item)
+  elif item > heap[0]:
+    heapq.heapreplace(heap, item)
+
+
+def _results(heap):
+  return sorted(((score, -negDocid) for score, negDocid in heap), key = lambda r: (-r[0], r[1]))
+
+
+def _score(lists, prior, doc_id):
+  score = sum(l.score() for l in sorted((l for l in lists if l.doc_id == doc_id), key = lambda l: l.order))
+  if prior is not None:
+    prior.next_geq(doc_id)
+    if prior.doc_id == doc_id:
+      score += prior.score()
+  return score
+
+
+def top_k(lists : [ScoredList], k : int, prior : ScoredList = None, deleted = (), block_max : bool = True):
+  """
+  Returns the (score, doc_id) tuples of the k documents (that have at least
+  one of the lists' tokens, and aren't deleted) with the largest scores,
+  from high to low. A document's score is the sum of its postings' scores
+  plus its score in prior (if given). Scores must be non-negative.
+  """
+  heap = []
+  # The score a document must beat to make it into the top k.
+  theta = -1.0
+  priorMax = 0.0 if prior is None else prior.max_score
+  active = [l for l in lists if l.doc_id != kEnd]
+  while len(active) > 0 and k > 0:
+    active.sort(key = lambda l: l.doc_id)
+    # The pivot is the first document whose upper bound beats theta.
+    bound = priorMax
+    p = None
+    for i, l in enumerate(active):
+      bound += l.max_score
+      if bound > theta:
+        p = i
+        break
+    if p is None:
+      break
+    pivot = active[p].doc_id
+    while p + 1 < len(active) and active[p + 1].doc_id == pivot:
+      p += 1
+
+    if active[0].doc_id != pivot:
+      # Lists before the pivot can't reach theta on their own.
+      for l in active[:p]:
+        l.next_geq(pivot)
+    elif block_max and sum(l.block_max(pivot) for l in active[:p + 1]) + (0.0 if prior is None else prior.block_max(pivot)) <= theta:
+      # No document in the rest of this block can beat theta without the
+      # lists after p, so skip to the end of the block (or the next list).
+      target = ((pivot >> kBlockBits) + 1) << kBlockBits
+      if p + 1 < len(active):
+        target = min(target, active[p + 1].doc_id)
+      for l in active[:p + 1]:
+        l.next_geq(target)
+    else:
+      if pivot not in deleted:
+        _push(heap, k, _score(active[:p + 1], prior, pivot), pivot)
+        if len(heap) == k:
+          theta = heap[0][0]
+      for l in active[:p + 1]:
+        l.next_geq(pivot + 1)
+    active = [l for l in active if l.doc_id != kEnd]
+  return _results(heap)
+
+
+def exhaustive_top_k(lists : [ScoredList], k : int, prior : ScoredList = None, deleted = ()):
+  """
+  Same as top_k, but scores every document that has any of the tokens.
+  """
+  scores = {}
+  for l in sorted(lists, key = lambda l: l.order):
+    while l.doc_id != kEnd:
+      scores[l.doc_id] = scores.get(l.doc_id, 0) + l.score()
+      l.next_geq(l.doc_id + 1)
+  heap = []
+  for doc_id in sorted(scores):
+    if doc_id in deleted:
+      continue
+    score = scores[doc_id]
+    if prior is not None:
+      prior.next_geq(doc_id)
+      if prior.doc_id == doc_id:
+        score += prior.score()
+    _push(heap, k, score, doc_id)
+  return _results(heap)